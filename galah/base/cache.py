@@ -0,0 +1,305 @@
+"""
+A thread-safe in-memory cache with an optional maximum size and optional
+expiration times, along with a decorator that caches a function's return
+values in one.
+
+Entries can be given tags so related entries can be invalidated together, for
+example everything computed from a particular assignment. Every cache keeps
+hit, miss, and eviction counts, and every named cache is listed in
+all_statistics() so they can be reported. The counts are not updated under a
+lock, so they may be slightly low when many threads use a cache at once.
+
+When a cache is full, an entry that hasn't been used recently is evicted. This
+uses the CLOCK (or second chance) approximation of least recently used
+eviction: a hit only marks its entry as used, and entries that have been
+marked are skipped over (and unmarked) when looking for one to evict. That way
+hits never take the cache's lock, which keeps them almost as cheap as a
+dictionary lookup.
+
+"""
+
+import threading
+import functools
+import weakref
+import time
+
+# Every named cache, so their statistics can be collected in one place.
+_caches = weakref.WeakValueDictionary()
+
+def all_statistics():
+    "Returns a dictionary mapping cache names to their statistics."
+
+    return dict((k, v.statistics()) for k, v in _caches.items())
+
+# Indexes into the lists that make up the entries of a cache's linked list.
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES, _TAGS, _USED = range(7)
+
+_missing = object()
+
+class Cache(object):
+    def __init__(self, max_size = None, ttl = None, name = None):
+        """
+        max_size is the most entries the cache will hold, and ttl is how many
+        seconds entries last by default. Either may be None, meaning no limit.
+        If name is given the cache is included in all_statistics().
+
+        """
+
+        if max_size is not None and max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+
+        # Maps keys to entries, each entry being a list of the form
+        # [prev, next, key, value, expires, tags, used]. The entries also form
+        # a circular doubly linked list with the newest entries right after
+        # the root and the next candidate for eviction right before it.
+        self._entries = {}
+        self._root = []
+        self._reset_root()
+
+        # Maps tags to the set of keys that have them.
+        self._tags = {}
+
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+        if name is not None:
+            _caches[name] = self
+
+    def _reset_root(self):
+        self._root[:] = [self._root, self._root, None, None, None, None, None]
+
+    def _link_first(self, entry):
+        "Puts an entry at the front of the list. Must hold the lock."
+
+        root = self._root
+        first = root[_NEXT]
+        entry[_PREV] = root
+        entry[_NEXT] = first
+        first[_PREV] = entry
+        root[_NEXT] = entry
+
+    def _unlink(self, entry):
+        "Removes an entry from the cache entirely. Must hold the lock."
+
+        entry[_PREV][_NEXT] = entry[_NEXT]
+        entry[_NEXT][_PREV] = entry[_PREV]
+        del self._entries[entry[_KEY]]
+
+        for i in entry[_TAGS]:
+            keys = self._tags[i]
+            keys.discard(entry[_KEY])
+            if not keys:
+                del self._tags[i]
+
+    def _evict(self):
+        "Evicts one entry that hasn't been used recently. Must hold the lock."
+
+        root = self._root
+        while True:
+            last = root[_PREV]
+            if not last[_USED]:
+                break
+
+            # Give the entry a second chance.
+            last[_USED] = False
+            last[_PREV][_NEXT] = root
+            root[_PREV] = last[_PREV]
+            self._link_first(last)
+
+        self._unlink(last)
+        self.evictions += 1
+
+    def get(self, key, default = None):
+        "Returns the value cached for key, or default if there is none."
+
+        # Getting an item out of a dictionary is atomic, so this is safe
+        # without the lock. The entry may be removed by another thread right
+        # after, but then we've just returned a value that was cached a moment
+        # ago.
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        if entry[_EXPIRES] is not None and entry[_EXPIRES] <= time.time():
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._unlink(entry)
+                    self.expirations += 1
+
+            self.misses += 1
+            return default
+
+        entry[_USED] = True
+        self.hits += 1
+        return entry[_VALUE]
+
+    def set(self, key, value, ttl = _missing, tags = ()):
+        """
+        Caches value under key, replacing anything already there. ttl
+        overrides the cache's default time to live (None means forever), and
+        tags is a collection of tags to file the entry under.
+
+        """
+
+        if ttl is _missing:
+            ttl = self.ttl
+
+        # The wall clock may jump, but that only makes entries expire early or
+        # late, and it's much cheaper to read than a monotonic clock.
+        expires = None if ttl is None else time.time() + ttl
+        tags = frozenset(tags)
+
+        with self._lock:
+            if key in self._entries:
+                self._unlink(self._entries[key])
+
+            # New entries start out marked so that they aren't evicted before
+            # anything that's been sitting around unused.
+            entry = [None, None, key, value, expires, tags, True]
+            self._link_first(entry)
+            self._entries[key] = entry
+
+            for i in tags:
+                self._tags.setdefault(i, set()).add(key)
+
+            if self.max_size is not None and \
+                    len(self._entries) > self.max_size:
+                self._evict()
+
+    def invalidate(self, key):
+        "Forgets the entry for key. Returns True if there was one."
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+
+            self._unlink(entry)
+            self.invalidations += 1
+
+            return True
+
+    def invalidate_tag(self, tag):
+        "Forgets every entry with the given tag. Returns how many there were."
+
+        with self._lock:
+            keys = list(self._tags.get(tag, ()))
+            for i in keys:
+                self._unlink(self._entries[i])
+
+            self.invalidations += len(keys)
+
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+
+            self._entries.clear()
+            self._tags.clear()
+            self._reset_root()
+
+    def statistics(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+
+        return entry is not None and (
+            entry[_EXPIRES] is None or entry[_EXPIRES] > time.time()
+        )
+
+# Separates positional from keyword arguments in keys.
+_kwargs_marker = object()
+
+def _make_key(args, kwargs):
+    if not kwargs:
+        return args
+
+    return args + (_kwargs_marker, ) + tuple(sorted(kwargs.items()))
+
+def cached(max_size = None, ttl = None, tags = None, name = None):
+    """
+    Decorator. Caches a function's return values, keyed by the arguments it's
+    called with, in a Cache with the given max_size and ttl. The cache is
+    named after the function unless name is given.
+
+    tags, if given, is a function that's called with the same arguments as the
+    decorated function and returns the tags to file the result under.
+
+    Calls with unhashable arguments are not cached. The function itself is
+    called without holding any locks, so two threads asking for the same
+    missing value at once may both compute it.
+
+    The decorated function has a cache attribute holding its Cache, and an
+    invalidate function that takes the same arguments as the decorated
+    function and forgets the result cached for them.
+
+    """
+
+    def decorator(func):
+        cache = Cache(
+            max_size, ttl,
+            name if name is not None else
+                "%s.%s" % (func.__module__, func.__name__)
+        )
+        entries = cache._entries
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs) if kwargs else args
+
+            try:
+                # This is Cache.get inlined, which makes a noticeable
+                # difference for cheap functions.
+                entry = entries.get(key)
+            except TypeError:
+                # Unhashable arguments, better to not cache than blow up.
+                return func(*args, **kwargs)
+
+            if entry is not None and (entry[_EXPIRES] is None or
+                    entry[_EXPIRES] > time.time()):
+                entry[_USED] = True
+                cache.hits += 1
+                return entry[_VALUE]
+
+            value = cache.get(key, _missing)
+            if value is _missing:
+                value = func(*args, **kwargs)
+                cache.set(
+                    key, value,
+                    tags = tags(*args, **kwargs) if tags is not None else ()
+                )
+
+            return value
+
+        def invalidate(*args, **kwargs):
+            return cache.invalidate(_make_key(args, kwargs))
+
+        wrapper.cache = cache
+        wrapper.invalidate = invalidate
+
+        return wrapper
+
+    return decorator
@@ -5,6 +5,7 @@ defaults = {
     "global/CURRENT_VERSION": "v0.1.3",
     "global/SUBMISSION_DIRECTORY": "/var/local/galah/web/submissions/",
     "global/CSV_DIRECTORY": "/var/local/galah/reports/csv/",
+    "global/ARCHIVE_DIRECTORY": "/var/local/galah/reports/archives/",
     "global/HARNESS_DIRECTORY": "/var/local/galah/web/harness/",
     "global/MONGODB": "galah",
     "global/SISYPHUS_ADDRESS": "ipc:///tmp/sisyphus.sock",
@@ -25,13 +26,55 @@ defaults = {
     "web/GOOGLE_LOGIN_CAPTION": "Login with Google",
     "sisyphus/TEACHER_ARCHIVE_LIFETIME": datetime.timedelta(minutes = 2),
     "sisyphus/TEACHER_CSV_LIFETIME": datetime.timedelta(minutes = 2),
+    "sisyphus/NWORKERS": 4,
+    "sisyphus/NPRIORITY_WORKERS": 1,
+    "sisyphus/DEFAULT_TASK_LANE":
+        {"lane": "thread", "concurrency": 1, "priority": 1, "attempts": 3},
+    "sisyphus/TASK_LANES": {
+        "delete_assignments": {"priority": 0},
+        "create_gradebook_csv":
+            {"lane": "process", "concurrency": 2, "priority": 0},
+        "create_assignment_csv":
+            {"lane": "process", "concurrency": 2, "priority": 0},
+        "zip_bulk_submissions": {"lane": "process", "concurrency": 2},
+        "rerun_test_harness": {"concurrency": 2, "attempts": 1}
+    },
+    "sisyphus/STATISTICS_INTERVAL": datetime.timedelta(minutes = 5),
+    "sisyphus/TASK_LEASE": datetime.timedelta(minutes = 1),
+    "sisyphus/TASK_POLL_INTERVAL": datetime.timedelta(seconds = 10),
+    "sisyphus/TASK_RETRY_DELAY": datetime.timedelta(seconds = 15),
+    "sisyphus/TASK_MAX_RETRY_DELAY": datetime.timedelta(minutes = 10),
+    "sisyphus/TASK_HISTORY_LIFETIME": datetime.timedelta(days = 1),
+    "sisyphus/ZIP_PROCESSES": 1,
+    "sisyphus/ARCHIVE_CACHE_DIRECTORY":
+        "/var/local/galah/sisyphus/archive-cache/",
+    "sisyphus/ARCHIVE_CACHE_BUDGET": 4 * 1024 * 1024 * 1024,
+    "sisyphus/JANITOR_INTERVAL": datetime.timedelta(minutes = 1),
+    "sisyphus/JANITOR_BATCH_SIZE": 100,
+    "sisyphus/JANITOR_BATCH_DELAY": datetime.timedelta(seconds = 1),
+    "sisyphus/JANITOR_ORPHAN_AGE": datetime.timedelta(hours = 1),
     "sheep/NCONSUMERS": 1,
     "sheep/VIRTUAL_SUITE": "dummy",
+    "sheep/PIPELINE": False,
+    "sheep/BLOB_DIRECTORY": "/var/local/galah/sheep/blobs/",
+    "sheep/CHUNK_SIZE": 256 * 1024,
+    "sheep/CHUNK_TIMEOUT": datetime.timedelta(seconds = 10),
+    "sheep/CHUNK_RETRIES": 5,
+    "sheep/BLOB_BUDGET": 1024 * 1024 * 1024,
+    "sheep/OUTBOX_DIRECTORY": "/var/local/galah/sheep/outbox/",
+    "sheep/REDELIVERY_BATCH_SIZE": 50,
+    "sheep/MAX_REDELIVERIES": 10,
     "sheep/vz/OS_TEMPLATE": "centos-6-x86_64",
     "sheep/vz/MAX_MACHINES": 2,
     "sheep/vz/LOW_MACHINE_THRESHOLD": 1,
     "sheep/vz/LOW_MACHINE_PERIOD": datetime.timedelta(minutes = 1),
     "sheep/vz/VZCTL_RETRY_TIMEOUT": datetime.timedelta(seconds = 30),
+    "sheep/vz/VZCTL_RETRY_DELAY": datetime.timedelta(milliseconds = 50),
+    "sheep/vz/VZCTL_RETRY_MAX_DELAY": datetime.timedelta(seconds = 2),
+    "sheep/vz/VZCTL_PATH": "/usr/sbin/vzctl",
+    "sheep/vz/VZLIST_PATH": "/usr/sbin/vzlist",
+    "sheep/vz/VZ_CONFIG_PATH": "/etc/vz/vz.conf",
+    "sheep/vz/INVENTORY_LIFETIME": datetime.timedelta(seconds = 30),
     "sheep/vz/CALL_MKDIR": True,
     "sheep/vz/VM_TESTABLES_DIRECTORY": "/tmp/testables/",
     "sheep/vz/VM_HARNESS_DIRECTORY": "/tmp/harness/",
@@ -40,11 +83,47 @@ defaults = {
     "sheep/vz/TESTUSER_GID": 1000,
     "sheep/vz/VM_SUBNET": "10.0.1",
     "sheep/vz/VM_PORT": 6668, # Must be changed in the bootstrapper as well.
+    "sheep/vz/CALLBACK_ADDRESS": None,
+    "sheep/vz/CALLBACK_PORT": 6669,
+    "sheep/vz/CALLBACK_HOST": None, # Defaults to CALLBACK_ADDRESS.
+    "sheep/vz/STREAM_INJECTION": True,
+    "sheep/vz/MAX_RESULT_SIZE": 4 * 1024 * 1024,
+    "sheep/vz/MAX_LOG_SIZE": 64 * 1024,
+    "sheep/vz/MAX_PARTIAL_OUTPUT_SIZE": 16 * 1024,
+    "sheep/vz/LOG_SPILL_DIRECTORY": None,
+    "sheep/vz/MAX_SPILL_SIZE": 64 * 1024 * 1024,
+    "sheep/vz/HARNESS_CACHE_DIRECTORY": "/var/local/galah/sheep/harnesses/",
+    "sheep/vz/HARNESS_CACHE_BUDGET": 1024 * 1024 * 1024,
+    "sheep/dummy/PRODUCE_TIME": ("fixed", 10),
+    "sheep/dummy/PREPARE_TIME": ("fixed", 10),
+    "sheep/dummy/TEST_TIME": ("fixed", 20),
+    "sheep/dummy/FAILURE_RATE": 0.0,
+    "sheep/dummy/RESULT_SIZE": ("fixed", 0),
+    "sheep/dummy/SEED": None,
+    "sheep/sandbox/DIRECTORY": "/var/local/galah/sheep/sandbox/",
+    "sheep/sandbox/MAX_SLOTS": 4,
+    "sheep/sandbox/TESTUSER_UID": 1000, # Only used if the sheep runs as root.
+    "sheep/sandbox/TESTUSER_GID": 1000,
+    "sheep/sandbox/RLIMIT_AS": 1024 * 1024 * 1024,
+    "sheep/sandbox/RLIMIT_NOFILE": 256,
+    "sheep/sandbox/RLIMIT_NPROC": 64, # Counts every process the user has.
+    "sheep/sandbox/UNSHARE": ["--user", "--net", "--ipc", "--uts"],
+    "sheep/sandbox/UNSHARE_PATH": "/usr/bin/unshare",
+    "sheep/sandbox/CHROOT": None,
+    "sheep/sandbox/CHROOT_PATH": "/usr/sbin/chroot",
+    "sheep/sandbox/MAX_RESULT_SIZE": 4 * 1024 * 1024,
+    "sheep/sandbox/MAX_LOG_SIZE": 64 * 1024,
+    "sheep/sandbox/MAX_PARTIAL_OUTPUT_SIZE": 16 * 1024,
     "shepherd/SHEEP_SOCKET": "ipc:///tmp/shepherd-sheep.sock",
     "shepherd/PUBLIC_SOCKET": "ipc:///tmp/shepherd-public.sock",
     "shepherd/REQUEST_QUEUE_TIMEOUT": datetime.timedelta(minutes = 1),
     "shepherd/SERVICE_TIMEOUT": datetime.timedelta(minutes = 1),
-    "shepherd/BLEET_TIMEOUT":  datetime.timedelta(seconds = 30)
+    "shepherd/BLEET_TIMEOUT":  datetime.timedelta(seconds = 30),
+    "shepherd/TRANSFER_FILES": False,
+    "shepherd/BLOB_DIRECTORY": "/var/local/galah/shepherd/blobs/",
+    "shepherd/BLOB_BUDGET": 1024 * 1024 * 1024,
+    "shepherd/MAX_CHUNK_SIZE": 1024 * 1024,
+    "shepherd/BLOB_WORKERS": 2
 }
 
 import imp
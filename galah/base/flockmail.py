@@ -3,8 +3,8 @@ class FlockMessage:
 
     # Acceptable types for a shepherd/sheep to send or sheep/shepherd to
     # receive.
-    shepherd_types = ("bloot", "identify", "request")
-    sheep_types = ("bleet", "environment", "distress", "result")
+    shepherd_types = ("bloot", "identify", "request", "chunk")
+    sheep_types = ("bleet", "environment", "distress", "result", "fetch")
 
     def __init__(self, type, body):
         self.type = type
@@ -49,18 +49,21 @@ class InternalTestRequest:
 
     """
 
-    __slots__ = ("submission_id", "timeout", "environment")
+    __slots__ = ("submission_id", "timeout", "environment", "test_harness_id")
 
-    def __init__(self, submission_id, timeout, environment):
+    def __init__(self, submission_id, timeout, environment,
+            test_harness_id = None):
         self.submission_id = submission_id
         self.timeout = timeout
         self.environment = environment
+        self.test_harness_id = test_harness_id
 
     def to_dict(self):
         return {
             "submission_id": self.submission_id,
             "timeout": self.timeout,
-            "environment": self.environment
+            "environment": self.environment,
+            "test_harness_id": self.test_harness_id
         }
 
     @staticmethod
@@ -68,5 +71,6 @@ class InternalTestRequest:
         return InternalTestRequest(
             raw["submission_id"],
             raw["timeout"],
-            raw["environment"]
+            raw["environment"],
+            raw.get("test_harness_id")
         )
@@ -4,41 +4,17 @@ handy they're almost magical.
 
 """
 
-import collections
-import functools
+from galah.base.cache import cached
 
-# http://wiki.python.org/moin/PythonDecoratorLibrary#Memoize
-class memoize(object):
+def memoize(func):
    """
    Decorator. Caches a function's return value each time it is called.
    If called later with the same arguments, the cached value is returned
    (not reevaluated).
 
-   """
-
-   def __init__(self, func):
-      self.func = func
-      self.cache = {}
-
-   def __call__(self, *args):
-      if not isinstance(args, collections.Hashable):
-         # uncacheable. a list, for instance.
-         # better to not cache than blow up.
-         return self.func(*args)
-
-      if args in self.cache:
-         return self.cache[args]
-      else:
-         value = self.func(*args)
-         self.cache[args] = value
-         return value
+   The cache is never emptied, use galah.base.cache.cached directly for
+   control over its size and lifetime.
 
-   def __repr__(self):
-      "Return the function's docstring."
-
-      return self.func.__doc__
-
-   def __get__(self, obj, objtype):
-      "Support instance methods."
+   """
 
-      return functools.partial(self.__call__, obj)
+   return cached()(func)
@@ -1,11 +1,10 @@
-# Snippet below derived from code published by Matteo Dell'Amico and published
-# under the unlicense.
+# The interface below is derived from code published by Matteo Dell'Amico and
+# published under the unlicense.
 #     see: https://gist.github.com/4451520
 # If you wish to use this file in your own project, go to the link above, DO NOT
 # use the code within this file verbatim unless you are prepared to work under
 # the restrictions of the AGPLv3, as this file is licenced under it.
 
-from heapq import heapify, heappush, heappop
 from collections import namedtuple
 
 PriorityValuePair = namedtuple("PriorityValuePair", ["priority", "value"])
@@ -16,22 +15,115 @@ class PriorityDict(dict):
     Keys of the dictionary are items to be put into the queue, and values
     are their respective priorities. All dictionary methods work as expected.
     The advantage over a standard heapq-based priority queue is
-    that priorities of items can be efficiently updated (amortized O(1))
+    that priorities of items can be efficiently updated (O(log n))
     using code as 'thedict[item] = new_priority.'
 
     The 'smallest' method can be used to return the object with lowest
     priority, and 'pop_smallest' also removes it.
 
     The 'sorted_iter' method provides a destructive sorted iterator.
-    """    
+
+    Internally this is an indexed d-ary heap: the position of every key in the
+    heap is tracked so that updating or deleting a key fixes the heap up in
+    place rather than leaving stale entries behind. The heap therefore never
+    holds more than one entry per key. Only priorities are compared, items
+    with equal priorities come out in no particular order.
+    """
+
+    # The number of children each node in the heap has. Wider heaps are
+    # shallower, which makes inserts and priority decreases (the common case
+    # when priorities are timestamps) cheaper.
+    ARITY = 4
 
     def __init__(self, *args, **kwargs):
         super(PriorityDict, self).__init__(*args, **kwargs)
         self._rebuild_heap()
 
     def _rebuild_heap(self):
-        self._heap = [(v, k) for k, v in self.iteritems()]
-        heapify(self._heap)
+        # The heap is kept as two parallel lists, so no tuples are created or
+        # compared, along with a dictionary mapping keys to their positions.
+        self._keys = self.keys()
+        self._priorities = [self[k] for k in self._keys]
+        self._positions = dict((k, i) for i, k in enumerate(self._keys))
+
+        for i in xrange((len(self._keys) - 2) // self.ARITY, -1, -1):
+            self._sift_down(i)
+
+    def _sift_up(self, position):
+        keys, priorities, positions = \
+            self._keys, self._priorities, self._positions
+        arity = self.ARITY
+        key, priority = keys[position], priorities[position]
+
+        while position > 0:
+            parent = (position - 1) // arity
+            parent_priority = priorities[parent]
+            if not priority < parent_priority:
+                break
+
+            parent_key = keys[parent]
+            keys[position] = parent_key
+            priorities[position] = parent_priority
+            positions[parent_key] = position
+
+            position = parent
+
+        keys[position] = key
+        priorities[position] = priority
+        positions[key] = position
+
+    def _sift_down(self, position):
+        keys, priorities, positions = \
+            self._keys, self._priorities, self._positions
+        arity = self.ARITY
+        key, priority = keys[position], priorities[position]
+        size = len(keys)
+
+        while True:
+            first_child = position * arity + 1
+            if first_child >= size:
+                break
+
+            # Find the child with the smallest priority.
+            child = first_child
+            child_priority = priorities[first_child]
+            for i in xrange(first_child + 1, min(first_child + arity, size)):
+                if priorities[i] < child_priority:
+                    child = i
+                    child_priority = priorities[i]
+
+            if not child_priority < priority:
+                break
+
+            child_key = keys[child]
+            keys[position] = child_key
+            priorities[position] = child_priority
+            positions[child_key] = position
+
+            position = child
+
+        keys[position] = key
+        priorities[position] = priority
+        positions[key] = position
+
+    def _remove_from_heap(self, key):
+        position = self._positions.pop(key)
+
+        # Fill the hole with the last entry and move that to where it belongs.
+        last_key = self._keys.pop()
+        last_priority = self._priorities.pop()
+        if position == len(self._keys):
+            return
+
+        self._keys[position] = last_key
+        self._priorities[position] = last_priority
+        self._positions[last_key] = position
+
+        parent = (position - 1) // self.ARITY
+        if position > 0 and last_priority < self._priorities[parent]:
+            self._sift_up(position)
+        else:
+            self._sift_down(position)
 
     def smallest(self):
         """
@@ -41,13 +133,28 @@ class PriorityDict(dict):
         Raises IndexError if the object is empty.
 
         """
-        
-        heap = self._heap
-        v, k = heap[0]
-        while k not in self or self[k] != v:
-            heappop(heap)
-            v, k = heap[0]
-        return PriorityValuePair(v, k)
+
+        if not self._keys:
+            raise IndexError("smallest of empty PriorityDict")
+
+        return PriorityValuePair(self._priorities[0], self._keys[0])
+
+    def top(self, n):
+        """
+        Return up to n items from the top of the heap as named tuples
+        (priority, value), without removing them.
+
+        The items are in no particular order and are not necessarily the n
+        smallest, but the smallest item is always among them and none of them
+        is larger than every item left out. This is O(n) however large the
+        dictionary is.
+
+        """
+
+        return [
+            PriorityValuePair(self._priorities[i], self._keys[i])
+                for i in xrange(min(n, len(self._keys)))
+        ]
 
     def pop_smallest(self):
         """
@@ -57,26 +164,56 @@ class PriorityDict(dict):
         Raises IndexError if the object is empty.
 
         """
-        
-        heap = self._heap
-        v, k = heappop(heap)
-        while k not in self or self[k] != v:
-            v, k = heappop(heap)
-        del self[k]
-        return PriorityValuePair(v, k)
+
+        if not self._keys:
+            raise IndexError("pop_smallest of empty PriorityDict")
+
+        result = PriorityValuePair(self._priorities[0], self._keys[0])
+        del self[result.value]
+        return result
 
     def __setitem__(self, key, val):
-        # We are not going to remove the previous value from the heap,
-        # since this would have a cost O(n).
-        
-        super(PriorityDict, self).__setitem__(key, val)
-        
-        if len(self._heap) < 2 * len(self):
-            heappush(self._heap, (val, key))
+        dict.__setitem__(self, key, val)
+
+        position = self._positions.get(key)
+        if position is None:
+            self._keys.append(key)
+            self._priorities.append(val)
+            self._sift_up(len(self._keys) - 1)
         else:
-            # When the heap grows larger than 2 * len(self), we rebuild it
-            # from scratch to avoid wasting too much memory.
-            self._rebuild_heap()
+            old_val = self._priorities[position]
+            self._priorities[position] = val
+
+            if val < old_val:
+                self._sift_up(position)
+            else:
+                self._sift_down(position)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+
+        self._remove_from_heap(key)
+
+    _marker = object()
+    def pop(self, key, default = _marker):
+        if key not in self:
+            if default is PriorityDict._marker:
+                raise KeyError(key)
+
+            return default
+
+        val = self[key]
+        del self[key]
+        return val
+
+    def popitem(self):
+        key, val = super(PriorityDict, self).popitem()
+        self._remove_from_heap(key)
+        return key, val
+
+    def clear(self):
+        super(PriorityDict, self).clear()
+        self._rebuild_heap()
 
     def setdefault(self, key, val):
         if key not in self:
@@ -88,7 +225,7 @@ class PriorityDict(dict):
         # Reimplementing dict.update is tricky -- see e.g.
         # http://mail.python.org/pipermail/python-ideas/2007-May/000744.html
         # We just rebuild the heap from scratch after passing to super.
-        
+
         super(PriorityDict, self).update(*args, **kwargs)
         self._rebuild_heap()
 
@@ -97,6 +234,6 @@ class PriorityDict(dict):
 
         Beware: this will destroy elements as they are returned.
         """
-        
+
         while self:
             yield self.pop_smallest()
@@ -5,3 +5,44 @@ def tuplify(target):
         return (target, )
     else:
         return target
+
+import time
+def _find_monotonic():
+    "Returns the best monotonic clock function available."
+
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        librt = ctypes.CDLL(
+            ctypes.util.find_library("rt") or ctypes.util.find_library("c"),
+            use_errno = True
+        )
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            now = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+
+            return now.tv_sec + now.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError, TypeError):
+        # The wall clock can go backwards, but it's the best we can do.
+        return time.time
+
+# Returns the number of seconds since some fixed point in the past as a float.
+# Unlike time.time() it never goes backwards, so it's suitable for measuring
+# intervals and for timestamps that are only compared to each other.
+monotonic = _find_monotonic()
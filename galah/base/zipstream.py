@@ -0,0 +1,205 @@
+"""
+Writes zip archives straight from the filesystem, one entry at a time, without
+building a temporary tree to zip up or changing the working directory.
+
+Files are read and compressed in chunks so memory use doesn't depend on how
+big they are, and ZIP64 extensions are used when an archive or a file in it is
+too big for a plain zip file. Files that are already compressed (judged by
+their extension) are stored as they are rather than compressed again.
+
+Compressing can optionally be spread across a pool of processes. Only files
+small enough to compress in memory are sent to the pool, and only a few at a
+time, so memory use stays bounded. The pool is made by forking, so it should
+only be used by processes that don't have other threads running.
+
+"""
+
+import multiprocessing
+import collections
+import zipfile
+import os.path
+import zlib
+import time
+import os
+
+# Extensions of files that are stored without compressing them because they
+# are compressed already.
+STORED_EXTENSIONS = frozenset([
+    ".zip", ".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz", ".lzma", ".7z",
+    ".rar", ".jar", ".war", ".whl", ".egg", ".png", ".jpg", ".jpeg", ".gif",
+    ".webp", ".mp3", ".ogg", ".mp4", ".mkv", ".avi", ".mov", ".pdf", ".docx",
+    ".xlsx", ".pptx", ".odt", ".ods", ".odp"
+])
+
+def _deflate(path, level):
+    """
+    Reads and compresses a whole file. Returns its CRC, its size, and the raw
+    deflate stream. Run in the compression pool.
+
+    """
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+
+    return zlib.crc32(data) & 0xffffffff, len(data), compressed
+
+class ZipWriter(object):
+    def __init__(self, path, mode = "w", processes = 1, level = 6,
+            max_pooled_size = 8 * 1024 * 1024):
+        """
+        Opens the archive at path. mode is "w" to create a new archive or "a"
+        to add entries to an existing one.
+
+        If processes is more than 1 a pool of that many processes compresses
+        files of up to max_pooled_size bytes. level is the zlib compression
+        level used for files compressed in the pool (files compressed in this
+        process always use zlib's default).
+
+        """
+
+        self._zip = zipfile.ZipFile(
+            path, mode, zipfile.ZIP_DEFLATED, allowZip64 = True
+        )
+
+        self.level = level
+        self.max_pooled_size = max_pooled_size
+
+        self._pool = None
+        if processes > 1:
+            self._pool = multiprocessing.Pool(processes)
+
+        # Files being compressed in the pool, in the order they were added, as
+        # (ZipInfo, AsyncResult) tuples. At most _max_pending at once.
+        self._pending = collections.deque()
+        self._max_pending = processes * 4
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def names(self):
+        "Returns the names of the entries in the archive."
+
+        self._flush()
+
+        return self._zip.namelist()
+
+    def add_file(self, path, arcname):
+        "Adds the file at path to the archive as arcname."
+
+        if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+            self._zip.write(path, arcname, zipfile.ZIP_STORED)
+            return
+
+        if self._pool is None or \
+                os.path.getsize(path) > self.max_pooled_size:
+            self._zip.write(path, arcname, zipfile.ZIP_DEFLATED)
+            return
+
+        # Make the entry's metadata the same way ZipFile.write would, the rest
+        # is filled in when the pool is done with it.
+        st = os.stat(path)
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+
+        while len(self._pending) >= self._max_pending:
+            self._write_pending()
+
+        self._pending.append(
+            (zinfo, self._pool.apply_async(_deflate, (path, self.level)))
+        )
+
+    def add_directory(self, path, arcname):
+        """
+        Adds everything in the directory at path to the archive under arcname
+        (which may be empty to put it at the root of the archive). Symbolic
+        links are skipped, as they could point anywhere.
+
+        """
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            relative = os.path.relpath(dirpath, path)
+            prefix = arcname if relative == "." else \
+                os.path.join(arcname, relative)
+
+            for i in list(dirnames):
+                if os.path.islink(os.path.join(dirpath, i)):
+                    dirnames.remove(i)
+                    continue
+
+                self.add_empty_directory(os.path.join(prefix, i))
+
+            for i in filenames:
+                file_path = os.path.join(dirpath, i)
+                if not os.path.islink(file_path):
+                    self.add_file(file_path, os.path.join(prefix, i))
+
+    def add_empty_directory(self, arcname):
+        zinfo = zipfile.ZipInfo(
+            arcname.rstrip("/") + "/", time.localtime()[0:6]
+        )
+        zinfo.external_attr = (0o40755 << 16L) | 0x10
+        self._zip.writestr(zinfo, "")
+
+    def add_string(self, data, arcname):
+        "Adds an entry containing data to the archive."
+
+        zinfo = zipfile.ZipInfo(arcname, time.localtime()[0:6])
+        zinfo.external_attr = 0o600 << 16L
+        self._zip.writestr(zinfo, data)
+
+    def _write_pending(self):
+        "Waits for the oldest file in the pool and writes it out."
+
+        zinfo, result = self._pending.popleft()
+        zinfo.CRC, zinfo.file_size, compressed = result.get()
+        zinfo.compress_size = len(compressed)
+
+        # This is what ZipFile.write does once it has compressed a file, but
+        # as we know the CRC and sizes up front we can write the header first.
+        # Files this small never need ZIP64 extensions in their header.
+        archive = self._zip
+        archive._writecheck(zinfo)
+        archive._didModify = True
+
+        zinfo.header_offset = archive.fp.tell()
+        archive.fp.write(zinfo.FileHeader(False))
+        archive.fp.write(compressed)
+
+        archive.filelist.append(zinfo)
+        archive.NameToInfo[zinfo.filename] = zinfo
+
+    def _flush(self):
+        while self._pending:
+            self._write_pending()
+
+    def close(self):
+        "Finishes writing the archive."
+
+        try:
+            self._flush()
+            self._zip.close()
+        finally:
+            self._close_pool()
+
+    def abort(self):
+        "Stops writing the archive, leaving it incomplete."
+
+        self._pending.clear()
+        self._close_pool()
+        self._zip.fp.close()
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
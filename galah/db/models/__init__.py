@@ -25,3 +25,6 @@ from archives import Archive
 
 import csv
 from csv import CSV
+
+import tasks
+from tasks import SisyphusTask
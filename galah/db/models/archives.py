@@ -6,9 +6,14 @@ class Archive(Document):
     error_string = StringField()
     expires = DateTimeField()
     archive_type = StringField(choices = ["assignment_package", "single_submission"], required = True)
-    
 
     meta = {
-        "allow_inheritance": False
+        "allow_inheritance": False,
+        "indexes": [
+            {
+                "fields": ["expires"],
+                "types": False
+            }
+        ]
     }
 
@@ -7,5 +7,11 @@ class CSV(Document):
     expires = DateTimeField()
 
     meta = {
-        "allow_inheritance": False
+        "allow_inheritance": False,
+        "indexes": [
+            {
+                "fields": ["expires"],
+                "types": False
+            }
+        ]
     }
@@ -45,8 +45,41 @@ class TestResult(Document):
     # TestResult object.
     failed = BooleanField()
 
+    # The resources the test harness used as reported by the sheep: its
+    # wall_time and cpu_time in seconds and its peak resident set size
+    # (max_rss) in kilobytes.
+    resources = DictField()
+
+    # Set if the test harness was killed for running past its galah/timeout.
+    # The end of whatever output and log it gave before then are kept in
+    # partial_output and partial_log so it's clear how far it got.
+    timed_out = BooleanField()
+    partial_output = StringField()
+    partial_log = StringField()
+
+    # The id of the dispatch (the particular request sent to a sheep) that
+    # produced this result. Only one result is ever stored per dispatch.
+    dispatch_id = StringField()
+
+    # How long each phase of the test took in seconds, as reported by the
+    # sheep (prepare, wait, fetch, inject, connect, run, teardown, etc.) and
+    # the shepherd (queue_wait and service), along with when the request was
+    # dispatched_at and when this result was received_at.
+    timings = DictField()
+
+    # The host name of the sheep that ran the test.
+    sheep = StringField()
+
     meta = {
-        "allow_inheritance": False
+        "allow_inheritance": False,
+        "indexes": [
+            {
+                "fields": ["dispatch_id"],
+                "unique": True,
+                "sparse": True,
+                "types": False
+            }
+        ]
     }
 
     @staticmethod
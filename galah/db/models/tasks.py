@@ -0,0 +1,70 @@
+from mongoengine import *
+
+class SisyphusTask(Document):
+    name = StringField(required = True)
+    args = ListField()
+    kwargs = DictField()
+
+    # The ids of the Archive or CSV documents the task will create, so anyone
+    # waiting on one of them can check how it's going, along with the users
+    # that requested each of them. Requests for the same thing made while the
+    # task is queued or running are attached to it rather than creating a new
+    # task, which is why there can be more than one.
+    result_ids = ListField(ObjectIdField())
+    requesters = ListField(StringField())
+
+    # Identifies what the task does (its name and arguments, other than the
+    # id of the document it creates and who requested it), so that duplicate
+    # requests can be found.
+    dedup_key = StringField()
+
+    status = StringField(
+        choices = ["queued", "running", "done", "failed"], required = True
+    )
+
+    # The number of times the task has been started.
+    attempts = IntField(default = 0)
+
+    # Why the last attempt failed, if it did.
+    error_string = StringField()
+
+    enqueued_at = DateTimeField()
+
+    # A queued task won't be started before this time, which is how retries
+    # back off.
+    run_after = DateTimeField()
+
+    started_at = DateTimeField()
+    finished_at = DateTimeField()
+
+    # The sisyphus instance running the task and when its lease on the task
+    # runs out. Running instances keep renewing their leases, so a task whose
+    # lease has run out was being run by an instance that died.
+    owner = StringField()
+    lease_expires = DateTimeField()
+
+    meta = {
+        "allow_inheritance": False,
+        "indexes": [
+            {
+                "fields": ("status", "run_after"),
+                "types": False
+            },
+            {
+                "fields": ("status", "lease_expires"),
+                "types": False
+            },
+            {
+                "fields": ("dedup_key", "status"),
+                "types": False
+            },
+            {
+                "fields": ["result_ids"],
+                "types": False
+            },
+            {
+                "fields": ["finished_at"],
+                "types": False
+            }
+        ]
+    }
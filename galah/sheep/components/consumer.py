@@ -2,27 +2,104 @@ import zmq
 import galah.sheep.utility.universal as universal
 import galah.sheep.utility.exithelpers as exithelpers
 from galah.sheep.utility.suitehelpers import get_virtual_suite
+from galah.sheep.utility.background import Background
+from galah.sheep.utility.blobfetch import BlobFetcher, TransferError
 from galah.base.flockmail import FlockMessage
 import time
 import threading
 import logging
 import random
 import datetime
+import platform
 
 # Load Galah's configuration.
 from galah.base.config import load_config
 config = load_config("sheep")
 
+# Shared by all the consumers so a blob needed by several of them at once is
+# only fetched once.
+blob_fetcher = None
+_blob_fetcher_lock = threading.Lock()
+
+def get_blob_fetcher():
+    global blob_fetcher
+
+    with _blob_fetcher_lock:
+        if blob_fetcher is None:
+            blob_fetcher = BlobFetcher(
+                config["BLOB_DIRECTORY"],
+                config["CHUNK_SIZE"],
+                config["CHUNK_TIMEOUT"].seconds * 1000 +
+                    config["CHUNK_TIMEOUT"].microseconds / 1000,
+                config["CHUNK_RETRIES"],
+                config["BLOB_BUDGET"]
+            )
+
+        return blob_fetcher
+
 @universal.handleExiting
 def run():
-    try:
-        _run()
-    except universal.ShepherdLost as e:
-        if e.result:
-            universal.orphaned_results.put(e.result)
+    # Any result we fail to deliver is left in the outbox for the maintainer.
+    _run()
+
+def fetch_files(logger, shepherd, test_request):
+    """
+    Fetches the testables and test harness described in the test request from
+    the shepherd and records where they are in test_request["local"]. Returns
+    a dictionary describing the transfer. release_files() must be called once
+    the files aren't needed anymore.
 
+    """
+
+    fetcher = get_blob_fetcher()
+    transfer = test_request["transfer"]
+
+    start_time = time.time()
+    testables = fetcher.fetch(shepherd, transfer["testables"])
+    try:
+        harness = fetcher.fetch(shepherd, transfer["harness"])
+    except:
+        fetcher.remove(transfer["testables"])
         raise
 
+    test_request["local"] = {"testables": testables, "harness": harness}
+
+    stats = {
+        "size": transfer["testables"]["size"] + transfer["harness"]["size"],
+        "seconds": time.time() - start_time
+    }
+
+    logger.info(
+        "Fetched %d bytes of files for test in %.3fs.",
+        stats["size"], stats["seconds"]
+    )
+
+    return stats
+
+def release_files(test_request):
+    "Lets go of the files fetched by fetch_files(), if it succeeded."
+
+    if "local" not in test_request:
+        return
+
+    fetcher = get_blob_fetcher()
+    transfer = test_request["transfer"]
+
+    # The submission won't be tested again any time soon, unlike the harness.
+    fetcher.remove(transfer["testables"])
+    fetcher.release(transfer["harness"])
+
+def discard_machine(logger, consumer, machine_id):
+    "Gets rid of a machine that was prepared but never had a test run in it."
+
+    if not hasattr(consumer, "destroy_machine"):
+        return
+
+    try:
+        consumer.destroy_machine(machine_id)
+    except Exception:
+        logger.exception("Could not discard machine %s.", str(machine_id))
+
 def _run():
     logger = logging.getLogger("galah.sheep.%s" % threading.currentThread().name)
     logger.info("Consumer starting.")
@@ -36,118 +113,223 @@ def _run():
     shepherd.linger = 0
     shepherd.connect(config["shepherd/SHEEP_SOCKET"])
 
-    # Loop until the program is shutting down
-    while not universal.exiting:
-        # Prepare a VM and make sure we're completely prepared to handle a test
-        # request before asking the shepherd for one.
-        logger.info("Waiting for virtual machine to become available...")
+    # In pipelined mode, the machine for the next test request is prepared
+    # (in the background) while the current one is being tested.
+    next_machine = None
+
+    # The machine prepared for the next test request, until it's handed to
+    # the suite to run a test in.
+    machine_id = None
+
+    def stage_machine(hint):
+        start_time = time.time()
         machine_id = consumer.prepare_machine()
 
-        def bleet():
-            shepherd.send_json(FlockMessage("bleet", "").to_dict())
+        if hint and hasattr(consumer, "stage_machine"):
+            consumer.stage_machine(machine_id, hint)
 
-            # Figure out when we should send the next bleet
-            return (
-                datetime.datetime.now() + config["shepherd/BLEET_TIMEOUT"] / 2
-            )
+        return machine_id, time.time() - start_time
 
-        # Send the intitial bleet so that the shepherd knows we're available
-        logger.info("Ready for test request. Sending initial bleet.")
-        next_bleet_time = bleet()
+    try:
+        # Loop until the program is shutting down
+        while not universal.exiting:
+            # Prepare a VM and make sure we're completely prepared to handle a
+            # test request before asking the shepherd for one.
+            logger.info("Waiting for virtual machine to become available...")
+            if next_machine is not None:
+                machine_id, prepare_time = next_machine.result()
+                next_machine = None
+            else:
+                start_time = time.time()
+                machine_id = consumer.prepare_machine()
+                prepare_time = time.time() - start_time
 
-        # Set to True whenever the shepherd bloots. Set to False everytime we
-        # bleet. If this variable is still False by the time it's time to bleet
-        # again we know we've lost the shepherd.
-        shepherd_blooted = False
+            def bleet():
+                shepherd.send_json(FlockMessage("bleet", "").to_dict())
 
-        # Process traffic from shepherd.
-        while True:
-            try:
-                message = exithelpers.recv_json(
-                    shepherd,
-                    timeout = max(
-                        1, # 1 millisecond (0 would imply infinite timeout)
-                        (next_bleet_time - datetime.datetime.now()).seconds
-                            * 1000
-                    )
+                # Figure out when we should send the next bleet
+                return (
+                    datetime.datetime.now() + config["shepherd/BLEET_TIMEOUT"] / 2
                 )
 
-                message = FlockMessage(message["type"], message["body"])
-            except exithelpers.Timeout:
-                if not shepherd_blooted:
-                    raise universal.ShepherdLost()
+            # Send the intitial bleet so that the shepherd knows we're available
+            logger.info("Ready for test request. Sending initial bleet.")
+            next_bleet_time = bleet()
+            ready_at = time.time()
 
-                logger.debug("Sending bleet.")
-                next_bleet_time = bleet()
-                shepherd_blooted = False
+            # Set to True whenever the shepherd bloots. Set to False everytime we
+            # bleet. If this variable is still False by the time it's time to bleet
+            # again we know we've lost the shepherd.
+            shepherd_blooted = False
 
-                continue
+            # Process traffic from shepherd.
+            while True:
+                try:
+                    message = exithelpers.recv_json(
+                        shepherd,
+                        timeout = max(
+                            1, # 1 millisecond (0 would imply infinite timeout)
+                            (next_bleet_time - datetime.datetime.now()).seconds
+                                * 1000
+                        )
+                    )
 
-            if message.type == "bloot":
-                logger.debug("Got bloot.")
-                shepherd_blooted = True
+                    message = FlockMessage(message["type"], message["body"])
+                except exithelpers.Timeout:
+                    if not shepherd_blooted:
+                        raise universal.ShepherdLost()
 
-            elif message.type == "identify":
-                logger.info(
-                    "Received request to identify. Sending environment."
-                )
+                    logger.debug("Sending bleet.")
+                    next_bleet_time = bleet()
+                    shepherd_blooted = False
 
-                # identify is a valid response to a bleet.
-                shepherd_blooted = True
+                    continue
 
-                identification = FlockMessage(
-                    type = "environment",
-                    body = universal.environment
-                )
+                if message.type == "bloot":
+                    logger.debug("Got bloot.")
+                    shepherd_blooted = True
+
+                elif message.type == "identify":
+                    logger.info(
+                        "Received request to identify. Sending environment."
+                    )
+
+                    # identify is a valid response to a bleet.
+                    shepherd_blooted = True
 
-                shepherd.send_json(identification.to_dict())
+                    identification = FlockMessage(
+                        type = "environment",
+                        body = universal.environment
+                    )
+
+                    shepherd.send_json(identification.to_dict())
 
-            elif message.type == "request":
-                # Received test request from the shepherd
-                logger.info("Test request received, running tests.")
-                logger.debug("Test request: %s", str(message))
-                result = consumer.run_test(machine_id, message.body)
+                elif message.type == "request":
+                    # Received test request from the shepherd
+                    logger.info("Test request received, running tests.")
+                    logger.debug("Test request: %s", str(message))
 
-                # Check to see if the test harness crashed/somehow testing was
-                # unable to be done.
-                if result is None:
-                    result = {
-                        "failed": True
+                    # The number of seconds each phase of handling this request
+                    # took. The suite fills in the phases of the test itself.
+                    timings = {
+                        "prepare": prepare_time,
+                        "wait": time.time() - ready_at
                     }
 
-                # Add in the submission id to the result that we send back
-                result["id"] = str(message.body["submission"]["id"])
+                    if config["PIPELINE"]:
+                        next_machine = Background(
+                            stage_machine, message.body.get("hint")
+                        )
 
-                logger.info("Testing completed, sending results to shepherd.")
-                logger.debug("Raw test results: %s", str(result))
-                shepherd.send_json(FlockMessage("result", result).to_dict())
+                    # Don't report the last test's timings if this one never
+                    # starts.
+                    if hasattr(consumer, "timings"):
+                        consumer.timings = {}
 
-                # Wait for the shepherd to acknowledge the result. Ignore any
-                # messages that we get from the shepherd besides an acknowledge.
-                deadline = \
-                    datetime.datetime.now() + datetime.timedelta(seconds = 30)
-                while True:
-                    try:
-                        confirmation = exithelpers.recv_json(
-                            shepherd,
-                            timeout = max(
-                                1, # 1 millisecond (0 would imply infinite timeout)
-                                (deadline - datetime.datetime.now()).seconds
-                                    * 1000
+                    # Fetch the testables and test harness if the shepherd is
+                    # sending them to us rather than us reading them off of a
+                    # shared filesystem.
+                    transfer = message.body.get("transfer")
+                    transfer_stats = None
+
+                    # The suite is responsible for the machine once it's asked
+                    # to run a test in it.
+                    test_machine, machine_id = machine_id, None
+                    if transfer:
+                        try:
+                            transfer_stats = fetch_files(
+                                logger, shepherd, message.body
                             )
-                        )
+                        except TransferError:
+                            logger.exception("Could not fetch files for test.")
 
-                        confirmation = FlockMessage(
-                            confirmation["type"], confirmation["body"]
-                        )
-                    except exithelpers.Timeout:
-                        raise universal.ShepherdLost(result = result)
+                            discard_machine(logger, consumer, test_machine)
+                            result = None
+                        else:
+                            result = \
+                                consumer.run_test(test_machine, message.body)
+                        finally:
+                            release_files(message.body)
+                    else:
+                        result = consumer.run_test(test_machine, message.body)
 
-                    logger.debug("Received message: %s", str(confirmation))
+                    # Check to see if the test harness crashed/somehow testing was
+                    # unable to be done.
+                    if result is None:
+                        result = {
+                            "failed": True
+                        }
 
-                    if confirmation.type == "bloot" and \
-                            confirmation.body == result["id"]:
-                        shepherd_blooted = True
-                        break
+                    if transfer_stats is not None:
+                        result["transfer"] = transfer_stats
+                        timings["fetch"] = transfer_stats["seconds"]
 
-                break
+                    timings.update(getattr(consumer, "timings", {}))
+                    result["timings"] = timings
+                    result["sheep"] = platform.node()
+
+                    # Add in the submission id to the result that we send back
+                    result["id"] = str(message.body["submission"]["id"])
+
+                    # As well as the dispatch id so the shepherd can tell if it
+                    # gets this result more than once.
+                    if "dispatch_id" in message.body:
+                        result["dispatch_id"] = message.body["dispatch_id"]
+
+                    logger.info("Testing completed, sending results to shepherd.")
+                    logger.debug("Raw test results: %s", str(result))
+
+                    # Make sure the result survives us dying before the shepherd
+                    # gets it.
+                    outbox_key = universal.outbox.put(result)
+
+                    try:
+                        shepherd.send_json(FlockMessage("result", result).to_dict())
+
+                        # Wait for the shepherd to acknowledge the result. Ignore
+                        # any messages that we get from the shepherd besides an
+                        # acknowledge.
+                        deadline = datetime.datetime.now() + \
+                            datetime.timedelta(seconds = 30)
+                        while True:
+                            try:
+                                confirmation = exithelpers.recv_json(
+                                    shepherd,
+                                    timeout = max(
+                                        1, # 1 millisecond (0 would imply infinite timeout)
+                                        (deadline - datetime.datetime.now()).seconds
+                                            * 1000
+                                    )
+                                )
+
+                                confirmation = FlockMessage(
+                                    confirmation["type"], confirmation["body"]
+                                )
+                            except exithelpers.Timeout:
+                                raise universal.ShepherdLost(result = result)
+
+                            logger.debug("Received message: %s", str(confirmation))
+
+                            if confirmation.type == "bloot" and \
+                                    confirmation.body == result["id"]:
+                                shepherd_blooted = True
+                                break
+                    except:
+                        # Leave it to the maintainer to deliver.
+                        universal.outbox.release(outbox_key)
+                        raise
+
+                    universal.outbox.ack(outbox_key)
+
+                    break
+    finally:
+        # Both machines have already been taken from the pool, so nobody else
+        # will ever clean them up.
+        if machine_id is not None:
+            discard_machine(logger, consumer, machine_id)
+
+        if next_machine is not None:
+            try:
+                discard_machine(logger, consumer, next_machine.result()[0])
+            except (Exception, universal.Exiting):
+                logger.exception("Could not get the next machine to discard.")
@@ -38,6 +38,47 @@ def start_producer():
 
     return producer_thread
 
+def redeliver(shepherd):
+    """
+    Sends a batch of orphaned results to the shepherd all at once and then
+    waits for it to acknowledge them. Raises exithelpers.Timeout if the
+    shepherd doesn't acknowledge every one of them in time.
+
+    """
+
+    batch = universal.outbox.orphaned(limit = config["REDELIVERY_BATCH_SIZE"])
+
+    # The shepherd acknowledges results by their submission ids, maps those to
+    # the outbox keys of the results we're waiting on.
+    waiting = {}
+    for key, result in batch:
+        # Results the shepherd never acknowledges are eventually given up on.
+        if not universal.outbox.attempt(key):
+            continue
+
+        shepherd.send_json(FlockMessage("result", result).to_dict())
+
+        waiting.setdefault(result["id"], []).append(key)
+
+    logger.info(
+        "Redelivered %d orphaned results.",
+        sum(len(i) for i in waiting.values())
+    )
+
+    deadline = time.time() + 5 + len(batch)
+    while waiting:
+        confirmation = exithelpers.recv_json(
+            shepherd, timeout = max(1, int((deadline - time.time()) * 1000))
+        )
+        confirmation = FlockMessage.from_dict(confirmation)
+
+        if confirmation.type == "bloot" and confirmation.body in waiting:
+            keys = waiting[confirmation.body]
+            universal.outbox.ack(keys.pop(0))
+
+            if not keys:
+                del waiting[confirmation.body]
+
 @universal.handleExiting
 def run(znconsumers):
     log = logging.getLogger("galah.sheep.maintainer")
@@ -50,21 +91,21 @@ def run(znconsumers):
     # Continually make sure that all of the threads are up until it's time to
     # exit
     while not universal.exiting:
-        if not universal.orphaned_results.empty():
+        if universal.outbox.has_orphans():
             logger.warning(
                 "Orphaned results detected, going into distress mode."
             )
 
-        while not universal.orphaned_results.empty():
-            try:
-                # We want to create a whole new socket everytime so we don't
-                # stack messages up in the queue. We also don't want to just
-                # send it once and let ZMQ take care of it because it might
-                # be eaten by a defunct shepherd and then we'd be stuck forever.
-                shepherd = universal.context.socket(zmq.DEALER)
-                shepherd.linger = 0
-                shepherd.connect(config["shepherd/SHEEP_SOCKET"])
+        while universal.outbox.has_orphans():
+            # We want to create a whole new socket everytime so we don't
+            # stack messages up in the queue. We also don't want to just
+            # send it once and let ZMQ take care of it because it might
+            # be eaten by a defunct shepherd and then we'd be stuck forever.
+            shepherd = universal.context.socket(zmq.DEALER)
+            shepherd.linger = 0
+            shepherd.connect(config["shepherd/SHEEP_SOCKET"])
 
+            try:
                 shepherd.send_json(FlockMessage("distress", "").to_dict())
 
                 logger.info(
@@ -75,25 +116,8 @@ def run(znconsumers):
                 message = FlockMessage.from_dict(message)
 
                 if message.type == "bloot" and message.body == "":
-                    while not universal.orphaned_results.empty():
-                        result = universal.orphaned_results.get()
-
-                        try:
-                            shepherd.send_json(
-                                FlockMessage("result", result).to_dict()
-                            )
-
-                            confirmation = exithelpers.recv_json(
-                                shepherd, timeout = 1000 * 5
-                            )
-                            confirmation = FlockMessage.from_dict(confirmation)
-
-                            if confirmation.type == "bloot" and \
-                                    confirmation.body == "":
-                                continue
-                        except:
-                            universal.orphaned_results.put(result)
-                            raise
+                    while universal.outbox.has_orphans():
+                        redeliver(shepherd)
             except universal.Exiting:
                 logger.warning(
                     "Orphaned results have not been sent back to the "
@@ -107,6 +131,8 @@ def run(znconsumers):
                 continue
             except exithelpers.Timeout:
                 continue
+            finally:
+                shepherd.close()
 
         # Remove any dead consumers from the list
         dead_consumers = 0
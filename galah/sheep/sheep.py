@@ -16,8 +16,12 @@ import zmq
 import galah.sheep.utility.universal as universal
 universal.context = zmq.Context()
 
-import Queue
-universal.orphaned_results = Queue.Queue()
+# Any results left over from a previous run are picked up here and redelivered
+# by the maintainer.
+from galah.sheep.utility.outbox import Outbox
+universal.outbox = Outbox(
+    config["OUTBOX_DIRECTORY"], config["MAX_REDELIVERIES"]
+)
 
 # Initialize the correct consumer based on the selected virtual suite.
 from galah.sheep.utility.suitehelpers import get_virtual_suite
@@ -0,0 +1,51 @@
+import threading
+import sys
+
+class Background:
+    """
+    Runs a function in its own thread so that other work can be done while it
+    runs. The function's return value (or the exception it raised) is
+    collected with result().
+
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        self._value = None
+        self._exc_info = None
+
+        def run():
+            try:
+                self._value = function(*args, **kwargs)
+            except:
+                self._exc_info = sys.exc_info()
+
+        self._thread = threading.Thread(
+            target = run,
+            name = "%s-%s" % (threading.currentThread().name, function.__name__)
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def wait(self):
+        "Blocks until the function returns, ignoring how it went."
+
+        # Joining with a timeout keeps us responsive to signals.
+        while self._thread.is_alive():
+            self._thread.join(1)
+
+    def result(self):
+        """
+        Blocks until the function returns and gives back its return value. If
+        the function raised an exception it is reraised here instead.
+
+        """
+
+        self.wait()
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._value
@@ -0,0 +1,365 @@
+"""
+Fetches submissions and test harnesses from the shepherd so that sheep do not
+need to share a filesystem with the web server. See galah.shepherd.blobstore
+for the other side of this.
+
+Blobs are downloaded in chunks, each of which is checked against the hash the
+shepherd sent along with it, and the whole blob is checked against its digest
+before it is used. Partially downloaded blobs are kept on disk so a download
+that is interrupted (even by the sheep dying) resumes where it left off.
+
+Extracted blobs are kept around for as long as they fit in the fetcher's disk
+budget, evicting the least recently used ones first. A blob is never evicted
+while a consumer is using it, every fetch() must be matched by a release() or
+remove() once the consumer is done with it.
+
+"""
+
+import galah.sheep.utility.exithelpers as exithelpers
+from galah.base.flockmail import FlockMessage
+import os
+import os.path
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import base64
+import time
+import threading
+import logging
+
+logger = logging.getLogger("galah.sheep.blobfetch")
+
+class TransferError(Exception):
+    pass
+
+class BlobFetcher:
+    def __init__(self, directory, chunk_size, chunk_timeout, retries,
+            budget = None):
+        """
+        directory is where blobs will be downloaded and extracted to.
+        chunk_timeout is the number of milliseconds to wait for a chunk before
+        asking for it again, which will be done at most retries times in a
+        row. budget is the maximum number of bytes the extracted blobs may use
+        in total, if None they are never evicted.
+
+        """
+
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.chunk_timeout = chunk_timeout
+        self.retries = retries
+        self.budget = budget
+
+        # The number of bytes downloaded and the number of seconds spent
+        # downloading by this fetcher.
+        self.bytes_fetched = 0
+        self.time_spent = 0.0
+
+        # Maps blob ids to locks held while the blob is being fetched, so
+        # consumers needing the same blob don't download it twice.
+        self._locks = {}
+        self._lock = threading.Lock()
+
+        # Maps the ids of extracted blobs to their size in bytes and the last
+        # time (seconds since the epoch) they were used.
+        self._entries = {}
+
+        # Maps the ids of blobs consumers are using to how many are using them.
+        self._users = {}
+
+        self.evictions = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Pick up any blobs left over from a previous run, using the
+        # modification time (which we bump on every use) as the last use time.
+        for i in os.listdir(self.directory):
+            path = os.path.join(self.directory, i)
+            if i.endswith(".partial") or not os.path.isdir(path):
+                continue
+
+            self._entries[i] = [BlobFetcher._size(path), os.stat(path).st_mtime]
+
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def _size(directory):
+        "Returns the number of bytes used by the files in a directory."
+
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for i in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, i)).st_size
+                except OSError:
+                    pass
+
+        return total
+
+    def _path(self, descriptor):
+        blob_id = descriptor["id"]
+        if not blob_id or os.path.basename(blob_id) != blob_id or \
+                blob_id.startswith("."):
+            raise TransferError("Invalid blob id %s." % repr(blob_id))
+
+        return os.path.join(self.directory, blob_id)
+
+    @staticmethod
+    def _digest(path):
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), ""):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def _download(self, shepherd, descriptor, destination):
+        """
+        Downloads the blob into destination, resuming from whatever was
+        already downloaded.
+
+        """
+
+        partial = destination + ".partial"
+        size = descriptor["size"]
+
+        with open(partial, "ab") as f:
+            offset = f.tell()
+            if offset > size:
+                f.truncate(0)
+                offset = 0
+
+            if offset:
+                logger.debug(
+                    "Resuming download of %s at byte %d.",
+                    descriptor["id"], offset
+                )
+
+            failures = 0
+            while offset < size:
+                shepherd.send_json(FlockMessage("fetch", {
+                    "blob": descriptor["id"],
+                    "offset": offset,
+                    "length": self.chunk_size
+                }).to_dict())
+
+                chunk = self._receive_chunk(shepherd, descriptor["id"], offset)
+
+                if chunk is None:
+                    failures += 1
+                    if failures > self.retries:
+                        raise TransferError(
+                            "Could not get chunk of %s at byte %d." %
+                                (descriptor["id"], offset)
+                        )
+
+                    continue
+
+                failures = 0
+
+                f.write(chunk)
+                offset += len(chunk)
+                self.bytes_fetched += len(chunk)
+
+        if BlobFetcher._digest(partial) != descriptor["digest"]:
+            os.remove(partial)
+
+            raise TransferError(
+                "Downloaded blob %s does not match its digest." %
+                    descriptor["id"]
+            )
+
+        os.rename(partial, destination)
+
+    def _receive_chunk(self, shepherd, blob_id, offset):
+        """
+        Waits for the chunk of the given blob starting at offset. Returns its
+        data or None if it didn't arrive intact in time.
+
+        """
+
+        deadline = time.time() + self.chunk_timeout / 1000.0
+        while True:
+            try:
+                message = exithelpers.recv_json(
+                    shepherd,
+                    timeout = max(1, int((deadline - time.time()) * 1000))
+                )
+                message = FlockMessage.from_dict(message)
+            except exithelpers.Timeout:
+                return None
+
+            # Anything else (including chunks we asked for earlier and gave up
+            # on) is not for us, the shepherd knows we are busy.
+            if message.type != "chunk" or \
+                    message.body.get("blob") != blob_id or \
+                    message.body.get("offset") != offset:
+                logger.debug("Ignoring message %s.", str(message))
+                continue
+
+            if "error" in message.body:
+                raise TransferError(
+                    "Shepherd could not send %s: %s" %
+                        (blob_id, message.body["error"])
+                )
+
+            data = base64.b64decode(message.body["data"])
+            if hashlib.sha1(data).hexdigest() != message.body["sha1"] or \
+                    not data:
+                logger.warning(
+                    "Chunk of %s at byte %d was corrupt.", blob_id, offset
+                )
+
+                return None
+
+            return data
+
+    def fetch(self, shepherd, descriptor):
+        """
+        Makes sure the blob described by descriptor is downloaded and extracted
+        and returns the directory it was extracted to. shepherd is the socket
+        to request chunks over. Raises TransferError if the blob cannot be
+        retrieved.
+
+        The blob won't be evicted until release() or remove() is called for
+        it.
+
+        """
+
+        blob_id = descriptor["id"]
+        directory = self._path(descriptor)
+
+        with self._lock:
+            blob_lock = self._locks.setdefault(blob_id, threading.Lock())
+
+            # Claim the blob before we look for it so it can't be evicted out
+            # from under us.
+            self._users[blob_id] = self._users.get(blob_id, 0) + 1
+
+        try:
+            with blob_lock:
+                self._fetch(shepherd, descriptor, directory)
+        except:
+            self.release(descriptor)
+            raise
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(blob_id)
+            if entry is None:
+                self._entries[blob_id] = [descriptor["size"], now]
+                self._evict(keep = blob_id)
+            else:
+                entry[1] = now
+
+        # Keep the last use time across restarts.
+        try:
+            os.utime(directory, (now, now))
+        except OSError:
+            pass
+
+        return directory
+
+    def _fetch(self, shepherd, descriptor, directory):
+        archive = directory + ".tar"
+
+        if os.path.isdir(directory):
+            return
+
+        start_time = time.time()
+        try:
+            if not os.path.isfile(archive):
+                self._download(shepherd, descriptor, archive)
+
+            # Extract next to the final location so a half extracted blob is
+            # never used.
+            temp_directory = tempfile.mkdtemp(
+                suffix = ".partial", dir = self.directory
+            )
+            try:
+                with tarfile.open(archive, "r") as f:
+                    f.extractall(temp_directory)
+
+                os.rename(temp_directory, directory)
+            except:
+                shutil.rmtree(temp_directory, ignore_errors = True)
+                raise
+        except (IOError, OSError, tarfile.TarError) as e:
+            raise TransferError("Could not fetch %s: %s" % (descriptor["id"], e))
+        finally:
+            self.time_spent += time.time() - start_time
+
+        os.remove(archive)
+
+    def release(self, descriptor):
+        """
+        Lets the fetcher know a consumer is done with a fetched blob, so it
+        may be evicted.
+
+        """
+
+        with self._lock:
+            self._release(descriptor["id"])
+
+    def _release(self, blob_id):
+        "Must hold the lock. Returns True if nobody is using the blob now."
+
+        users = self._users.get(blob_id, 0) - 1
+        if users > 0:
+            self._users[blob_id] = users
+            return False
+
+        self._users.pop(blob_id, None)
+        return True
+
+    def remove(self, descriptor):
+        """
+        Like release() but deletes the blob right away if no other consumer is
+        using it, for blobs that are unlikely to be needed again.
+
+        """
+
+        path = self._path(descriptor)
+
+        with self._lock:
+            if not self._release(descriptor["id"]):
+                return
+
+            self._locks.pop(descriptor["id"], None)
+            self._entries.pop(descriptor["id"], None)
+
+            shutil.rmtree(path, ignore_errors = True)
+
+    def _evict(self, keep = None):
+        """
+        Evicts extracted blobs nobody is using, least recently used first,
+        until we are within budget. The blob with the id keep is never
+        evicted. Must hold the lock.
+
+        """
+
+        if self.budget is None:
+            return
+
+        total = sum(size for size, last_used in self._entries.values())
+        by_age = sorted(
+            (i for i in self._entries.items()
+                if i[0] != keep and i[0] not in self._users),
+            key = lambda i: i[1][1]
+        )
+        while total > self.budget and by_age:
+            blob_id, (size, last_used) = by_age.pop(0)
+
+            shutil.rmtree(
+                os.path.join(self.directory, blob_id), ignore_errors = True
+            )
+
+            del self._entries[blob_id]
+            self._locks.pop(blob_id, None)
+            total -= size
+            self.evictions += 1
+
+            logger.debug("Evicted blob %s (%d bytes).", blob_id, size)
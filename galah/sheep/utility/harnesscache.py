@@ -0,0 +1,266 @@
+"""
+A sheep-local cache of prepared test harness archives.
+
+Every test needs a copy of its assignment's test harness inside of the virtual
+machine. Rather than copying the harness directory file by file (and then
+fixing up ownership and permissions) for every single test, the harness is
+packed once into a tarball whose entries already carry the correct owner and
+mode. Injecting the harness then only requires a single extraction.
+
+Entries are keyed by the harness's id and a hash of its contents, so a harness
+that is modified in place is never served stale. Least recently used entries
+are evicted whenever the cache grows beyond its disk budget.
+
+"""
+
+import os
+import os.path
+import hashlib
+import tarfile
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger("galah.sheep.harnesscache")
+
+class HarnessCache:
+    def __init__(self, directory, budget, uid = 0, gid = 0, mode = 0777):
+        """
+        directory is where the prepared archives will be stored, it will be
+        created if it does not exist. budget is the maximum number of bytes the
+        archives may use in total, if None the cache will never evict.
+
+        uid, gid, and mode are applied to every entry in the prepared archives.
+
+        """
+
+        self.directory = directory
+        self.budget = budget
+        self.uid = uid
+        self.gid = gid
+        self.mode = mode
+
+        # Maps file names of archives in the cache directory to the size in
+        # bytes and last time (seconds since the epoch) they were used.
+        self._entries = {}
+
+        # Maps (harness id, stat fingerprint) pairs to content hashes so we
+        # only need to read every file in a harness once per sheep run.
+        self._digests = {}
+
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Pick up any archives left over from a previous run, using the
+        # modification time (which we bump on every hit) as the last use time.
+        # Nobody else uses the cache, so any partially written archives were
+        # left by a run that died and can be thrown away.
+        for i in os.listdir(self.directory):
+            if i.endswith(".partial"):
+                logger.info("Removing partially written archive %s.", i)
+                os.remove(os.path.join(self.directory, i))
+                continue
+
+            if not i.endswith(".tar"):
+                continue
+
+            stat = os.stat(os.path.join(self.directory, i))
+            self._entries[i] = [stat.st_size, stat.st_mtime]
+
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def _walk(source):
+        "Yields (relative path, absolute path) pairs in a stable order."
+
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+
+            for i in sorted(dirnames + filenames):
+                path = os.path.join(dirpath, i)
+
+                yield os.path.relpath(path, source), path
+
+    def _digest(self, harness_id, source):
+        """
+        Returns a hash of the contents of the harness at source. The file
+        contents are only read if the files' sizes or modification times
+        changed since we last hashed the harness.
+
+        """
+
+        fingerprint = hashlib.sha1()
+        for relpath, path in HarnessCache._walk(source):
+            stat = os.lstat(path)
+            fingerprint.update(
+                "%s\0%d\0%d\0%f\0" %
+                    (relpath, stat.st_mode, stat.st_size, stat.st_mtime)
+            )
+
+        key = (harness_id, fingerprint.hexdigest())
+
+        with self._lock:
+            if key in self._digests:
+                return self._digests[key]
+
+        digest = hashlib.sha1()
+        for relpath, path in HarnessCache._walk(source):
+            digest.update(relpath + "\0")
+
+            if os.path.islink(path):
+                digest.update("l" + os.readlink(path))
+            elif os.path.isfile(path):
+                digest.update("f")
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(64 * 1024), ""):
+                        digest.update(chunk)
+            else:
+                digest.update("d")
+
+        with self._lock:
+            self._digests[key] = digest.hexdigest()
+
+        return digest.hexdigest()
+
+    def _prepare(self, source, dest):
+        "Packs the harness at source into a tarball at dest."
+
+        def fix_ownership(tarinfo):
+            tarinfo.uid = self.uid
+            tarinfo.gid = self.gid
+            tarinfo.uname = tarinfo.gname = ""
+
+            if not tarinfo.issym():
+                tarinfo.mode = self.mode
+
+            return tarinfo
+
+        # Build the archive next to its final location and then move it into
+        # place so other threads never see a partially written archive.
+        fd, temp_path = tempfile.mkstemp(
+            suffix = ".partial", dir = self.directory
+        )
+        os.close(fd)
+
+        try:
+            archive = tarfile.open(temp_path, "w")
+            try:
+                # The root entry makes extraction fix up the target directory
+                # itself as well.
+                archive.add(
+                    source, arcname = ".", recursive = False,
+                    filter = fix_ownership
+                )
+
+                for relpath, path in HarnessCache._walk(source):
+                    archive.add(
+                        path, arcname = relpath, recursive = False,
+                        filter = fix_ownership
+                    )
+            finally:
+                archive.close()
+
+            os.rename(temp_path, dest)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def _evict(self, keep = None):
+        """
+        Evicts entries until we are within budget. The entry named keep is
+        never evicted, even if it alone is over budget. Must hold the lock.
+
+        """
+
+        if self.budget is None:
+            return
+
+        total = sum(size for size, last_used in self._entries.values())
+        by_age = sorted(
+            (i for i in self._entries.items() if i[0] != keep),
+            key = lambda i: i[1][1]
+        )
+        while total > self.budget and by_age:
+            name, (size, last_used) = by_age.pop(0)
+
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError as e:
+                logger.warning("Could not evict %s: %s.", name, str(e))
+
+            del self._entries[name]
+            total -= size
+            self.evictions += 1
+
+    def key(self, harness_id, source):
+        """
+        Returns a string identifying the current contents of the harness at
+        source. It changes whenever the harness does.
+
+        """
+
+        return "%s-%s" % (harness_id, self._digest(harness_id, source))
+
+    def open(self, harness_id, source):
+        """
+        Returns an open file object for a prepared archive of the harness at
+        source, building the archive first if it is not in the cache.
+
+        The file is opened before this function returns, so it remains
+        readable even if another thread evicts it while it is in use.
+
+        """
+
+        name = self.key(harness_id, source) + ".tar"
+        path = os.path.join(self.directory, name)
+
+        with self._lock:
+            hit = name in self._entries
+            if hit:
+                self.hits += 1
+                self._entries[name][1] = time.time()
+
+                archive = open(path, "rb")
+
+        if hit:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+
+            return archive
+
+        self._prepare(source, path)
+
+        with self._lock:
+            self.misses += 1
+            self._entries[name] = [os.path.getsize(path), time.time()]
+
+            archive = open(path, "rb")
+
+            self._evict(keep = name)
+
+        return archive
+
+    def stats(self):
+        "Returns a dictionary of metrics describing the cache's performance."
+
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": sum(size for size, _ in self._entries.values())
+            }
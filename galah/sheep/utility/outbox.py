@@ -0,0 +1,215 @@
+"""
+A durable outbox for test results.
+
+Results are written to an append-only journal on disk before they are sent to
+the shepherd and are only forgotten once the shepherd acknowledges them, so a
+result survives the sheep being killed while the shepherd is unreachable. The
+journal is replayed whenever the outbox is opened.
+
+Every result in the outbox is either owned by the consumer that is sending it,
+or orphaned, meaning it needs to be redelivered (by the maintainer). Results
+replayed from the journal always start out orphaned. A result that still
+hasn't been acknowledged after being redelivered too many times is dropped,
+so one the shepherd will never accept can't hold up the sheep forever.
+
+"""
+
+import os
+import os.path
+import json
+import uuid
+import threading
+import logging
+
+logger = logging.getLogger("galah.sheep.outbox")
+
+class Outbox:
+    def __init__(self, directory, max_attempts = None,
+            compact_threshold = 1024 * 1024, compact_floor = 64 * 1024):
+        """
+        directory is where the journal is kept, it will be created if it does
+        not exist. Results are dropped once they have been redelivered
+        max_attempts times, if None they are never dropped.
+
+        The journal is rewritten to contain only undelivered results whenever
+        it grows past compact_threshold bytes, or past compact_floor bytes
+        when there's nothing left to deliver (which makes the rewrite cheap).
+
+        """
+
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.compact_threshold = compact_threshold
+        self.compact_floor = compact_floor
+        self.path = os.path.join(directory, "outbox.journal")
+
+        # Maps keys to the results waiting to be delivered.
+        self._pending = {}
+
+        # Maps keys to the number of times their results were redelivered.
+        self._attempts = {}
+
+        # The keys of the pending results that no consumer is delivering.
+        self._orphaned = set()
+
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._replay()
+        self._compact()
+
+        self._journal = open(self.path, "ab")
+
+        if self._pending:
+            logger.warning(
+                "Found %d undelivered results in %s.",
+                len(self._pending), self.path
+            )
+
+    def _replay(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Only the last entry can be damaged, by us dying partway
+                    # through writing it, and it was never sent in that case.
+                    logger.warning("Ignoring damaged entry in outbox journal.")
+                    continue
+
+                if entry["op"] == "put":
+                    self._pending[entry["key"]] = entry["result"]
+                    self._attempts[entry["key"]] = entry.get("attempts", 0)
+                    self._orphaned.add(entry["key"])
+                elif entry["op"] == "attempt":
+                    if entry["key"] in self._attempts:
+                        self._attempts[entry["key"]] += 1
+                elif entry["op"] == "ack":
+                    self._forget(entry["key"])
+
+    def _compact(self):
+        "Rewrites the journal so it contains only pending results."
+
+        temp_path = self.path + ".compacting"
+        with open(temp_path, "wb") as f:
+            for key, result in self._pending.items():
+                f.write(json.dumps({
+                    "op": "put",
+                    "key": key,
+                    "result": result,
+                    "attempts": self._attempts.get(key, 0)
+                }) + "\n")
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temp_path, self.path)
+
+    def _append(self, entry, sync):
+        "Writes an entry to the journal. Must hold the lock."
+
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
+        if sync:
+            os.fsync(self._journal.fileno())
+
+        size = self._journal.tell()
+        if size > self.compact_threshold or \
+                (not self._pending and size > self.compact_floor):
+            self._journal.close()
+            self._compact()
+            self._journal = open(self.path, "ab")
+
+    def _forget(self, key):
+        self._pending.pop(key, None)
+        self._attempts.pop(key, None)
+        self._orphaned.discard(key)
+
+    def put(self, result):
+        """
+        Durably stores a result that the calling consumer is about to deliver
+        and returns the key to acknowledge or release it with.
+
+        """
+
+        key = uuid.uuid4().hex
+
+        with self._lock:
+            self._pending[key] = result
+            self._attempts[key] = 0
+            self._append({"op": "put", "key": key, "result": result}, True)
+
+        return key
+
+    def ack(self, key):
+        "Forgets about a result the shepherd has acknowledged."
+
+        with self._lock:
+            if key not in self._pending:
+                return
+
+            self._forget(key)
+
+            # Losing an acknowledgement only causes a duplicate delivery, which
+            # the shepherd ignores, so there's no need to wait for the disk.
+            self._append({"op": "ack", "key": key}, False)
+
+    def attempt(self, key):
+        """
+        Records that an orphaned result is about to be redelivered. Returns
+        False, and drops the result, if it has already been redelivered
+        max_attempts times.
+
+        """
+
+        with self._lock:
+            if key not in self._pending:
+                return False
+
+            if self.max_attempts is not None and \
+                    self._attempts[key] >= self.max_attempts:
+                logger.error(
+                    "Dropping result after %d redeliveries: %s",
+                    self._attempts[key], str(self._pending[key])
+                )
+
+                self._forget(key)
+                self._append({"op": "ack", "key": key}, True)
+
+                return False
+
+            self._attempts[key] += 1
+
+            # Losing this only gives the result an extra attempt.
+            self._append({"op": "attempt", "key": key}, False)
+
+            return True
+
+    def release(self, key):
+        "Marks a result whose delivery failed as needing redelivery."
+
+        with self._lock:
+            if key in self._pending:
+                self._orphaned.add(key)
+
+    def orphaned(self, limit = None):
+        "Returns a list of up to limit (key, result) pairs needing redelivery."
+
+        with self._lock:
+            keys = sorted(self._orphaned)[:limit]
+
+            return [(i, self._pending[i]) for i in keys]
+
+    def has_orphans(self):
+        with self._lock:
+            return bool(self._orphaned)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
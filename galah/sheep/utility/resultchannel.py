@@ -0,0 +1,186 @@
+"""
+The receiving end of the protocol the bootstrapper uses to send a test
+harness's output back to the sheep.
+
+Every frame is a single line containing a JSON object with a "type" and some
+"data". The frame types are...
+
+    * "stdout": A chunk of the harness's standard output (its result).
+    * "stderr": A chunk of the harness's standard error (its log).
+    * "truncated": The sender dropped output. The data is an object with the
+      "stream" that was truncated and the number of "bytes" dropped.
+    * "exit": The harness exited. The data is an object with the harness's
+      "returncode", whether it was killed because it "timed_out", and the
+      "resources" it used: its "wall_time" and "cpu_time" in seconds and its
+      peak resident set size ("max_rss") in kilobytes.
+
+Frames are parsed as they arrive and neither stream is ever held in memory
+beyond its configured cap, so a harness that prints without end cannot exhaust
+the sheep's memory.
+
+"""
+
+import os
+import os.path
+import json
+
+class ProtocolError(Exception):
+    pass
+
+class ResultChannel:
+    def __init__(self, max_result_size, max_log_size, max_frame_size = 65536,
+            spill_path = None, max_spill_size = None):
+        """
+        max_result_size and max_log_size are the number of bytes of the
+        harness's standard output and standard error respectively that will be
+        kept.
+
+        If spill_path is given, the entire log (up to max_spill_size bytes) is
+        written to a file at that path if it is larger than max_log_size.
+
+        The sender should keep its frames well below max_frame_size bytes.
+
+        """
+
+        self.max_result_size = max_result_size
+        self.max_log_size = max_log_size
+        self.max_frame_size = max_frame_size
+        self.spill_path = spill_path
+        self.max_spill_size = max_spill_size
+
+        self._result = []
+        self._log = []
+
+        # The number of bytes of each stream received, whether they were kept
+        # or not.
+        self.result_size = 0
+        self.log_size = 0
+
+        # Set if either stream was truncated, by us or the sender.
+        self.result_truncated = False
+        self.log_truncated = False
+
+        # The path to the file the log was spilled to, if any.
+        self.spilled_to = None
+        self._spill_file = None
+        self._spill_size = 0
+
+        self.returncode = None
+        self.timed_out = False
+        self.resources = None
+
+        # Holds any partial frame we have received.
+        self._buffer = ""
+
+    def feed(self, data):
+        "Parses any complete frames in data. Raises ProtocolError on bad frames."
+
+        self._buffer += data
+
+        while True:
+            end = self._buffer.find("\n")
+            if end == -1:
+                break
+
+            frame, self._buffer = self._buffer[:end], self._buffer[end + 1:]
+
+            if frame.strip():
+                self._handle_frame(frame)
+
+        if len(self._buffer) > self.max_frame_size:
+            raise ProtocolError(
+                "Frame larger than %d bytes received." % self.max_frame_size
+            )
+
+    def close(self):
+        "Should be called once the sender has closed the connection."
+
+        if self._buffer.strip():
+            self._handle_frame(self._buffer)
+            self._buffer = ""
+
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def _handle_frame(self, frame):
+        try:
+            frame = json.loads(frame)
+            frame_type, frame_data = frame["type"], frame["data"]
+        except (ValueError, TypeError, KeyError):
+            raise ProtocolError("Malformed frame received.")
+
+        if frame_type == "stdout":
+            self._add_result(frame_data.encode("utf-8"))
+        elif frame_type == "stderr":
+            self._add_log(frame_data.encode("utf-8"))
+        elif frame_type == "truncated":
+            if frame_data["stream"] == "stdout":
+                self.result_truncated = True
+                self.result_size += frame_data["bytes"]
+            else:
+                self.log_truncated = True
+                self.log_size += frame_data["bytes"]
+        elif frame_type == "exit":
+            self.returncode = frame_data["returncode"]
+            self.timed_out = frame_data.get("timed_out", False)
+            self.resources = frame_data.get("resources")
+        else:
+            raise ProtocolError("Unknown frame type %s." % frame_type)
+
+    def _add_result(self, data):
+        kept = max(0, min(len(data), self.max_result_size - self.result_size))
+        if kept < len(data):
+            self.result_truncated = True
+
+        if kept:
+            self._result.append(data[:kept])
+
+        self.result_size += len(data)
+
+    def _add_log(self, data):
+        kept = max(0, min(len(data), self.max_log_size - self.log_size))
+        if kept < len(data):
+            self.log_truncated = True
+
+            if self.spill_path and self._spill_file is None and \
+                    self.spilled_to is None:
+                self._start_spill()
+
+        if kept:
+            self._log.append(data[:kept])
+
+        if self._spill_file is not None:
+            self._spill(data)
+
+        self.log_size += len(data)
+
+    def _start_spill(self):
+        directory = os.path.dirname(self.spill_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._spill_file = open(self.spill_path, "wb")
+        self.spilled_to = self.spill_path
+
+        for i in self._log:
+            self._spill(i)
+
+    def _spill(self, data):
+        if self.max_spill_size is not None:
+            data = data[:max(0, self.max_spill_size - self._spill_size)]
+
+        self._spill_file.write(data)
+        self._spill_size += len(data)
+
+    @property
+    def result(self):
+        "The harness's standard output, as much of it as was kept."
+
+        return "".join(self._result)
+
+    @property
+    def log(self):
+        "The harness's standard error, as much of it as was kept."
+
+        return "".join(self._log)
@@ -1,6 +1,11 @@
-from galah.base.magic import memoize
+from galah.base.cache import cached
+import os.path
 
-@memoize
+# Load Galah's configuration.
+from galah.base.config import load_config
+config = load_config("sheep")
+
+@cached()
 def get_virtual_suite(suite_name):
     suite_name = suite_name.lower()
 
@@ -10,5 +15,55 @@ def get_virtual_suite(suite_name):
     elif suite_name == "dummy":
         import galah.sheep.virtualsuites.dummy as dummy
         return dummy
+    elif suite_name == "sandbox":
+        import galah.sheep.virtualsuites.sandbox as sandbox
+        return sandbox
     else:
         raise ValueError("Suite name %s not recognized." % suite_name)
+
+def timed_out_result(output, log, resources, max_size):
+    """
+    Returns the result for a test whose harness timed out, with the last
+    max_size bytes of the harness's output and log.
+
+    """
+
+    def tail(data):
+        # Cutting the data may split a character in two.
+        return data[-max_size:].decode("utf-8", "replace") if max_size else u""
+
+    return {
+        "failed": True,
+        "timed_out": True,
+        "partial_output": tail(output),
+        "partial_log": tail(log),
+        "resources": resources
+    }
+
+def get_testables_directory(test_request):
+    """
+    Returns the directory on this host containing the testables for the given
+    test request. This is in the submission directory unless the testables
+    were fetched from the shepherd.
+
+    """
+
+    if "local" in test_request:
+        return test_request["local"]["testables"]
+
+    return os.path.join(
+        config["SUBMISSION_DIRECTORY"],
+        test_request["submission"]["assignment"],
+        test_request["submission"]["user"],
+        test_request["submission"]["id"]
+    )
+
+def get_harness_directory(test_request):
+    "Like get_testables_directory() but for the test harness."
+
+    if "local" in test_request:
+        return test_request["local"]["harness"]
+
+    return os.path.join(
+        config["HARNESS_DIRECTORY"], test_request["test_harness"]["id"]
+    )
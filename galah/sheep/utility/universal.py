@@ -11,9 +11,11 @@ class Exiting:
 # pull from.
 containers = None
 
-# When a consumer loses its shepherd after it has processed a test request, it
-# will kill itself and put the results into this queue.
-orphaned_results = None
+# The outbox (see galah.sheep.utility.outbox) every result is stored in until
+# the shepherd acknowledges it. When a consumer loses its shepherd after it has
+# processed a test request, it will kill itself and leave the result there for
+# the maintainer to redeliver.
+outbox = None
 
 # The application-wide ZMQ context used to create sockets
 context = None
@@ -1,8 +1,87 @@
+"""
+A virtual suite that doesn't actually test anything. It pretends to create
+machines and run tests, taking as long as it's configured to, and returns a
+canned result. Useful for developing Galah and for load testing the rest of
+the system without any virtual machines.
+
+How long each step takes, and how large the results are, are given as
+distributions, each of which is a tuple of one of the following forms.
+
+    * ("fixed", value)
+    * ("exponential", mean)
+    * ("lognormal", mu, sigma): mu and sigma are of the underlying normal
+      distribution.
+    * ("trace", path): Replays the numbers in the file at path (one per line)
+      in order, starting over once they run out.
+
+"""
+
+import threading
+import random
 import time
 
+# Load Galah's configuration.
+from galah.base.config import load_config
+config = load_config("sheep/dummy")
+
+class Distribution:
+    def __init__(self, spec, rng):
+        self.kind = spec[0]
+        self.rng = rng
+
+        if self.kind == "fixed":
+            self.value = float(spec[1])
+        elif self.kind == "exponential":
+            self.mean = float(spec[1])
+        elif self.kind == "lognormal":
+            self.mu, self.sigma = float(spec[1]), float(spec[2])
+        elif self.kind == "trace":
+            with open(spec[1]) as f:
+                self.trace = [float(i) for i in f if i.strip()]
+
+            if not self.trace:
+                raise ValueError("Trace %s is empty." % spec[1])
+
+            self._position = 0
+            self._lock = threading.Lock()
+        else:
+            raise ValueError("Unknown distribution %s." % repr(self.kind))
+
+    def sample(self):
+        if self.kind == "fixed":
+            return self.value
+        elif self.kind == "exponential":
+            return self.rng.expovariate(1 / self.mean) if self.mean else 0.0
+        elif self.kind == "lognormal":
+            return self.rng.lognormvariate(self.mu, self.sigma)
+        else:
+            with self._lock:
+                value = self.trace[self._position]
+                self._position = (self._position + 1) % len(self.trace)
+
+            return value
+
+# Set by setup().
+rng = None
+produce_time = None
+prepare_time = None
+test_time = None
+result_size = None
+
 # Performs one time setup for the entire module
 def setup(logger):
-    logger.debug("setup called. Doing nothing.")
+    global rng, produce_time, prepare_time, test_time, result_size
+
+    rng = random.Random(config["SEED"])
+    produce_time = Distribution(config["PRODUCE_TIME"], rng)
+    prepare_time = Distribution(config["PREPARE_TIME"], rng)
+    test_time = Distribution(config["TEST_TIME"], rng)
+    result_size = Distribution(config["RESULT_SIZE"], rng)
+
+    logger.debug(
+        "Dummy suite will take %s to produce, %s to prepare, and %s to test.",
+        config["PRODUCE_TIME"], config["PREPARE_TIME"], config["TEST_TIME"]
+    )
 
 class Producer:
 	def __init__(self, logger):
@@ -10,19 +89,39 @@ class Producer:
 
 	def produce_vm(self):
 		self.logger.debug("produce_vm called. Doing nothing.")
-		time.sleep(10)
+		time.sleep(produce_time.sample())
 		return 0
 
 class Consumer:
     def __init__(self, logger):
         self.logger = logger
 
+        # The number of seconds each phase of the last test took.
+        self.timings = {}
+
     def prepare_machine(self):
         self.logger.debug("prepare machine called. Doing nothing.")
-        time.sleep(10)
+        time.sleep(prepare_time.sample())
         return 0
 
     def run_test(self, container_id, test_request):
         self.logger.debug("run_test called. Doing nothing.")
-        time.sleep(20)
-        return {"_id": test_request["submission"]["id"], "tests": [{"message": "Could not find `main.cpp`.", "score": 0, "max_score": 1, "name": "File Name Correct"}, {"parts": [["Found Hello", 0, 0.5], ["Found World", 0, 0.5]], "score": 0, "max_score": 1, "name": "Found Hello World"}], "score": 0, "max_score": 2}
+        start_time = time.time()
+        time.sleep(test_time.sample())
+        self.timings = {"run": time.time() - start_time}
+
+        # Pretend the test harness crashed.
+        if rng.random() < config["FAILURE_RATE"]:
+            return None
+
+        result = {"_id": test_request["submission"]["id"], "tests": [{"message": "Could not find `main.cpp`.", "score": 0, "max_score": 1, "name": "File Name Correct"}, {"parts": [["Found Hello", 0, 0.5], ["Found World", 0, 0.5]], "score": 0, "max_score": 1, "name": "Found Hello World"}], "score": 0, "max_score": 2}
+
+        # Pad the result out to make it as large as we were asked to.
+        padding = int(result_size.sample())
+        if padding > 0:
+            result["tests"].append({
+                "message": "x" * padding, "score": 0, "max_score": 0,
+                "name": "Padding"
+            })
+
+        return result
@@ -0,0 +1,459 @@
+"""
+A virtual suite that runs test harnesses directly on the sheep's host inside of
+a lightweight process sandbox rather than a virtual machine.
+
+Every test gets its own scratch directory (a "slot") containing copies of the
+testables and the test harness. The harness is run in its own process group
+with resource limits applied, optionally inside of new namespaces (using
+unshare(1)) and a chroot. Slots are just directories, so they are prepared in
+milliseconds, making this suite well suited for hosts without OpenVZ and for
+continuous integration.
+
+The sandbox is weaker than a virtual machine. Only use it with harnesses and
+submissions you are comfortable running on the sheep's host.
+
+"""
+
+import galah.sheep.utility.exithelpers as exithelpers
+from galah.sheep.utility.testrequest import PreparedTestRequest
+from galah.sheep.utility.suitehelpers import (get_testables_directory,
+                                              get_harness_directory,
+                                              timed_out_result)
+import subprocess
+import resource
+import tempfile
+import shutil
+import select
+import signal
+import errno
+import Queue
+import math
+import time
+import json
+import os
+import os.path
+
+# Load Galah's configuration.
+from galah.base.config import load_config
+config = load_config("sheep/sandbox")
+
+slots = Queue.Queue(maxsize = config["MAX_SLOTS"])
+
+# The arguments unshare is called with, or None if namespaces are unavailable.
+# Set by setup().
+unshare_arguments = None
+
+# Once the harness is killed, its output is only drained for this many seconds
+# in case something it started escaped the process group and holds the pipes
+# open.
+DRAIN_TIMEOUT = 1
+
+def _demoting():
+    "Returns True if harnesses will be run as TESTUSER rather than as us."
+
+    return os.getuid() == 0
+
+def _limits(timeout):
+    "Returns a list of (resource, limit) pairs to apply to a harness."
+
+    limits = []
+
+    if timeout is not None:
+        # The wall clock deadline is enforced separately, this just makes sure
+        # a harness cannot spin for long after it.
+        limits.append((resource.RLIMIT_CPU, int(math.ceil(timeout)) + 1))
+
+    for name in ("AS", "NOFILE", "NPROC"):
+        if config["RLIMIT_" + name] is not None:
+            limits.append(
+                (getattr(resource, "RLIMIT_" + name), config["RLIMIT_" + name])
+            )
+
+    return limits
+
+def _preexec(limits, demote):
+    "Returns a function to run in the harness's process before it is exec'ed."
+
+    def preexec():
+        # Put ourselves in a new process group so the harness can be killed
+        # along with any processes it starts.
+        os.setpgrp()
+
+        for which, limit in limits:
+            resource.setrlimit(which, (limit, limit))
+
+        if demote:
+            os.setgroups([])
+            os.setgid(config["TESTUSER_GID"])
+            os.setuid(config["TESTUSER_UID"])
+
+    return preexec
+
+def _command(program):
+    """
+    Returns the command that will run program (a path as seen from within the
+    chroot if one is configured) inside of the sandbox.
+
+    """
+
+    command = [program]
+
+    if config["CHROOT"]:
+        command = [
+            config["CHROOT_PATH"],
+            "--userspec=%d:%d" %
+                (config["TESTUSER_UID"], config["TESTUSER_GID"]),
+            config["CHROOT"]
+        ] + command
+
+    if unshare_arguments is not None:
+        command = [config["UNSHARE_PATH"]] + unshare_arguments + ["--"] + \
+            command
+
+    return command
+
+def _sandbox_path(path):
+    "Returns path as it will be seen from inside of the sandbox."
+
+    if not config["CHROOT"]:
+        return path
+
+    return "/" + os.path.relpath(path, config["CHROOT"])
+
+# Performs one time setup for the entire module. Cannot be a member function of
+# producer because it needs to be called once at startup, and the producer class
+# would not have been made yet.
+def setup(logger):
+    global unshare_arguments
+
+    directory = config["DIRECTORY"]
+
+    if config["CHROOT"]:
+        if os.getuid() != 0:
+            raise ValueError("CHROOT may only be used if the sheep runs as root.")
+
+        chroot = os.path.realpath(config["CHROOT"])
+        if not os.path.realpath(directory).startswith(chroot + os.sep):
+            raise ValueError("DIRECTORY must be inside of CHROOT.")
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Any slots left over from a previous run may have been used, so they are
+    # simply thrown away.
+    leftover = [
+        i for i in os.listdir(directory) if i.startswith("slot-")
+    ]
+    if leftover:
+        logger.info("Removing %d leftover slots.", len(leftover))
+
+        for i in leftover:
+            shutil.rmtree(os.path.join(directory, i), ignore_errors = True)
+
+    if config["UNSHARE"]:
+        arguments = list(config["UNSHARE"])
+
+        # Root does not need a user namespace to create the others, and being
+        # mapped to nobody inside of one would prevent the chroot.
+        if config["CHROOT"] and "--user" in arguments:
+            arguments.remove("--user")
+
+        # Make sure the namespaces can actually be created with our privileges
+        # before we rely on them.
+        try:
+            probe = subprocess.Popen(
+                [config["UNSHARE_PATH"]] + arguments + ["--", "true"],
+                preexec_fn = _preexec(
+                    [], _demoting() and not config["CHROOT"]
+                ),
+                stdout = open(os.devnull, "w"),
+                stderr = subprocess.PIPE
+            )
+            _, error = probe.communicate()
+        except OSError as e:
+            error = str(e)
+            probe = None
+
+        if probe is not None and probe.returncode == 0:
+            unshare_arguments = arguments
+
+            logger.info("Harnesses will be run with unshare %s.", arguments)
+        else:
+            logger.warning(
+                "Could not create namespaces with unshare %s, harnesses will "
+                "share the host's namespaces: %s", arguments, error.strip()
+            )
+
+class Producer:
+    def __init__(self, logger):
+        self.logger = logger
+
+    def produce_vm(self):
+        if slots.full():
+            self.logger.debug("MAX_SLOTS slots exist. Waiting...")
+
+            exithelpers.wait_for_queue(slots)
+
+        slot = tempfile.mkdtemp(prefix = "slot-", dir = config["DIRECTORY"])
+
+        # The harness must be able to traverse into the slot, but nobody else
+        # needs to see what is in it.
+        os.chmod(slot, 0711)
+
+        exithelpers.enqueue(slots, slot)
+
+        self.logger.debug("Added slot %s to the queue.", slot)
+
+        return slot
+
+class Consumer:
+    def __init__(self, logger):
+        self.logger = logger
+
+        # The number of seconds each phase of the last test took.
+        self.timings = {}
+
+    def prepare_machine(self):
+        return exithelpers.dequeue(slots)
+
+    def _populate(self, slot, test_request):
+        """
+        Copies the testables and the test harness into the slot and returns the
+        directories they were copied to.
+
+        """
+
+        # Figure out where the user's testables are stored
+        testable_source = get_testables_directory(test_request)
+
+        # Figure out where the test harness is
+        harness_source = get_harness_directory(test_request)
+
+        testables_directory = os.path.join(slot, "testables")
+        harness_directory = os.path.join(slot, "harness")
+
+        self.logger.debug(
+            "Copying testables at '%s' and harness at '%s'.",
+            testable_source, harness_source
+        )
+
+        shutil.copytree(testable_source, testables_directory, symlinks = True)
+        shutil.copytree(harness_source, harness_directory, symlinks = True)
+
+        # Give the test user the slot's contents. Ownership rather than
+        # permissions is changed so executable bits are preserved.
+        if _demoting():
+            for dirpath, dirnames, filenames in os.walk(slot):
+                for i in dirnames + filenames:
+                    os.lchown(
+                        os.path.join(dirpath, i),
+                        config["TESTUSER_UID"], config["TESTUSER_GID"]
+                    )
+
+        return testables_directory, harness_directory
+
+    def _run_harness(self, harness_directory, prepared_request, timeout):
+        """
+        Runs the test harness, giving it prepared_request on its standard
+        input. Returns a tuple containing its output, its log, whether its
+        output was truncated, whether it timed out, and the resources it used.
+
+        """
+
+        harness = subprocess.Popen(
+            _command(_sandbox_path(os.path.join(harness_directory, "main"))),
+            cwd = harness_directory,
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE,
+            close_fds = True,
+            preexec_fn = _preexec(
+                _limits(timeout), _demoting() and not config["CHROOT"]
+            )
+        )
+        start_time = time.time()
+
+        try:
+            harness.stdin.write(json.dumps(prepared_request))
+        except IOError as e:
+            # The harness does not have to read its request.
+            if e.errno != errno.EPIPE:
+                raise
+        harness.stdin.close()
+
+        streams = {
+            harness.stdout.fileno(): "stdout",
+            harness.stderr.fileno(): "stderr"
+        }
+        limits = {
+            "stdout": config["MAX_RESULT_SIZE"],
+            "stderr": config["MAX_LOG_SIZE"]
+        }
+        received = {"stdout": [], "stderr": []}
+        sizes = {"stdout": 0, "stderr": 0}
+
+        def kill():
+            try:
+                os.killpg(harness.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        deadline = None if timeout is None else start_time + timeout
+        timed_out = False
+        while streams:
+            if deadline is None:
+                readable, _, _ = select.select(streams.keys(), [], [])
+            else:
+                readable, _, _ = select.select(
+                    streams.keys(), [], [], max(0, deadline - time.time())
+                )
+
+            if not readable and deadline is not None and \
+                    time.time() >= deadline:
+                if timed_out:
+                    break
+
+                kill()
+                timed_out = True
+                deadline = time.time() + DRAIN_TIMEOUT
+
+                continue
+
+            for fd in readable:
+                chunk = os.read(fd, 4096)
+                name = streams[fd]
+
+                if not chunk:
+                    del streams[fd]
+                    continue
+
+                kept = max(0, min(len(chunk), limits[name] - sizes[name]))
+                if kept:
+                    received[name].append(chunk[:kept])
+
+                sizes[name] += len(chunk)
+
+        harness.stdout.close()
+        harness.stderr.close()
+
+        # The harness may have closed its output without exiting, so it still
+        # needs to be held to its deadline. wait4 gives us the resources used
+        # by this harness alone, unlike getrusage which would include every
+        # other consumer's harnesses as well.
+        while True:
+            pid, status, usage = os.wait4(harness.pid, os.WNOHANG)
+            if pid != 0:
+                break
+
+            if not timed_out and deadline is not None and \
+                    time.time() >= deadline:
+                kill()
+                timed_out = True
+
+            time.sleep(0.05)
+
+        # Keep Popen from trying to reap the harness itself.
+        harness.returncode = \
+            -os.WTERMSIG(status) if os.WIFSIGNALED(status) else \
+                os.WEXITSTATUS(status)
+
+        # Get rid of anything the harness left running.
+        kill()
+
+        resources = {
+            "wall_time": time.time() - start_time,
+            "cpu_time": usage.ru_utime + usage.ru_stime,
+            "max_rss": usage.ru_maxrss
+        }
+
+        self.logger.debug(
+            "Test harness exited with %d and logged (%d bytes): %s",
+            harness.returncode, sizes["stderr"], "".join(received["stderr"])
+        )
+
+        return (
+            "".join(received["stdout"]), "".join(received["stderr"]),
+            sizes["stdout"] > limits["stdout"], timed_out, resources
+        )
+
+    def run_test(self, slot, test_request):
+        self.logger.debug("Running test in slot %s.", slot)
+
+        self.timings = {}
+
+        try:
+            start_time = time.time()
+            testables_directory, harness_directory = \
+                self._populate(slot, test_request)
+            self.timings["inject"] = time.time() - start_time
+
+            prepared_request = PreparedTestRequest(
+                raw_harness = test_request["test_harness"],
+                raw_submission = test_request["submission"],
+                raw_assignment = test_request["assignment"],
+                testables_directory = _sandbox_path(testables_directory),
+                harness_directory = _sandbox_path(harness_directory),
+                suite_specific = {
+                    "sandbox/uid": config["TESTUSER_UID"]
+                        if _demoting() else os.getuid(),
+                    "sandbox/gid": config["TESTUSER_GID"]
+                        if _demoting() else os.getgid()
+                }
+            )
+            prepared_request.update_actions()
+            prepared_request = prepared_request.to_dict()
+
+            self.logger.debug(
+                "Test request being sent to harness: %s", str(prepared_request)
+            )
+
+            start_time = time.time()
+            output, log, truncated, timed_out, resources = self._run_harness(
+                harness_directory, prepared_request,
+                test_request["test_harness"]["config"].get("galah/timeout")
+            )
+            self.timings["run"] = time.time() - start_time
+
+            if timed_out:
+                self.logger.info(
+                    "Test harness timed out, partial output was: %s", output
+                )
+
+                return timed_out_result(
+                    output, log, resources, config["MAX_PARTIAL_OUTPUT_SIZE"]
+                )
+
+            if truncated:
+                self.logger.info(
+                    "Test harness gave more output than MAX_RESULT_SIZE (%d).",
+                    config["MAX_RESULT_SIZE"]
+                )
+
+                return None
+
+            try:
+                result = json.loads(output)
+            except ValueError:
+                self.logger.info("Test harness gave bad output: %s", output)
+
+                return None
+
+            if isinstance(result, dict):
+                result["resources"] = resources
+
+            return result
+        except (OSError, IOError, shutil.Error):
+            self.logger.exception("Could not run test in slot %s.", slot)
+
+            return None
+        finally:
+            start_time = time.time()
+            self.destroy_machine(slot)
+            self.timings["teardown"] = time.time() - start_time
+
+    def destroy_machine(self, slot):
+        "Removes a slot, whether or not a test was run in it."
+
+        self.logger.debug("Removing slot %s.", slot)
+
+        shutil.rmtree(slot, ignore_errors = True)
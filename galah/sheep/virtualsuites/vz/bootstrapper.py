@@ -6,24 +6,69 @@ import json
 import subprocess
 import os
 import os.path
+import select
+import codecs
+import signal
+import resource
+import time
+from optparse import OptionParser
 
-# Bind to a good ole' fashioned tcp socket.
-sheep_listener = \
-    socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-sheep_listener.bind(("0.0.0.0", 6668))
-sheep_listener.setblocking(1)
-sheep_listener.listen(1)
-
-# Wait for the sheep to connect to us.
-print >> sys.stderr, "[bootstrapper] Waiting for sheep to connect."
-try:
-    sheep, sheep_address = \
-        sheep_listener.accept()
-except socket.timeout:
-    exit(1)
+parser = OptionParser()
+parser.add_option(
+    "--connect", metavar = "HOST:PORT",
+    help = "Connect to the sheep at HOST:PORT rather than waiting for it to "
+           "connect to us."
+)
+parser.add_option(
+    "--token",
+    help = "The token to identify ourselves to the sheep with. Required with "
+           "--connect."
+)
+options, args = parser.parse_args()
+
+if options.connect:
+    if not options.token:
+        parser.error("--token is required with --connect.")
+
+    host, port = options.connect.rsplit(":", 1)
+
+    # The sheep is always listening, but our network may take a moment to come
+    # up.
+    print >> sys.stderr, "[bootstrapper] Connecting to sheep at", options.connect
+    deadline = time.time() + 30
+    while True:
+        sheep = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sheep.connect((host, int(port)))
+            break
+        except socket.error:
+            sheep.close()
+
+            if time.time() > deadline:
+                exit(1)
+
+            time.sleep(0.05)
+
+    sheep.sendall(options.token + "\n")
+else:
+    # Bind to a good ole' fashioned tcp socket.
+    sheep_listener = \
+        socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sheep_listener.bind(("0.0.0.0", 6668))
+    sheep_listener.setblocking(1)
+    sheep_listener.listen(1)
+
+    # Wait for the sheep to connect to us.
+    print >> sys.stderr, "[bootstrapper] Waiting for sheep to connect."
+    try:
+        sheep, sheep_address = \
+            sheep_listener.accept()
+    except socket.timeout:
+        exit(1)
 
 # We're going to treat the socket just like a file object.
-sheep_fd = sheep.makefile()
+sheep_fd = sheep.makefile("r")
+sheep_out = sheep.makefile("w")
 
 # We're guarenteed that the entire test request is contained on a single line.
 print >> sys.stderr, "[bootstrapper] Waiting for test request."
@@ -31,23 +76,141 @@ test_request = sheep_fd.readline()
 print >> sys.stderr, "[bootstrapper] Received test request", test_request
 test_request = json.loads(test_request)
 
+def send_frame(frame_type, data):
+    """
+    Sends a single frame to the sheep. See galah.sheep.utility.resultchannel
+    for a description of the protocol.
+
+    """
+
+    sheep_out.write(json.dumps({"type": frame_type, "data": data}) + "\n")
+    sheep_out.flush()
+
+# Output is sent as text, so make sure multibyte characters split across reads
+# are decoded correctly. The codec is looked up before we demote ourselves in
+# case we can no longer read it afterwards.
+decoders = {
+    "stdout": codecs.getincrementaldecoder("utf-8")("replace"),
+    "stderr": codecs.getincrementaldecoder("utf-8")("replace")
+}
+
 # Demote ourselves
 os.setgid(test_request["vz/gid"])
 os.setuid(test_request["vz/uid"])
 
-# Start the test harness
+# The number of seconds the harness may run before it is killed, or None if it
+# may run forever.
+timeout = test_request["raw_harness"]["config"].get("galah/timeout")
+
+# Start the test harness in its own process group so that it can be killed
+# along with any processes it starts.
 print >> sys.stderr, "[bootstrapper] Starting test harness."
+start_time = time.time()
 harness = subprocess.Popen(
 	os.path.join(test_request["harness_directory"], "main"),
 	stdin = subprocess.PIPE,
-	stdout = sheep_fd,
-	stderr = subprocess.STDOUT
+	stdout = subprocess.PIPE,
+	stderr = subprocess.PIPE,
+	preexec_fn = os.setpgrp
 )
 harness.stdin.write(json.dumps(test_request))
 harness.stdin.close()
-harness.wait()
 
+# Forward the harness's output to the sheep as it is produced. We never send
+# more of a stream than the sheep is willing to keep, anything beyond that is
+# read and counted but dropped.
+streams = {
+    harness.stdout.fileno(): "stdout",
+    harness.stderr.fileno(): "stderr"
+}
+limits = {
+    "stdout": test_request["vz/max_result_size"],
+    "stderr": test_request["vz/max_log_size"]
+}
+sent = {"stdout": 0, "stderr": 0}
+dropped = {"stdout": 0, "stderr": 0}
+
+# Once the harness is killed, its output is only drained for this many seconds
+# in case something it started escaped the process group and holds the pipes
+# open.
+DRAIN_TIMEOUT = 1
+
+deadline = None if timeout is None else start_time + timeout
+timed_out = False
+while streams:
+    if deadline is None:
+        readable, _, _ = select.select(streams.keys(), [], [])
+    else:
+        readable, _, _ = select.select(
+            streams.keys(), [], [], max(0, deadline - time.time())
+        )
+
+    if not readable and deadline is not None and time.time() >= deadline:
+        if timed_out:
+            break
+
+        print >> sys.stderr, "[bootstrapper] Test harness timed out."
+        try:
+            os.killpg(harness.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        timed_out = True
+        deadline = time.time() + DRAIN_TIMEOUT
+
+        continue
+
+    for fd in readable:
+        chunk = os.read(fd, 4096)
+        name = streams[fd]
+
+        if not chunk:
+            del streams[fd]
+            continue
+
+        allowed = max(0, limits[name] - sent[name])
+        if allowed < len(chunk):
+            dropped[name] += len(chunk) - allowed
+            chunk = chunk[:allowed]
+
+        if chunk:
+            send_frame(name, decoders[name].decode(chunk))
+            sent[name] += len(chunk)
+
+# The harness may have closed its output without exiting, so it still needs to
+# be held to its deadline.
+while harness.poll() is None:
+    if not timed_out and deadline is not None and time.time() >= deadline:
+        print >> sys.stderr, "[bootstrapper] Test harness timed out."
+        try:
+            os.killpg(harness.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        timed_out = True
+
+    time.sleep(0.05)
+wall_time = time.time() - start_time
+
+# Only covers the harness and any of its children it waited on.
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+for name, count in dropped.items():
+    if count:
+        send_frame("truncated", {"stream": name, "bytes": count})
+
+send_frame("exit", {
+    "returncode": harness.returncode,
+    "timed_out": timed_out,
+    "resources": {
+        "wall_time": wall_time,
+        "cpu_time": usage.ru_utime + usage.ru_stime,
+        "max_rss": usage.ru_maxrss
+    }
+})
+
+sheep_out.close()
 sheep_fd.close()
 sheep.close()
 
-exit(harness.returncode)
\ No newline at end of file
+exit(harness.returncode)
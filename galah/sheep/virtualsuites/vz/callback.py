@@ -0,0 +1,165 @@
+"""
+A listener the bootstrappers connect back to once they are ready.
+
+Rather than having the consumer repeatedly try to connect to a bootstrapper
+that may not be listening yet, each bootstrapper is told the address of this
+listener and a one-time token when it is started. As soon as it is running it
+connects to the listener and sends the token on a line by itself, and the
+connection is handed to whichever consumer is waiting on that token. Every
+connection is identified in its own thread, so a peer that is slow to send its
+token can't hold up anybody else's.
+
+"""
+
+import socket
+import threading
+import os
+import time
+import logging
+
+logger = logging.getLogger("galah.sheep.vz.callback")
+
+# The longest line a bootstrapper may send to identify itself.
+MAX_TOKEN_LINE = 256
+
+class CallbackListener:
+    def __init__(self, address, port, backlog = 16, identify_timeout = 5,
+            max_identifying = 64):
+        """
+        Binds to the given address and port. Connections that do not identify
+        themselves within identify_timeout seconds are dropped, as are new
+        connections while max_identifying others are still identifying.
+
+        """
+
+        self.identify_timeout = identify_timeout
+
+        # Bounds the number of threads identifying connections at once.
+        self._identifying = threading.BoundedSemaphore(max_identifying)
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((address, port))
+        self._socket.listen(backlog)
+
+        self.address = self._socket.getsockname()
+
+        # Maps tokens we are waiting on to a list of the form
+        # [event, connection], the connection is filled in when it arrives.
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+        self._thread = threading.Thread(
+            target = self._accept_forever, name = "vz-callback"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def expect(self):
+        """
+        Returns a new one-time token to give to a bootstrapper. wait() or
+        cancel() must be called with the token afterwards.
+
+        """
+
+        token = os.urandom(16).encode("hex")
+
+        with self._lock:
+            self._waiting[token] = [threading.Event(), None]
+
+        return token
+
+    def wait(self, token, timeout):
+        """
+        Blocks until the bootstrapper given token connects and returns its
+        socket, or returns None if it does not connect within timeout seconds.
+        The token cannot be used again either way.
+
+        """
+
+        with self._lock:
+            event = self._waiting[token][0]
+
+        event.wait(timeout)
+
+        with self._lock:
+            return self._waiting.pop(token)[1]
+
+    def cancel(self, token):
+        "Stops waiting on token, closing its connection if it arrived."
+
+        with self._lock:
+            waiter = self._waiting.pop(token, None)
+
+        if waiter is not None and waiter[1] is not None:
+            waiter[1].close()
+
+    def _accept_forever(self):
+        while True:
+            try:
+                connection, address = self._socket.accept()
+            except socket.error:
+                logger.exception("Could not accept connection.")
+                time.sleep(1)
+                continue
+
+            if not self._identifying.acquire(False):
+                logger.warning(
+                    "Too many connections identifying, dropping connection "
+                    "from %s.", str(address)
+                )
+                connection.close()
+                continue
+
+            identify_thread = threading.Thread(
+                target = self._identify, args = (connection, address),
+                name = "vz-callback-identify"
+            )
+            identify_thread.daemon = True
+
+            try:
+                identify_thread.start()
+            except Exception:
+                self._identifying.release()
+                logger.exception("Could not start identifying thread.")
+                connection.close()
+
+    def _identify(self, connection, address):
+        try:
+            self._read_token(connection, address)
+        except Exception:
+            logger.exception(
+                "Could not identify connection from %s.", str(address)
+            )
+            connection.close()
+        finally:
+            self._identifying.release()
+
+    def _read_token(self, connection, address):
+        connection.settimeout(self.identify_timeout)
+
+        # Read byte by byte so nothing the bootstrapper sends after its token
+        # is consumed here.
+        line = []
+        while len(line) < MAX_TOKEN_LINE:
+            received = connection.recv(1)
+            if not received or received == "\n":
+                break
+
+            line.append(received)
+
+        token = "".join(line).strip()
+
+        with self._lock:
+            waiter = self._waiting.get(token)
+            if waiter is not None and waiter[1] is None:
+                connection.settimeout(None)
+                waiter[1] = connection
+                waiter[0].set()
+
+                return
+
+        logger.warning(
+            "Dropping connection from %s with unknown token.", str(address)
+        )
+        connection.close()
@@ -1,12 +1,16 @@
-import subprocess, ConfigParser, sys, os, datetime
-from galah.base.magic import memoize
+import subprocess, ConfigParser, sys, os, datetime, tarfile, shutil, time
+import random, threading, fnmatch
+from galah.base.cache import cached
 
 # Load Galah's configuration.
 from galah.base.config import load_config
 config = load_config("sheep/vz")
 
-vzctlPath = "/usr/sbin/vzctl"
-vzlistPath = "/usr/sbin/vzlist"
+import logging
+logger = logging.getLogger("galah.sheep.pyvz")
+
+vzctlPath = config["VZCTL_PATH"]
+vzlistPath = config["VZLIST_PATH"]
 containerDirectory = None
 nullFile = open("/dev/null", "w")
 
@@ -15,29 +19,61 @@ def check_call(*args, **kwargs):
 
     returnValue = subprocess.call(*args, **kwargs)
     if returnValue != 0:
-        raise SystemError((return_value, str(zparams[0])))
+        raise SystemError((returnValue, str(args[0])))
     else:
         return 0
 
 def run_vzctl(zparams, timeout = config["VZCTL_RETRY_TIMEOUT"]):
+    """
+    Runs vzctl with the given parameters and raises a SystemError if it fails.
+
+    vzctl exits with 9 if the container is locked by another vzctl process. In
+    that case the command is retried after a randomized, exponentially growing
+    delay until timeout passes, which keeps us from hammering the lock while
+    it is held.
+
+    """
+
     cmd = [vzctlPath] + zparams
 
     deadline = datetime.datetime.today() + timeout
+    delay = config["VZCTL_RETRY_DELAY"].total_seconds()
 
     while True:
         return_value = subprocess.call(
             cmd, stdout = nullFile, stderr = nullFile
         )
 
-        if return_value == 9 and datetime.datetime.today() < deadline:
+        remaining = (deadline - datetime.datetime.today()).total_seconds()
+        if return_value == 9 and remaining > 0:
+            time.sleep(min(remaining, delay * random.uniform(0.5, 1.5)))
+
+            delay = min(
+                delay * 2, config["VZCTL_RETRY_MAX_DELAY"].total_seconds()
+            )
+
             continue
         elif return_value != 0:
             raise SystemError((return_value, str(zparams[0])))
         else:
             return 0
 
-@memoize
-def find_container_directory(config_path = "/etc/vz/vz.conf"):
+def run_vzlist(zparams):
+    "Runs vzlist with the given parameters and returns its output lines."
+
+    p = subprocess.Popen([vzlistPath] + zparams,
+                         stdout = subprocess.PIPE,
+                         stderr = nullFile)
+
+    output = p.communicate()
+
+    if p.returncode != 0:
+        raise SystemError((p.returncode, "vzlist"))
+
+    return [i for i in output[0].splitlines() if i.strip()]
+
+@cached()
+def find_container_directory(config_path = config["VZ_CONFIG_PATH"]):
     """
     Finds the location of the container filesystems and returns it.
 
@@ -142,6 +178,8 @@ def create_container(id_range = range(1, 255),
     # Actually call vzctl to create the container
     run_vzctl(["create", str(id)] + parameters)
 
+    _inventory.update(id, description)
+
     return id
 
 def start_container(id):
@@ -160,6 +198,8 @@ def destroy_container(id):
 
     run_vzctl(["destroy", str(id)])
 
+    _inventory.remove(id)
+
 def extirpate_container(id):
     "Destroys a container and stops it first if it must."
 
@@ -167,7 +207,7 @@ def extirpate_container(id):
     destroy_container(id)
 
 def inject_file(id, source, to, move = False, permissions = "rwx",
-               unpack = False):
+               unpack = False, stream = None):
     """
     Injects a given file (source) from the host system into the filesystem of
     the container with id id at location to (to is an absolute filepath as
@@ -184,16 +224,165 @@ def inject_file(id, source, to, move = False, permissions = "rwx",
     this option will be ignored. Iff move is True the package will be deleted
     after extracting.
 
+    If stream is True, the files are written into a single tar stream that is
+    extracted into the container in one pass with the correct owner and
+    permissions already set. If that fails (or stream is False) the files are copied and
+    then fixed up with chown and chmod. If stream is None the STREAM_INJECTION
+    configuration value is used.
+
     """
 
+    if stream is None:
+        stream = config["STREAM_INJECTION"]
+
     # Figure out the fully qualified destination path as seen by the host
     # system
     ztoReal = container_to_host_path(id, to)
 
+    unpack = unpack and source.endswith((".tar", ".tar.gz"))
+
+    if stream:
+        try:
+            _inject_stream(source, ztoReal, permissions, unpack)
+        except (SystemError, EnvironmentError, tarfile.TarError):
+            logger.warning(
+                "Could not stream %s into container %s, falling back to "
+                "copying.", source, str(id), exc_info = True
+            )
+        else:
+            if move:
+                _remove_source(source)
+
+            return
+
+    _inject_copy(source, ztoReal, move, permissions, unpack)
+
+def _permission_bits(permissions):
+    """
+    Converts a permission string as chmod would accept after a= (ex: "rwx")
+    into mode bits that apply to the owner, group, and others.
+
+    """
+
+    bits = 0
+    for i in permissions:
+        bits |= {"r": 4, "w": 2, "x": 1}[i]
+
+    return bits * 0111
+
+def _extract_stream(path, stdin):
+    """
+    Starts a tar process that extracts the archive it reads from stdin into
+    path. Owners and permissions stored in the archive are kept as is,
+    modification times are not (cp does not keep them either).
+
+    """
+
+    return subprocess.Popen(
+        ["tar", "--extract", "--same-owner", "--same-permissions",
+         "--numeric-owner", "--touch", "--file", "-", "-C", path],
+        stdin = stdin, stdout = nullFile, stderr = nullFile
+    )
+
+def _wait_all(*processes):
+    "Waits for every process and raises a SystemError if any of them failed."
+
+    for p in processes:
+        returnValue = p.wait()
+        if returnValue != 0:
+            raise SystemError((returnValue, "tar"))
+
+def _inject_stream(source, ztoReal, permissions, unpack):
+    if unpack:
+        # The package's members need new owners and modes, so re-stream it
+        # through tarfile rather than extracting it and fixing it up
+        # afterwards.
+        mode = _permission_bits(permissions)
+        extractor = _extract_stream(ztoReal, subprocess.PIPE)
+
+        try:
+            package = tarfile.open(source, "r|*")
+            try:
+                archive = tarfile.open(fileobj = extractor.stdin, mode = "w|")
+                for member in package:
+                    member.uid = member.gid = 0
+                    member.uname = member.gname = ""
+                    if not member.issym():
+                        member.mode = mode
+
+                    archive.addfile(
+                        member,
+                        package.extractfile(member) if member.isreg() else None
+                    )
+
+                archive.close()
+            finally:
+                package.close()
+        except:
+            # Whatever went wrong is more useful than tar complaining about
+            # the truncated archive it got, so don't let cleaning up hide it.
+            exc_info = sys.exc_info()
+
+            try:
+                extractor.stdin.close()
+            except IOError:
+                pass
+
+            extractor.wait()
+
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        # Closing the pipe lets tar finish so it does not hang around.
+        extractor.stdin.close()
+        _wait_all(extractor)
+
+        return
+
+    # A directory's own entry is included so tar fixes up the target directory
+    # itself, just like chown -R and chmod -R would.
+    if os.path.isdir(source):
+        directory, names = source, ["."]
+    else:
+        directory, names = os.path.split(source)
+        names = [names]
+
+    # GNU tar rewrites the owners and modes as it builds the stream, and the
+    # stream goes straight from one tar process into the other. Generating it
+    # with tarfile instead is several times slower than even the copying path
+    # on trees of many small files.
+    creator = subprocess.Popen(
+        ["tar", "--create", "--file", "-", "--owner", "0", "--group", "0",
+         "--numeric-owner", "--mode", "a=%s" % (permissions), "-C",
+         directory, "--"] + names,
+        stdout = subprocess.PIPE, stderr = nullFile
+    )
+    extractor = _extract_stream(ztoReal, creator.stdout)
+
+    # Only the extractor should hold the read end of the pipe, otherwise the
+    # creator would not notice if the extractor died.
+    creator.stdout.close()
+
+    _wait_all(extractor, creator)
+
+def _remove_source(source):
+    "Removes the injected files after they were streamed into a container."
+
+    if os.path.isdir(source):
+        for i in os.listdir(source):
+            path = os.path.join(source, i)
+
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    else:
+        os.remove(source)
+
+def _inject_copy(source, ztoReal, move, permissions, unpack):
     # Use the system commands rather than python's filesystem functions for
     # efficiency and simplicity (we certainly know what system this code is
     # running on since OpenVZ only supports *nix).
-    if unpack and source.endswith((".tar", ".tar.gz")):
+    if unpack:
         check_call(["tar", "-xzf", source, "-C", ztoReal],
                    stdout = nullFile, stderr = nullFile)
         if move:
@@ -216,6 +405,22 @@ def inject_file(id, source, to, move = False, permissions = "rwx",
     check_call(["chmod", "-R", "a=%s" % (permissions), ztoReal],
                stdout = nullFile, stderr = nullFile)
 
+def inject_archive(id, archive, to):
+    """
+    Extracts a tarball into the filesystem of the container with id id at
+    location to (to is an absolute filepath as seen by the container's
+    filesystem).
+
+    archive is an open file object. Unlike inject_file, the owners and
+    permissions stored in the archive are kept as is, so no additional passes
+    over the injected files are necessary.
+
+    """
+
+    ztoReal = container_to_host_path(id, to)
+
+    _wait_all(_extract_stream(ztoReal, archive))
+
 def run_shell_script_from_host(id, script):
     """
     Runs the given script located at script on the host system inside of the
@@ -304,27 +509,121 @@ def set_attribute(id, attribute, value, save = True):
     run_vzctl(["set", str(id), "--" + attribute, value] +
                     (["--save"] if save else ["--setmode", "ignore"]))
 
+    if attribute == "description":
+        _inventory.update(id, value)
+
+def get_attributes(ids, attributes):
+    """
+    Gets a number of attributes (check documentation for vzlist -o) of a number
+    of vms with a single call to vzlist. Returns a dictionary mapping each id
+    to a dictionary mapping each attribute to its value.
+
+    Only the last attribute's value may contain spaces.
+
+    """
+
+    ids = [int(i) for i in ids]
+    if not ids:
+        return {}
+
+    lines = run_vzlist(
+        ["-aHo", ",".join(["ctid"] + list(attributes))] + [str(i) for i in ids]
+    )
+
+    result = {}
+    for line in lines:
+        values = line.split(None, len(attributes))
+
+        # vzlist shows empty values as a dash.
+        values += ["-"] * (len(attributes) + 1 - len(values))
+        result[int(values[0])] = dict(
+            (k, "" if v == "-" else v.strip())
+                for k, v in zip(attributes, values[1:])
+        )
+
+    missing = set(ids) - set(result.keys())
+    if missing:
+        raise SystemError((1, "Could not get attributes of %s." % (
+            ", ".join(str(i) for i in sorted(missing))
+        )))
+
+    return result
+
 def get_attribute(id, attribute):
-    p = subprocess.Popen([vzlistPath, "-Ho", attribute, str(id)],
-                         stdout = subprocess.PIPE,
-                         stderr = nullFile)
+    return get_attributes([id], [attribute])[int(id)][attribute]
 
-    output = p.communicate()
+class _Inventory:
+    """
+    A cache of the extant containers and their descriptions. The whole
+    inventory is only read from vzlist when it has gone stale, every change we
+    make to a container through this module updates it in place.
 
-    if p.returncode != 0:
-        raise SystemError((p.returncode,
-                           "Could not get attribute %s of %s." %
-                                (attribute, id)))
+    """
+
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+
+        # Maps container ids to their descriptions.
+        self._descriptions = {}
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        "Must hold the lock."
+
+        now = datetime.datetime.today()
+        if self._refreshed is not None and \
+                now - self._refreshed < self.lifetime:
+            return
+
+        descriptions = {}
+        for line in run_vzlist(["-aHo", "ctid,description"]):
+            values = line.split(None, 1)
+
+            description = values[1].strip() if len(values) > 1 else "-"
+            descriptions[int(values[0])] = \
+                "" if description == "-" else description
 
-    return output[0].strip()
+        self._descriptions = descriptions
+        self._refreshed = now
 
-def get_containers(description_pattern = None):
-    "Returns a list all of the extant containers."
+    def invalidate(self):
+        with self._lock:
+            self._refreshed = None
+
+    def update(self, id, description):
+        with self._lock:
+            self._descriptions[int(id)] = description or ""
+
+    def remove(self, id):
+        with self._lock:
+            self._descriptions.pop(int(id), None)
+
+    def find(self, description_pattern):
+        with self._lock:
+            self._refresh()
+
+            return [
+                k for k, v in self._descriptions.items()
+                    if fnmatch.fnmatchcase(v, description_pattern)
+            ]
+
+_inventory = _Inventory(config["INVENTORY_LIFETIME"])
+
+def get_containers(description_pattern = None, refresh = False):
+    """
+    Returns a list all of the extant containers.
+
+    If description_pattern is given, only containers whose descriptions match
+    it (as a shell-style pattern) are returned. These are looked up in a cached
+    inventory of the containers, refresh forces it to be reloaded from vzlist.
+
+    """
 
     # If we do not care about the description, we can very quickly get a list
     # of the extant containers by enumerating through the directory which
     # contains the containers' private areas. Otherwise, we have to use
-    # vzlist.
+    # the inventory.
     if description_pattern == None:
         # Find the directory where the container's private areas are stored
         dirPath = find_container_directory()
@@ -339,14 +638,7 @@ def get_containers(description_pattern = None):
 
         return containers
     else:
-        flags = ["-d", description_pattern]
-
-        p = subprocess.Popen([vzlistPath] + flags + ["-aHo", "ctid"],
-                             stdout = subprocess.PIPE, stderr = nullFile)
-
-        output = p.communicate()
-
-        if p.returncode != 0:
-            raise SystemError((p.returncode, "Could not list containers"))
+        if refresh:
+            _inventory.invalidate()
 
-        return [int(i.strip()) for i in output[0].splitlines()]
+        return _inventory.find(description_pattern)
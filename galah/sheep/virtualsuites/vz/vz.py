@@ -1,5 +1,12 @@
 import galah.sheep.utility.exithelpers as exithelpers
 from galah.sheep.utility.testrequest import PreparedTestRequest
+from galah.sheep.utility.harnesscache import HarnessCache
+from galah.sheep.utility.resultchannel import ResultChannel, ProtocolError
+from galah.sheep.utility.background import Background
+from galah.sheep.utility.suitehelpers import (get_testables_directory,
+                                              get_harness_directory,
+                                              timed_out_result)
+from callback import CallbackListener
 import pyvz
 import time
 import Queue
@@ -15,10 +22,32 @@ config = load_config("sheep/vz")
 
 containers = Queue.Queue(maxsize = config["MAX_MACHINES"])
 
+# The cache of prepared test harnesses. Created by setup() unless the cache is
+# disabled.
+harness_cache = None
+
+# The listener bootstrappers connect back to. Created by setup() if
+# CALLBACK_ADDRESS is set, otherwise we connect to the bootstrappers instead.
+callback_listener = None
+
+# The address bootstrappers are told to connect back to. Set by setup() along
+# with callback_listener.
+callback_host = None
+
+# Maps the CTIDs of containers we started to the time they were started at.
+container_start_times = {}
+
+# Maps the CTIDs of containers that had a test harness injected into them ahead
+# of time (see Consumer.stage_machine()) to the harness cache's key for it, or
+# None if staging failed part way through.
+staged_harnesses = {}
+
 # Performs one time setup for the entire module. Cannot be a member function of
 # producer because it needs to be called once at startup, and the producer class
 # would not have been made yet.
 def setup(logger):
+    global harness_cache, callback_listener, callback_host
+
     if config["MAX_MACHINES"] == 0:
         logger.warning(
             "MAX_MACHINES is 0. Infinitely many virtual machines will be "
@@ -69,6 +98,37 @@ def setup(logger):
         except SystemError:
             logger.exception("Could not destroy dirty VM with CTID %d.", i)
 
+    if config["HARNESS_CACHE_DIRECTORY"]:
+        harness_cache = HarnessCache(
+            config["HARNESS_CACHE_DIRECTORY"],
+            config["HARNESS_CACHE_BUDGET"]
+        )
+
+        logger.info(
+            "Using harness cache at %s with %s.",
+            config["HARNESS_CACHE_DIRECTORY"], str(harness_cache.stats())
+        )
+
+    if config["CALLBACK_ADDRESS"]:
+        # The listener may be bound to every interface, but the bootstrappers
+        # need an address they can actually reach.
+        callback_host = config["CALLBACK_HOST"] or config["CALLBACK_ADDRESS"]
+        if callback_host in ("0.0.0.0", "::"):
+            raise ValueError(
+                "CALLBACK_ADDRESS (%s) is a wildcard address, set "
+                "CALLBACK_HOST to the address bootstrappers should connect "
+                "back to." % config["CALLBACK_ADDRESS"]
+            )
+
+        callback_listener = CallbackListener(
+            config["CALLBACK_ADDRESS"], config["CALLBACK_PORT"]
+        )
+
+        logger.info(
+            "Bootstrappers will connect back to %s:%d.",
+            callback_host, callback_listener.address[1]
+        )
+
 class Producer:
     def __init__(self, logger):
         self.logger = logger
@@ -134,6 +194,8 @@ class Producer:
 
             return None
 
+        container_start_times[id] = time.time()
+
         # Try to add the container to the queue until successful or the program
         # is exiting.
         exithelpers.enqueue(containers, id)
@@ -146,12 +208,239 @@ class Consumer:
     def __init__(self, logger):
         self.logger = logger
 
+        # The number of seconds each phase of the last test took.
+        self.timings = {}
+
     def prepare_machine(self):
         return exithelpers.dequeue(containers)
 
+    def stage_machine(self, container_id, hint):
+        """
+        Injects the test harness the shepherd thinks we will need next into
+        the container ahead of time, so run_test() can skip it if the guess
+        was right.
+
+        """
+
+        if harness_cache is None or not hint.get("test_harness"):
+            return
+
+        harness_id = hint["test_harness"]
+        harness_directory = os.path.join(
+            config["HARNESS_DIRECTORY"], harness_id
+        )
+
+        # Harnesses fetched from the shepherd can't be staged before the
+        # request arrives.
+        if not os.path.isdir(harness_directory):
+            return
+
+        try:
+            # The container is no longer pristine after this, so make sure it
+            # is not reused if we die before running a test in it.
+            pyvz.set_attribute(container_id, "description", "galah-vm: dirty")
+
+            if config["CALL_MKDIR"]:
+                pyvz.execute(
+                    container_id, "mkdir -p %s" % config["VM_HARNESS_DIRECTORY"]
+                )
+
+            key = harness_cache.key(harness_id, harness_directory)
+            harness_archive = harness_cache.open(harness_id, harness_directory)
+            try:
+                pyvz.inject_archive(
+                    container_id, harness_archive,
+                    config["VM_HARNESS_DIRECTORY"]
+                )
+            finally:
+                harness_archive.close()
+        except (SystemError, OSError, IOError):
+            self.logger.exception(
+                "Could not stage harness %s in VM with CTID %d.",
+                harness_id, container_id
+            )
+
+            # Some of the harness may have made it in, so make sure it's
+            # cleared out before the real one is injected.
+            staged_harnesses[container_id] = None
+
+            return
+
+        staged_harnesses[container_id] = key
+
+        self.logger.debug(
+            "Staged harness %s in VM with CTID %d.", harness_id, container_id
+        )
+
+    def _inject_files(self, container_id, test_request, testable_directory,
+            harness_directory):
+        """
+        Injects the testables and the test harness into the container. Returns
+        the number of seconds it took.
+
+        """
+
+        start_time = time.time()
+
+        # Inject file into VM from the testables location
+        pyvz.inject_file(
+            container_id, testable_directory, config["VM_TESTABLES_DIRECTORY"]
+        )
+
+        harness_id = test_request["test_harness"]["id"]
+
+        # Skip the harness if it was staged ahead of time and hasn't changed
+        # since.
+        if container_id in staged_harnesses:
+            staged = staged_harnesses.pop(container_id)
+            if staged is not None and \
+                    staged == harness_cache.key(harness_id, harness_directory):
+                self.logger.debug(
+                    "Harness %s was already staged in VM with CTID %d.",
+                    harness_id, container_id
+                )
+
+                return time.time() - start_time
+
+            # Whatever was staged is the wrong harness (or only part of one),
+            # and extracting the right one on top of it would leave behind any
+            # files only the staged one had.
+            self.logger.debug(
+                "Clearing out wrongly staged harness in VM with CTID %d.",
+                container_id
+            )
+
+            returncode = pyvz.execute(
+                container_id, "rm -rf %s && mkdir -p %s" % (
+                    config["VM_HARNESS_DIRECTORY"],
+                    config["VM_HARNESS_DIRECTORY"]
+                )
+            )
+            if returncode != 0:
+                raise SystemError((returncode, "clearing staged harness"))
+
+        # Ditto from the test harness's location. Use the harness cache if
+        # we can as it only needs a single extraction.
+        if harness_cache is not None:
+            harness_archive = harness_cache.open(harness_id, harness_directory)
+
+            try:
+                pyvz.inject_archive(
+                    container_id, harness_archive,
+                    config["VM_HARNESS_DIRECTORY"]
+                )
+            finally:
+                harness_archive.close()
+
+            self.logger.debug(
+                "Harness cache statistics: %s", str(harness_cache.stats())
+            )
+        else:
+            pyvz.inject_file(
+                container_id, harness_directory,
+                config["VM_HARNESS_DIRECTORY"]
+            )
+
+        return time.time() - start_time
+
+    def _start_bootstrapper(self, container_id):
+        """
+        Runs the bootstrapper that has been injected into the container and
+        returns a socket connected to it.
+
+        """
+
+        script = os.path.join(
+            "/tmp/", os.path.basename(config["BOOTSTRAPPER"])
+        )
+
+        if callback_listener is not None:
+            # Have the bootstrapper connect to us as soon as it is up.
+            token = callback_listener.expect()
+            try:
+                pyvz.run_script(
+                    container_id,
+                    "%s --connect %s:%d --token %s" % (
+                        script, callback_host, callback_listener.address[1],
+                        token
+                    )
+                )
+
+                bootstrapper = callback_listener.wait(token, 30)
+            except:
+                callback_listener.cancel(token)
+                raise
+
+            if bootstrapper is None:
+                raise RuntimeError("Bootstrapper never connected back.")
+
+            self.logger.debug(
+                "Bootstrapper in VM with CTID %d connected back.", container_id
+            )
+
+            bootstrapper.settimeout(60)
+
+            return bootstrapper
+
+        pyvz.run_script(container_id, script)
+
+        # Bind to a good ole' fashioned tcp socket and wait for the
+        # bootstrapper to connect to us.
+        bootstrapper = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        bootstrapper.setblocking(1)
+        bootstrapper.settimeout(60)
+
+        # Try to connect to the bootstrapper
+        deadline = time.time() + 30
+        while time.time() <= deadline:
+            try:
+                bootstrapper.connect(
+                    ("%s.%d" % (config["VM_SUBNET"], container_id), config["VM_PORT"])
+                )
+
+                self.logger.debug(
+                    "Connected to %s.%d:%d.",
+                    config["VM_SUBNET"], container_id, config["VM_PORT"]
+                )
+
+                return bootstrapper
+            except socket.error:
+                time.sleep(0.1)
+
+        raise RuntimeError("Could not connect to bootstrapper.")
+
+    def _bootstrapper_timings(self, container_id, launched_at, connected_at,
+            first_byte_at):
+        """
+        Records the number of seconds it took the bootstrapper to become ready
+        and to send its first byte of output, measured from when it was
+        launched and, if we started the container, from when the container was
+        started.
+
+        """
+
+        self.timings["connect"] = connected_at - launched_at
+
+        if first_byte_at is not None:
+            self.timings["first_byte"] = first_byte_at - launched_at
+
+        started_at = container_start_times.get(container_id)
+        if started_at is not None and first_byte_at is not None:
+            self.timings["first_byte_since_vm_start"] = \
+                first_byte_at - started_at
+
+        self.logger.info(
+            "Bootstrapper in VM with CTID %d was ready after %.3fs, first "
+            "byte after %s.", container_id, self.timings["connect"],
+            "%.3fs" % self.timings["first_byte"]
+                if "first_byte" in self.timings else "never"
+        )
+
     def run_test(self, container_id, test_request):
         self.logger.debug("Running test with VM with CTID %d.", container_id)
 
+        self.timings = {}
+
         try:
             # Mark container as dirty before we do anything at all
             pyvz.set_attribute(container_id, "description", "galah-vm: dirty")
@@ -169,17 +458,10 @@ class Consumer:
 
         try:
             # Figure out where the user's testables are stored
-            testable_directory = os.path.join(
-                config["SUBMISSION_DIRECTORY"],
-                test_request["submission"]["assignment"],
-                test_request["submission"]["user"],
-                test_request["submission"]["id"]
-            )
+            testable_directory = get_testables_directory(test_request)
 
             # Figure out where the test harness is
-            harness_directory = os.path.join(
-                config["HARNESS_DIRECTORY"], test_request["test_harness"]["id"]
-            )
+            harness_directory = get_harness_directory(test_request)
 
             self.logger.debug(
                 "Injecting testables at '%s' and harness at '%s'." %
@@ -195,50 +477,33 @@ class Consumer:
                     )
                 )
 
-            # Inject file into VM from the testables location
-            pyvz.inject_file(
-                container_id, testable_directory, config["VM_TESTABLES_DIRECTORY"]
+            # The files are injected while the bootstrapper starts up, the
+            # bootstrapper doesn't touch them until we send it the test
+            # request.
+            injection = Background(
+                self._inject_files, container_id, test_request,
+                testable_directory, harness_directory
             )
 
-            # Ditto from the test harness's location
-            pyvz.inject_file(container_id, harness_directory, config["VM_HARNESS_DIRECTORY"])
-
-            # Inject bootstrapper (which is responsible for running inside of
-            # the virtual machine with root privelages and starting up the test
-            # harness while communicating with us).
-            self.logger.debug(
-                "Running bootstrapper at '%s'." % config["BOOTSTRAPPER"]
-            )
-            pyvz.inject_file(container_id, config["BOOTSTRAPPER"], "/tmp/")
-            pyvz.run_script(
-                container_id,
-                os.path.join("/tmp/", os.path.basename(config["BOOTSTRAPPER"]))
-            )
-
-            # Bind to a good ole' fashioned tcp socket and wait for the
-            # bootstrapper to connect to us.
-            bootstrapper = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            bootstrapper.setblocking(1)
-            bootstrapper.settimeout(60)
+            try:
+                # Inject bootstrapper (which is responsible for running inside
+                # of the virtual machine with root privelages and starting up
+                # the test harness while communicating with us).
+                self.logger.debug(
+                    "Running bootstrapper at '%s'." % config["BOOTSTRAPPER"]
+                )
+                pyvz.inject_file(container_id, config["BOOTSTRAPPER"], "/tmp/")
 
-            # Try to connect to the bootstrapper
-            deadline = time.time() + 30
-            while time.time() <= deadline:
-                try:
-                    bootstrapper.connect(
-                        ("%s.%d" % (config["VM_SUBNET"], container_id), config["VM_PORT"])
-                    )
+                launched_at = time.time()
+                bootstrapper = self._start_bootstrapper(container_id)
+                connected_at = time.time()
+            except:
+                # Never let the injection outlive the container, but don't let
+                # it hide why we couldn't start the bootstrapper either.
+                injection.wait()
+                raise
 
-                    self.logger.debug(
-                        "Connected to %s.%d:%d.",
-                        config["VM_SUBNET"], container_id, config["VM_PORT"]
-                    )
-
-                    break
-                except socket.error:
-                    time.sleep(0.1)
-            else:
-                raise RuntimeError("Could not connect to bootstrapper.")
+            self.timings["inject"] = injection.result()
 
             # TODO: Bring this out of the virtual suite. Plz.
             prepared_request = PreparedTestRequest(
@@ -249,7 +514,12 @@ class Consumer:
                 harness_directory = config["VM_HARNESS_DIRECTORY"],
                 suite_specific = {
                     "vz/uid": config["TESTUSER_UID"],
-                    "vz/gid": config["TESTUSER_GID"]
+                    "vz/gid": config["TESTUSER_GID"],
+                    "vz/max_result_size": config["MAX_RESULT_SIZE"],
+                    "vz/max_log_size":
+                        max(config["MAX_LOG_SIZE"], config["MAX_SPILL_SIZE"])
+                            if config["LOG_SPILL_DIRECTORY"] else
+                                config["MAX_LOG_SIZE"]
                 }
             )
             prepared_request.update_actions()
@@ -261,39 +531,117 @@ class Consumer:
             )
 
             # Chuck the test request at the bootstrapper
+            sent_at = time.time()
             bootstrapper.send(json.dumps(prepared_request))
             bootstrapper.shutdown(socket.SHUT_WR)
 
+            spill_path = None
+            if config["LOG_SPILL_DIRECTORY"]:
+                spill_path = os.path.join(
+                    config["LOG_SPILL_DIRECTORY"],
+                    "%s.log" % test_request["submission"]["id"]
+                )
+
+            channel = ResultChannel(
+                max_result_size = config["MAX_RESULT_SIZE"],
+                max_log_size = config["MAX_LOG_SIZE"],
+                spill_path = spill_path,
+                max_spill_size = config["MAX_SPILL_SIZE"]
+            )
+
+            first_byte_at = None
             try:
-                # Receive test results from the VM
+                # Receive test results from the VM, parsing them as they
+                # arrive.
                 self.logger.debug("Waiting for test results from bootstrapper.")
-                results = []
-                while True:
-                    received = bootstrapper.recv(4096)
+                try:
+                    while True:
+                        received = bootstrapper.recv(4096)
 
-                    if not received:
-                        break
+                        if not received:
+                            break
 
-                    results.append(received)
-                results = "".join(results)
+                        if first_byte_at is None:
+                            first_byte_at = time.time()
 
-                self.logger.debug("Test results received %s.", results)
+                        channel.feed(received)
+                finally:
+                    channel.close()
             except socket.timeout:
                 self.logger.debug("Bootstrapper timed out")
 
+                return None
+            except ProtocolError as e:
+                self.logger.info("Bootstrapper sent bad frame: %s", str(e))
+
+                return None
+            finally:
+                self.timings["run"] = time.time() - sent_at
+
+                self._bootstrapper_timings(
+                    container_id, launched_at, connected_at, first_byte_at
+                )
+
+            self.logger.debug(
+                "Test harness exited with %s and logged (%d bytes%s): %s",
+                str(channel.returncode), channel.log_size,
+                ", truncated" if channel.log_truncated else "", channel.log
+            )
+
+            if channel.spilled_to:
+                self.logger.info(
+                    "Test harness log too large, spilled to %s.",
+                    channel.spilled_to
+                )
+
+            if channel.timed_out:
+                self.logger.info(
+                    "Test harness timed out, partial output was: %s",
+                    channel.result
+                )
+
+                return timed_out_result(
+                    channel.result, channel.log, channel.resources,
+                    config["MAX_PARTIAL_OUTPUT_SIZE"]
+                )
+
+            if channel.result_truncated:
+                self.logger.info(
+                    "Test harness gave %d bytes of output, more than "
+                    "MAX_RESULT_SIZE (%d).",
+                    channel.result_size, config["MAX_RESULT_SIZE"]
+                )
+
                 return None
 
             try:
-                return json.loads(results)
+                result = json.loads(channel.result)
             except ValueError:
-                self.logger.info("Test harness gave bad output: %s", results)
+                self.logger.info(
+                    "Test harness gave bad output: %s", channel.result
+                )
                 return None
+
+            if isinstance(result, dict) and channel.resources:
+                result["resources"] = channel.resources
+
+            return result
         finally:
-            self.logger.debug("Destroying VM with CTID %d" % container_id)
+            teardown_started_at = time.time()
+            self.destroy_machine(container_id)
+            self.timings["teardown"] = time.time() - teardown_started_at
 
-            try:
-                pyvz.extirpate_container(container_id)
-            except SystemError:
-                self.logger.critical(
-                    "Could not destroy container with container_id %s.", str(container_id)
-                )
+    def destroy_machine(self, container_id):
+        "Destroys a container, whether or not a test was run in it."
+
+        container_start_times.pop(container_id, None)
+        staged_harnesses.pop(container_id, None)
+
+        self.logger.debug("Destroying VM with CTID %d" % container_id)
+
+        try:
+            pyvz.extirpate_container(container_id)
+        except SystemError:
+            self.logger.critical(
+                "Could not destroy container with container_id %s.", str(container_id)
+            )
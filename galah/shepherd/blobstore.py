@@ -0,0 +1,287 @@
+"""
+Serves submissions and test harnesses to sheep that do not share a filesystem
+with the web server.
+
+A directory is packed into a tarball (a "blob") when a test request that needs
+it is dispatched. The sheep is told the blob's id, size, and SHA-1 digest in
+the test request and then fetches it in chunks over the flock protocol using
+"fetch" messages, each of which is answered with a "chunk" message.
+
+Blobs are named after the directory they were made from and a fingerprint of
+its contents, so they never go stale and an interrupted download can be
+resumed even if the shepherd restarts in the meantime.
+
+Packing a blob can take a while, so a BlobPreparer does it in background
+threads as soon as a test request arrives, keeping the shepherd's main loop
+free to handle other messages.
+
+"""
+
+import os
+import os.path
+import hashlib
+import tarfile
+import tempfile
+import base64
+import threading
+import Queue
+import logging
+import zmq
+
+logger = logging.getLogger("galah.shepherd.blobstore")
+
+class BlobStore:
+    def __init__(self, directory, budget, max_chunk_size):
+        """
+        directory is where the blobs will be stored, it will be created if it
+        does not exist. budget is the maximum number of bytes the blobs may use
+        in total, if None blobs will never be deleted. No chunk larger than
+        max_chunk_size bytes will be served.
+
+        """
+
+        self.directory = directory
+        self.budget = budget
+        self.max_chunk_size = max_chunk_size
+
+        # Maps blob ids to (size, digest) tuples.
+        self._blobs = {}
+
+        # Held while evicting, as blobs may be prepared by several threads.
+        self._evict_lock = threading.Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Throw away any blobs that were being built when we last died.
+        for i in os.listdir(self.directory):
+            if i.endswith(".partial"):
+                os.remove(os.path.join(self.directory, i))
+
+    @staticmethod
+    def _fingerprint(source):
+        fingerprint = hashlib.sha1()
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+
+            for i in sorted(dirnames + filenames):
+                path = os.path.join(dirpath, i)
+                stat = os.lstat(path)
+                fingerprint.update(
+                    "%s\0%d\0%d\0%f\0" % (
+                        os.path.relpath(path, source), stat.st_mode,
+                        stat.st_size, stat.st_mtime
+                    )
+                )
+
+        return fingerprint.hexdigest()
+
+    def _path(self, blob_id):
+        # Blob ids come from the sheep, make sure they can't escape the blob
+        # directory.
+        if not blob_id or os.path.basename(blob_id) != blob_id or \
+                blob_id.startswith("."):
+            raise KeyError(blob_id)
+
+        return os.path.join(self.directory, blob_id + ".tar")
+
+    def _describe(self, blob_id):
+        "Returns the size and digest of an existing blob."
+
+        if blob_id not in self._blobs:
+            path = self._path(blob_id)
+
+            digest = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(64 * 1024), ""):
+                    digest.update(chunk)
+
+            self._blobs[blob_id] = (os.path.getsize(path), digest.hexdigest())
+
+        return self._blobs[blob_id]
+
+    def prepare(self, kind, name, source):
+        """
+        Makes sure a blob of the directory at source exists and returns a
+        dictionary describing it that can be given to a sheep.
+
+        kind and name identify the directory, for example "harness" and the
+        test harness's id.
+
+        """
+
+        blob_id = "%s-%s-%s" % (kind, name, BlobStore._fingerprint(source))
+        path = self._path(blob_id)
+
+        if os.path.isfile(path):
+            # Mark the blob as recently used so it is evicted last.
+            os.utime(path, None)
+        else:
+            fd, temp_path = tempfile.mkstemp(
+                suffix = ".partial", dir = self.directory
+            )
+            os.close(fd)
+
+            try:
+                archive = tarfile.open(temp_path, "w")
+                try:
+                    archive.add(source, arcname = ".")
+                finally:
+                    archive.close()
+
+                os.rename(temp_path, path)
+            except:
+                os.remove(temp_path)
+                raise
+
+            with self._evict_lock:
+                self._evict(keep = path)
+
+        size, digest = self._describe(blob_id)
+
+        return {"id": blob_id, "size": size, "digest": digest}
+
+    def touch(self, blob_id):
+        """
+        Marks a blob as recently used. Returns False if it no longer exists
+        (it may have been evicted since it was prepared).
+
+        """
+
+        try:
+            os.utime(self._path(blob_id), None)
+        except (KeyError, OSError):
+            return False
+
+        return True
+
+    def read(self, blob_id, offset, length):
+        """
+        Returns a chunk of a blob as a dictionary suitable for the body of a
+        "chunk" message. Raises KeyError if there is no such blob.
+
+        """
+
+        path = self._path(blob_id)
+        length = min(length, self.max_chunk_size)
+
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read(length)
+        except IOError:
+            raise KeyError(blob_id)
+
+        return {
+            "blob": blob_id,
+            "offset": offset,
+            "data": base64.b64encode(data),
+            "sha1": hashlib.sha1(data).hexdigest()
+        }
+
+    def _evict(self, keep):
+        "Deletes the least recently used blobs until we are within budget."
+
+        if self.budget is None:
+            return
+
+        blobs = []
+        for i in os.listdir(self.directory):
+            path = os.path.join(self.directory, i)
+            if not i.endswith(".tar") or path == keep:
+                continue
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            blobs.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in blobs) + os.path.getsize(keep)
+
+        blobs.sort()
+        while total > self.budget and blobs:
+            _, size, path = blobs.pop(0)
+
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Could not evict %s: %s.", path, str(e))
+                continue
+
+            self._blobs.pop(os.path.basename(path)[:-len(".tar")], None)
+            total -= size
+
+class BlobPreparer:
+    def __init__(self, blob_store, context, nworkers):
+        """
+        Prepares blobs in the given store using nworkers background threads.
+        The socket attribute becomes readable whenever a job finishes, so it
+        can be waited on along with other zmq sockets. context is the zmq
+        context to make sockets in.
+
+        """
+
+        self.blob_store = blob_store
+        self._context = context
+
+        self._jobs = Queue.Queue()
+        self._finished = Queue.Queue()
+
+        # The workers have no other way of waking up a thread blocked on
+        # zmq.select, so they poke it through this socket.
+        self._address = "inproc://blob-preparer-%d" % id(self)
+        self.socket = context.socket(zmq.PULL)
+        self.socket.bind(self._address)
+
+        for i in xrange(nworkers):
+            worker = threading.Thread(
+                target = self._work, name = "blob-preparer-%d" % i
+            )
+            worker.daemon = True
+            worker.start()
+
+    def put(self, key, blobs):
+        """
+        Prepares blobs, a dictionary mapping names to (kind, name, source)
+        tuples as given to BlobStore.prepare(). finished() will eventually
+        return key along with a dictionary mapping the same names to the blobs'
+        descriptions, or None if they could not be prepared.
+
+        """
+
+        self._jobs.put((key, blobs))
+
+    def _work(self):
+        signal = self._context.socket(zmq.PUSH)
+        signal.connect(self._address)
+
+        while True:
+            key, blobs = self._jobs.get()
+
+            try:
+                prepared = dict(
+                    (name, self.blob_store.prepare(*args))
+                        for name, args in blobs.items()
+                )
+            except Exception:
+                logger.exception("Could not prepare blobs %s.", str(blobs))
+
+                prepared = None
+
+            self._finished.put((key, prepared))
+            signal.send("")
+
+    def finished(self):
+        "Returns a list of (key, blobs) tuples for the jobs done so far."
+
+        while self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN != 0:
+            self.socket.recv()
+
+        finished = []
+        while True:
+            try:
+                finished.append(self._finished.get_nowait())
+            except Queue.Empty:
+                return finished
@@ -1,6 +1,7 @@
 from galah.base.prioritydict import PriorityDict
 from collections import namedtuple
 from galah.base.flockmail import InternalTestRequest
+from galah.base.utility import monotonic
 import datetime
 
 # Load Galah's configuration.
@@ -24,7 +25,9 @@ class FlockManager:
 
 		# A priority queue where sheep are ordered by the time when they last
 		# bleeted. The top of/smallest item in the priority queue is the sheep
-		# who has bleeted the farthest amount of time ago.
+		# who has bleeted the farthest amount of time ago. Times in all of the
+		# queues are monotonic() timestamps, which are much cheaper to get and
+		# compare than datetimes.
 		self._bleet_queue = PriorityDict()
 
 		# A priority queue that keeps track of how long each sheep has been
@@ -58,7 +61,7 @@ class FlockManager:
 	def _sheep_available(self, identity):
 		"""Called internally whenever a new sheep becomes available."""
 
-		sheep_environment = self._flock[identity]
+		sheep_environment = self._flock[identity].environment
 
 		for i in self._request_queue.keys()[:]:
 			if FlockManager.check_environments(i.environment, \
@@ -71,7 +74,7 @@ class FlockManager:
 
 		assert isinstance(request, InternalTestRequest)
 
-		self._request_queue[request] = datetime.datetime.now()
+		self._request_queue[request] = monotonic()
 
 		# Go through every available sheep and check to see if a match exists
 		for i in self._bleet_queue.keys():
@@ -135,7 +138,7 @@ class FlockManager:
 		# it.
 		newly_available = identity not in self._bleet_queue
 
-		self._bleet_queue[identity] = datetime.datetime.now()
+		self._bleet_queue[identity] = monotonic()
 
 		if newly_available:
 			self._sheep_available(identity)
@@ -163,7 +166,7 @@ class FlockManager:
 		del self._bleet_queue[identity]
 
 		# Make note of when the sheep started on the request
-		self._service_queue[identity] = datetime.datetime.now()
+		self._service_queue[identity] = monotonic()
 
 		self._flock[identity].servicing_request = request
 
@@ -182,6 +185,51 @@ class FlockManager:
 			k in b and b[k] == v for k, v in a.items()
 		)
 
+	def request_received_at(self, request):
+		"""
+		Returns when the given request was received if it is waiting for a
+		sheep, otherwise None.
+
+		"""
+
+		received = self._request_queue.get(request)
+		if received is None:
+			return None
+
+		return datetime.datetime.now() - \
+			datetime.timedelta(seconds = monotonic() - received)
+
+	# The most queued requests likely_next_request() will look at. It's called
+	# on every dispatch, so looking through the whole queue would make draining
+	# a large backlog quadratic.
+	LIKELY_NEXT_SCAN = 32
+
+	def likely_next_request(self, identity, exclude = None):
+		"""
+		Returns a request that has been waiting a long time that the given sheep
+		could service (ignoring exclude), or None if no such request is found.
+		This is the request the sheep is most likely to get next.
+
+		Only the oldest of the waiting requests are looked at (see
+		LIKELY_NEXT_SCAN), so None may be returned even though there's a
+		request the sheep could service further back in the queue.
+
+		"""
+
+		environment = self._flock[identity].environment
+
+		best = None
+		for received, request in \
+				self._request_queue.top(FlockManager.LIKELY_NEXT_SCAN):
+			if request is exclude or not FlockManager.check_environments(
+					request.environment, environment):
+				continue
+
+			if best is None or received < best[1]:
+				best = (request, received)
+
+		return None if best is None else best[0]
+
 	def is_sheep_managed(self, identity):
 		return identity in self._flock
 
@@ -200,18 +248,20 @@ class FlockManager:
 		lost_sheep = []
 		killed_sheep = []
 
+		now = monotonic()
+
 		# Find all the sheep who are not servicing requests but have not bleeted
 		# in awhile.
 		if self.bleet_timeout:
 			while (self._bleet_queue and self._bleet_queue.smallest().priority <
-					datetime.datetime.now() - self.bleet_timeout):
+					now - self.bleet_timeout.total_seconds()):
 				lost_sheep.append(self._bleet_queue.pop_smallest().value)
 
 		# Find all the sheep who have been servicing a single request too long.
 		if self.service_timeout:
 			while (self._service_queue and
 					self._service_queue.smallest().priority <
-					datetime.datetime.now() - self.service_timeout):
+					now - self.service_timeout.total_seconds()):
 				killed_sheep.append(self._service_queue.pop_smallest().value)
 
 		# Any lost sheep can simply be forgotten about as if they never existed.
@@ -6,11 +6,14 @@ import sys
 from galah.base.flockmail import FlockMessage, TestRequest, InternalTestRequest
 from galah.base.zmqhelpers import router_send_json, router_recv_json
 from flockmanager import FlockManager
+from blobstore import BlobStore, BlobPreparer
 from galah.db.models import (Submission, Assignment, TestHarness, TestResult,
                              User)
 from bson.objectid import ObjectId
 from bson.errors import InvalidId, InvalidDocument
+from mongoengine import OperationError
 import datetime
+import os.path
 
 # Load Galah's configuration.
 from galah.base.config import load_config
@@ -35,6 +38,37 @@ sheep.bind(config["SHEEP_SOCKET"])
 public = context.socket(zmq.DEALER)
 public.bind(config["PUBLIC_SOCKET"])
 
+# Serves files to sheep that don't share our filesystem, if enabled. The files
+# for a request are packed up by the blob preparer before the request is
+# queued.
+blob_store = None
+blob_preparer = None
+if config["TRANSFER_FILES"]:
+    blob_store = BlobStore(
+        config["BLOB_DIRECTORY"], config["BLOB_BUDGET"],
+        config["MAX_CHUNK_SIZE"]
+    )
+    blob_preparer = BlobPreparer(blob_store, context, config["BLOB_WORKERS"])
+
+# Maps queued requests to the descriptions of their blobs.
+transfers = {}
+
+def request_blobs(submission_id, test_harness_id, submission_path):
+    "Returns what the blob preparer needs to know to prepare a request's blobs."
+
+    return {
+        "testables": ("submission", str(submission_id), submission_path),
+        "harness": (
+            "harness", str(test_harness_id),
+            os.path.join(config["HARNESS_DIRECTORY"], str(test_harness_id))
+        )
+    }
+
+# Maps the ids of dispatches we're waiting on results for to information about
+# when they were made, which is stored along with the result, and which sheep
+# they were made to.
+dispatches = {}
+
 def match_found(flock_manager, sheep_identity, request):
     logger.info(
         "Sending test request for submission [%s] to sheep [%s].",
@@ -57,9 +91,57 @@ def match_found(flock_manager, sheep_identity, request):
     data = {
         "assignment": assignment.to_dict(),
         "submission": submission.to_dict(),
-        "test_harness": test_harness.to_dict()
+        "test_harness": test_harness.to_dict(),
+
+        # Identifies this particular dispatch of the request. The sheep sends
+        # it back with the result so that we only store one result for it no
+        # matter how many times the result is delivered.
+        "dispatch_id": str(ObjectId())
+    }
+
+    dispatched_at = datetime.datetime.now()
+    received_at = flock_manager.request_received_at(request)
+    dispatches[data["dispatch_id"]] = {
+        "sheep": sheep_identity,
+        "dispatched_at": dispatched_at,
+        "queue_wait": None if received_at is None else
+            (dispatched_at - received_at).total_seconds()
     }
 
+    # Let the sheep know which test harness it will probably need next so it
+    # can prepare for it while it works on this request. If nothing it could
+    # take is near the front of the queue, another submission for the same
+    # assignment is the best guess.
+    next_request = \
+        flock_manager.likely_next_request(sheep_identity, exclude = request)
+    if next_request is not None and next_request.test_harness_id is not None:
+        data["hint"] = {"test_harness": str(next_request.test_harness_id)}
+    else:
+        data["hint"] = {"test_harness": str(test_harness.id)}
+
+    # Tell the sheep what to fetch if it can't read our files itself.
+    if blob_store is not None:
+        transfer = transfers.pop(request, None)
+
+        # The blobs may have been evicted while the request was waiting, in
+        # which case there's nothing for it but to make them again now.
+        if transfer is None or \
+                not all(blob_store.touch(i["id"]) for i in transfer.values()):
+            logger.info(
+                "Blobs for submission [%s] are gone, preparing them again.",
+                str(submission.id)
+            )
+
+            transfer = dict(
+                (name, blob_store.prepare(*args)) for name, args in
+                    request_blobs(
+                        submission.id, test_harness.id,
+                        submission.getFilePath()
+                    ).items()
+            )
+
+        data["transfer"] = transfer
+
     router_send_json(
         sheep,
         sheep_identity,
@@ -77,9 +159,32 @@ def main():
 
     logger.info("Shepherd starting.")
 
+    # The number of results we've received for dispatches we already have a
+    # result for.
+    duplicate_results = 0
+
+    sockets = [public, sheep]
+    if blob_preparer is not None:
+        sockets.append(blob_preparer.socket)
+
     while True:
-        # Wait until either the public or sheep socket has messages waiting
-        zmq.select([public, sheep], [], [], timeout = 5)
+        # Wait until either the public or sheep socket has messages waiting,
+        # or the blob preparer has finished with a request.
+        zmq.select(sockets, [], [], timeout = 5)
+
+        # Requests are only queued up once their files are ready to be sent.
+        if blob_preparer is not None:
+            for request, transfer in blob_preparer.finished():
+                if transfer is None:
+                    logger.error(
+                        "Dropping test request for submission [%s], its "
+                        "files could not be prepared.",
+                        str(request.submission_id)
+                    )
+                    continue
+
+                transfers[request] = transfer
+                flock.received_request(request)
 
         # Will grab all of the outstanding messages from the outside and place them
         # in the request queue
@@ -142,12 +247,22 @@ def main():
                 submission.id,
                 test_harness.config.get("galah/timeout",
                     config["BLEET_TIMEOUT"].seconds),
-                test_harness.config.get("galah/environment", {})
+                test_harness.config.get("galah/environment", {}),
+                test_harness.id
             )
 
             logger.info("Received test request.")
 
-            flock.received_request(processed_request)
+            if blob_preparer is not None:
+                blob_preparer.put(
+                    processed_request,
+                    request_blobs(
+                        submission.id, test_harness.id,
+                        submission.getFilePath()
+                    )
+                )
+            else:
+                flock.received_request(processed_request)
 
 
         # Will grab all of the outstanding messages from the sheep and process them
@@ -211,6 +326,28 @@ def main():
                     logger.warn(
                         "Received environment from an already-recognized sheep."
                     )
+            elif sheep_message.type == "fetch":
+                try:
+                    chunk = blob_store.read(
+                        sheep_message.body["blob"],
+                        int(sheep_message.body["offset"]),
+                        int(sheep_message.body["length"])
+                    )
+                except (KeyError, ValueError, TypeError, AttributeError):
+                    logger.warn(
+                        "Sheep [%s] requested an unknown blob: %s",
+                        repr(sheep_identity), str(sheep_message.body)
+                    )
+
+                    chunk = {
+                        "blob": sheep_message.body.get("blob"),
+                        "offset": sheep_message.body.get("offset"),
+                        "error": "Unknown blob."
+                    }
+
+                router_send_json(
+                    sheep, sheep_identity, FlockMessage("chunk", chunk).to_dict()
+                )
             elif sheep_message.type == "result":
                 logger.info("Received test result from sheep.")
                 logger.debug(
@@ -218,34 +355,77 @@ def main():
                     str(sheep_message.body)
                 )
 
+                dispatch_id = sheep_message.body.get("dispatch_id")
+
+                # Add our side of the story to the sheep's timings.
+                timings = sheep_message.body.get("timings")
+                if not isinstance(timings, dict):
+                    timings = sheep_message.body["timings"] = {}
+
+                dispatch = dispatches.pop(dispatch_id, None)
+                timings["received_at"] = datetime.datetime.now()
+                if dispatch is not None:
+                    timings["dispatched_at"] = dispatch["dispatched_at"]
+                    timings["queue_wait"] = dispatch["queue_wait"]
+                    timings["service"] = (
+                        timings["received_at"] - dispatch["dispatched_at"]
+                    ).total_seconds()
+
                 try:
                     submission_id = ObjectId(sheep_message.body["id"])
 
                     submission = Submission.objects.get(id = submission_id)
 
-                    test_result = TestResult.from_dict(sheep_message.body)
-                    try:
-                        test_result.save()
-                    except InvalidDocument:
-                        logger.warn(
-                            "Test result is too large for the database.",
-                            exc_info = True
+                    # The first result for a dispatch wins, any others are
+                    # redeliveries and are only acknowledged.
+                    duplicate = dispatch_id is not None and \
+                        TestResult.objects(dispatch_id = dispatch_id).count()
+
+                    if not duplicate:
+                        test_result = TestResult.from_dict(sheep_message.body)
+                        try:
+                            test_result.save()
+                        except InvalidDocument:
+                            logger.warn(
+                                "Test result is too large for the database.",
+                                exc_info = True
+                            )
+                            test_result = TestResult(
+                                failed = True, dispatch_id = dispatch_id,
+                                timings = timings
+                            )
+                            test_result.save()
+                        except OperationError:
+                            # Someone beat us to it, but only if there really
+                            # is a result for this dispatch. Results without
+                            # a dispatch id can't be told apart, so whatever
+                            # went wrong must not be mistaken for that.
+                            if dispatch_id is None or not TestResult.objects(
+                                    dispatch_id = dispatch_id).count():
+                                raise
+
+                            duplicate = True
+
+                    if duplicate:
+                        duplicate_results += 1
+                        logger.info(
+                            "Ignoring duplicate result for dispatch [%s] from "
+                            "sheep [%s]. %d duplicate results received so far.",
+                            dispatch_id, repr(sheep_identity), duplicate_results
                         )
-                        test_result = TestResult(failed = True)
-                        test_result.save()
-
-                    submission.test_results = test_result.id
-                    submission.save()
+                    else:
+                        submission.test_results = test_result.id
+                        submission.save()
                 except (InvalidId, Submission.DoesNotExist) as e:
+                    # The result can never be stored, but it's still
+                    # acknowledged so the sheep doesn't keep redelivering it.
                     logger.warn(
                         "Could not retrieve submission [%s] for test result "
-                        "received from sheep [%s].",
-                        str(submission_id),
+                        "received from sheep [%s], dropping the result.",
+                        str(sheep_message.body["id"]),
                         repr(sheep_identity)
                     )
 
-                    continue
-
                 router_send_json(
                     sheep,
                     sheep_identity,
@@ -278,5 +458,19 @@ def main():
                 str([repr(i) for i in killed_sheep])
             )
 
+        # Forget about dispatches we'll likely never hear about again, those
+        # made to sheep we've lost and those whose results are long overdue.
+        # Results that do show up later are still stored, just without our
+        # timings.
+        cutoff = None
+        if config["SERVICE_TIMEOUT"]:
+            cutoff = datetime.datetime.now() - config["SERVICE_TIMEOUT"] * 2
+
+        lost_sheep = set(lost_sheep)
+        for k, v in dispatches.items():
+            if v["sheep"] in lost_sheep or \
+                    (cutoff is not None and v["dispatched_at"] < cutoff):
+                del dispatches[k]
+
 if __name__ == "__main__":
     main()
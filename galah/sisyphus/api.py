@@ -1,4 +1,6 @@
 import zmq
+import datetime
+from bson import ObjectId
 
 context = zmq.Context()
 
@@ -32,4 +34,41 @@ def send_task(sisyphus_host, task_name, *args, **kwargs):
         # Forcibly close the socket.
         socket.close(0)
 
+def get_task_status(result_id):
+    """
+    Returns a dictionary describing the progress of the task creating the
+    Archive or CSV with the given id, or None if there's no such task. It has
+    the task's status (one of queued, running, done, or failed), how many
+    attempts have been made at it, when it was enqueued_at and started_at, the
+    error_string of the last failed attempt, and if it's queued, how many
+    tasks are ahead of it.
+
+    """
+
+    # Imported here so that sending tasks doesn't require a database.
+    from galah.db.models import SisyphusTask
+
+    task = SisyphusTask.objects(result_ids = ObjectId(result_id)) \
+        .order_by("-enqueued_at").first()
+
+    if task is None:
+        return None
+
+    status = {
+        "status": task.status,
+        "attempts": task.attempts,
+        "enqueued_at": task.enqueued_at,
+        "started_at": task.started_at,
+        "error_string": task.error_string
+    }
+
+    if task.status == "queued":
+        status["tasks_ahead"] = SisyphusTask.objects(
+            status = "queued",
+            run_after__lte = datetime.datetime.today(),
+            enqueued_at__lt = task.enqueued_at
+        ).count()
+
+    return status
+
 #print send_task("ipc:///tmp/sisyphus.sock", "test_task", "hi")
@@ -0,0 +1,153 @@
+"""
+Deletes archives and CSV files once they expire, along with the documents
+describing them, and any file left in their directories without a document.
+
+Expired documents are found through the index on their expires field and are
+deleted a batch at a time, pausing between batches so a large backlog doesn't
+swamp the database or the disk. Every file in the archive and CSV directories
+is named after the document it belongs to, so a file whose document is gone
+(because whatever was making it died, or its document was deleted by hand) is
+removed too once it's old enough that nothing could still be working on it.
+
+"""
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+import datetime
+import logging
+import errno
+import time
+import os.path
+import os
+
+logger = logging.getLogger("galah.sisyphus.janitor")
+
+class Janitor:
+    def __init__(self, directories, batch_size, batch_delay, orphan_age):
+        """
+        directories is a list of (model, directory) tuples, giving the kind of
+        document (Archive or CSV) whose files are kept in each directory.
+        batch_size is the most documents or files dealt with at once and
+        batch_delay (a timedelta) is how long to wait between batches. Files
+        without a document are only removed once they haven't been touched
+        for orphan_age (also a timedelta).
+
+        """
+
+        self.directories = directories
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.orphan_age = orphan_age
+
+    def run(self):
+        "Cleans up everything that's expired or orphaned."
+
+        for model, directory in self.directories:
+            self.delete_expired(model)
+            self.delete_orphans(model, directory)
+
+    def delete_expired(self, model):
+        "Deletes the expired documents of the given kind and their files."
+
+        now = datetime.datetime.today()
+
+        deleted = 0
+        while True:
+            expired = list(
+                model.objects(expires__lt = now)
+                    .only("id", "file_location").limit(self.batch_size)
+            )
+
+            # The files go first so that if we die part way through the
+            # documents are still around to find them next time.
+            for i in expired:
+                if i.file_location:
+                    self._remove(i.file_location)
+
+            if expired:
+                model.objects(id__in = [i.id for i in expired]).delete()
+                deleted += len(expired)
+
+            if len(expired) < self.batch_size:
+                break
+
+            self._pause()
+
+        if deleted:
+            logger.info(
+                "Deleted %d expired %s documents.", deleted, model.__name__
+            )
+
+    def delete_orphans(self, model, directory):
+        """
+        Removes the files in directory that are named after a document of the
+        given kind that doesn't exist.
+
+        """
+
+        if not os.path.isdir(directory):
+            return
+
+        cutoff = time.time() - self.orphan_age.total_seconds()
+
+        # Maps the ids of the documents the old enough files belong to to the
+        # files' paths.
+        candidates = {}
+        for i in os.listdir(directory):
+            # Anything not named after a document isn't ours, so leave it be.
+            # ObjectId would also take any 12 byte name.
+            name = os.path.splitext(i)[0]
+            if len(name) != 24:
+                continue
+
+            try:
+                document_id = ObjectId(name)
+            except InvalidId:
+                continue
+
+            path = os.path.join(directory, i)
+
+            # The change time is used as linking a file to a new name (as is
+            # done with cached archives) doesn't touch its modification time.
+            try:
+                if os.stat(path).st_ctime >= cutoff:
+                    continue
+            except OSError:
+                continue
+
+            candidates[document_id] = path
+
+        ids = candidates.keys()
+        removed = 0
+        for start in xrange(0, len(ids), self.batch_size):
+            if start:
+                self._pause()
+
+            batch = ids[start:start + self.batch_size]
+            existing = set(
+                i.id for i in model.objects(id__in = batch).only("id")
+            )
+
+            for i in batch:
+                if i not in existing:
+                    self._remove(candidates[i])
+                    removed += 1
+
+        if removed:
+            logger.info(
+                "Removed %d files without a document from %s.", removed,
+                directory
+            )
+
+    def _pause(self):
+        time.sleep(self.batch_delay.total_seconds())
+
+    def _remove(self, path):
+        # Documents shared between requesters point at the same file, so it
+        # may well be gone already.
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Could not remove %s: %s.", path, str(e))
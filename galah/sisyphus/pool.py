@@ -0,0 +1,247 @@
+"""
+The pool of workers that sisyphus runs tasks with.
+
+Every kind of task has its own queue and lane settings, which say whether the
+task runs in one of the worker threads (good for tasks that mostly wait on the
+database) or in a separate process started by a worker thread (good for CPU
+heavy tasks, or tasks that do process-wide things like changing directory),
+how many tasks of that kind may run at once, and the task's priority. Whenever
+a worker is free it takes the oldest task out of the highest priority queue
+whose concurrency limit hasn't been reached. Some workers can be reserved for
+only the highest priority tasks so that quick tasks never wait behind long
+ones.
+
+"""
+
+import collections
+import subprocess
+import threading
+import logging
+import os.path
+import json
+import time
+import sys
+
+logger = logging.getLogger("galah.sisyphus.pool")
+
+class TaskError(Exception):
+    "Raised when a task run in a child process fails."
+
+    pass
+
+# The script that runs a single task in a child process.
+RUNTASK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "runtask.py")
+
+def run_in_process(name, args, kwargs):
+    """
+    Runs the named task in a fresh Python interpreter and waits for it to
+    finish. Raises TaskError if the task fails.
+
+    A new interpreter is used rather than forking because forking a process
+    with other threads running can leave locks (such as the logging module's)
+    held forever in the child, and the child could not use our connection to
+    the database anyway.
+
+    """
+
+    process = subprocess.Popen(
+        [sys.executable, RUNTASK_PATH], stdin = subprocess.PIPE,
+        close_fds = True
+    )
+    process.communicate(
+        json.dumps({"task_name": name, "args": args, "kwargs": kwargs})
+    )
+
+    if process.returncode != 0:
+        raise TaskError(
+            "Task process exited with status %d." % process.returncode
+        )
+
+class WorkerPool:
+    def __init__(self, task_list, lanes, default_lane, nworkers,
+            npriority_workers = 0):
+        """
+        task_list maps task names to the functions that perform them. lanes
+        maps task names to dictionaries with any of the keys "lane" ("thread"
+        or "process"), "concurrency", and "priority" (lower runs first), with
+        default_lane providing anything that's missing.
+
+        nworkers workers will run any task and npriority_workers more will only
+        run tasks with the highest priority of any lane.
+
+        """
+
+        self.task_list = task_list
+        self.nworkers = nworkers
+        self.npriority_workers = npriority_workers
+
+        self.lanes = {}
+        for name in task_list:
+            self.lanes[name] = dict(default_lane)
+            self.lanes[name].update(lanes.get(name, {}))
+
+        self.top_priority = min(
+            [i["priority"] for i in self.lanes.values()] or [0]
+        )
+
+        # Maps task names to deques of (enqueued_at, task) tuples.
+        self._queues = dict((i, collections.deque()) for i in task_list)
+
+        # Maps task names to the number of those tasks currently running.
+        self._running = dict((i, 0) for i in task_list)
+
+        self._condition = threading.Condition()
+
+        # Maps task names to statistics on how long they waited and ran.
+        self._statistics = dict(
+            (i, {"completed": 0, "failed": 0, "total_wait": 0.0,
+                 "max_wait": 0.0, "total_run": 0.0})
+                for i in task_list
+        )
+
+        self._threads = []
+
+    def start(self):
+        for i in xrange(self.nworkers + self.npriority_workers):
+            if i < self.nworkers:
+                max_priority = None
+                name = "worker-%d" % i
+            else:
+                max_priority = self.top_priority
+                name = "priority-worker-%d" % (i - self.nworkers)
+
+            thread = threading.Thread(
+                name = name, target = self._worker, args = (max_priority, )
+            )
+            thread.daemon = True
+            thread.start()
+
+            self._threads.append(thread)
+
+    def put(self, task):
+        "Queues a task, which must have name, args, and kwargs attributes."
+
+        with self._condition:
+            self._queues[task.name].append((time.time(), task))
+            self._condition.notify_all()
+
+    def _choose(self, max_priority):
+        "Returns the name of the task to run next, or None. Must hold the lock."
+
+        best = None
+        for name, queue in self._queues.items():
+            lane = self.lanes[name]
+
+            if not queue or self._running[name] >= lane["concurrency"]:
+                continue
+
+            if max_priority is not None and lane["priority"] > max_priority:
+                continue
+
+            candidate = (lane["priority"], queue[0][0], name)
+            if best is None or candidate < best:
+                best = candidate
+
+        return None if best is None else best[2]
+
+    def _next(self, max_priority):
+        "Blocks until there is a task to run, then returns it."
+
+        with self._condition:
+            while True:
+                name = self._choose(max_priority)
+                if name is not None:
+                    break
+
+                self._condition.wait()
+
+            enqueued_at, task = self._queues[name].popleft()
+            self._running[name] += 1
+
+            return task, time.time() - enqueued_at
+
+    def _worker(self, max_priority):
+        while True:
+            task, wait = self._next(max_priority)
+            lane = self.lanes[task.name]
+
+            logger.info(
+                "Starting task %s after waiting %.1f seconds in the queue.",
+                task.name, wait
+            )
+
+            start_time = time.time()
+            succeeded = False
+            try:
+                self.run(task, lane)
+                succeeded = True
+            except Exception as e:
+                if type(e) is TypeError and \
+                        str(e).startswith("%s()" % task.name):
+                    logger.error("Task with bad parameters: %s", str(task))
+                else:
+                    logger.warning(
+                        "Exception in task %s.", task.name,
+                        exc_info = sys.exc_info()
+                    )
+            finally:
+                with self._condition:
+                    self._running[task.name] -= 1
+
+                    statistics = self._statistics[task.name]
+                    statistics["completed" if succeeded else "failed"] += 1
+                    statistics["total_wait"] += wait
+                    statistics["max_wait"] = max(statistics["max_wait"], wait)
+                    statistics["total_run"] += time.time() - start_time
+
+                    self._condition.notify_all()
+
+    def run(self, task, lane):
+        "Runs a task in the given lane and waits for it to finish."
+
+        if lane["lane"] == "process":
+            run_in_process(task.name, task.args, task.kwargs)
+        else:
+            self.task_list[task.name](*task.args, **task.kwargs)
+
+    def statistics(self):
+        """
+        Returns a dictionary mapping task names to dictionaries of statistics
+        on them: how many are queued and running, how many have completed or
+        failed, and the mean and maximum number of seconds they waited in the
+        queue.
+
+        """
+
+        with self._condition:
+            result = {}
+            for name, statistics in self._statistics.items():
+                finished = statistics["completed"] + statistics["failed"]
+                result[name] = {
+                    "queued": len(self._queues[name]),
+                    "running": self._running[name],
+                    "completed": statistics["completed"],
+                    "failed": statistics["failed"],
+                    "mean_wait":
+                        statistics["total_wait"] / finished if finished else 0,
+                    "max_wait": statistics["max_wait"],
+                    "mean_run":
+                        statistics["total_run"] / finished if finished else 0
+                }
+
+            return result
+
+    def log_statistics(self):
+        for name, statistics in sorted(self.statistics().items()):
+            if not any(statistics.values()):
+                continue
+
+            logger.info(
+                "%s: %d queued, %d running, %d completed, %d failed, waited "
+                "%.1fs on average (at most %.1fs), ran %.1fs on average.",
+                name, statistics["queued"], statistics["running"],
+                statistics["completed"], statistics["failed"],
+                statistics["mean_wait"], statistics["max_wait"],
+                statistics["mean_run"]
+            )
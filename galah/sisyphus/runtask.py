@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+"""
+Runs a single sisyphus task and exits, used by sisyphus's worker pool to run
+tasks in their own process. The task is read from stdin as a JSON object of the
+same form sisyphus receives, and the exit status is non-zero if it fails.
+
+"""
+
+# Load Galah's configuration.
+from galah.base.config import load_config
+config = load_config("sisyphus")
+
+# Set up logging
+import logging
+logger = logging.getLogger("galah.sisyphus.runtask")
+
+# Connect to the mongo database
+import mongoengine
+mongoengine.connect(config["MONGODB"])
+
+from galah.sisyphus.tasks import task_list
+
+import json
+import sys
+
+def main():
+    request = json.load(sys.stdin)
+
+    try:
+        task_list[request["task_name"]](
+            *request["args"], **request["kwargs"]
+        )
+    except Exception:
+        logger.exception("Exception in task %s.", request["task_name"])
+
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,14 +13,11 @@ logger = logging.getLogger("galah.sisyphus")
 import mongoengine
 mongoengine.connect(config["MONGODB"])
 
-# Set up the queue we will store tasks in
-from Queue import Queue
 from collections import namedtuple
 Task = namedtuple("Task", ("name", "args", "kwargs"))
-task_queue = Queue()
 
 # Grab all of the tasks we know about
-from tasks import task_list
+from tasks import task_list, result_tasks
 
 # All ZMQ operations must be done within a context
 import zmq
@@ -30,25 +27,48 @@ context = zmq.Context()
 socket = context.socket(zmq.REP)
 socket.bind(config["SISYPHUS_ADDRESS"])
 
-import sys
-def consumer():
-    # Create a new logger for this consumer
-    from threading import current_thread
-    logger = logging.getLogger("galah.sisyphus." + current_thread().name)
-    
+# Set up the queue and the pool of workers that will run the tasks.
+from taskqueue import TaskQueue
+task_queue = TaskQueue(
+    task_list, config["TASK_LANES"], config["DEFAULT_TASK_LANE"],
+    config["NWORKERS"], config["NPRIORITY_WORKERS"], result_tasks,
+    config["TASK_LEASE"], config["TASK_RETRY_DELAY"],
+    config["TASK_MAX_RETRY_DELAY"], config["TASK_HISTORY_LIFETIME"]
+)
+
+# Set up the janitor that deletes expired archives and CSV files.
+from galah.db.models import Archive, CSV
+from janitor import Janitor
+janitor = Janitor(
+    [(Archive, config["ARCHIVE_DIRECTORY"]), (CSV, config["CSV_DIRECTORY"])],
+    config["JANITOR_BATCH_SIZE"], config["JANITOR_BATCH_DELAY"],
+    config["JANITOR_ORPHAN_AGE"]
+)
+
+import time
+def report_statistics():
     while True:
-        task = task_queue.get()
+        time.sleep(config["STATISTICS_INTERVAL"].total_seconds())
 
+        task_queue.log_statistics()
+
+def poll_tasks():
+    while True:
         try:
-            task_list[task.name](*task.args, **task.kwargs)
-        except Exception as e:
-            if type(e) is TypeError and str(e).startswith("%s()" % task.name):
-                logger.error("Task with bad parameters: %s", str(task))
-            else:
-                logger.warning(
-                    "Exception in task %s.", task.name,
-                    exc_info = sys.exc_info()
-                )
+            task_queue.poll()
+        except Exception:
+            logger.exception("Error polling for tasks.")
+
+        time.sleep(config["TASK_POLL_INTERVAL"].total_seconds())
+
+def clean_up():
+    while True:
+        try:
+            janitor.run()
+        except Exception:
+            logger.exception("Error cleaning up expired files.")
+
+        time.sleep(config["JANITOR_INTERVAL"].total_seconds())
 
 def to_task(request):
     # Do very explicit validation on the request so we can give better error
@@ -71,9 +91,20 @@ def to_task(request):
     )
 
 from threading import Thread
-consumer_thread = Thread(name = "consumer", target = consumer)
-consumer_thread.daemon = True
-consumer_thread.start()
+task_queue.start()
+
+# Picks up any tasks left queued from before we started, along with retries.
+poll_thread = Thread(name = "poll", target = poll_tasks)
+poll_thread.daemon = True
+poll_thread.start()
+
+janitor_thread = Thread(name = "janitor", target = clean_up)
+janitor_thread.daemon = True
+janitor_thread.start()
+
+statistics_thread = Thread(name = "statistics", target = report_statistics)
+statistics_thread.daemon = True
+statistics_thread.start()
 
 def main():
     while True:
@@ -110,8 +141,22 @@ def main():
 
             continue
 
-        # All is good, place the task in the queue
-        task_queue.put(task)
+        # All is good, save the task and place it in the queue. We only tell
+        # the requester the task was accepted once it's been saved so that it
+        # can't be lost.
+        try:
+            task_id = task_queue.add(task)
+        except Exception as e:
+            logger.exception("Could not queue task %s.", task.name)
+
+            socket.send_json({
+                "success": False,
+                "error_string": "Could not queue task: %s" % str(e)
+            })
+
+            continue
+
+        logger.info("Queued task %s as %s.", task.name, str(task_id))
 
         socket.send_json({"success": True})
 
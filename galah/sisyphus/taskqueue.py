@@ -0,0 +1,317 @@
+"""
+A worker pool whose tasks are kept in the database so that they survive
+sisyphus restarting or dying.
+
+Every task is saved as a SisyphusTask before sisyphus tells the requester it
+has been accepted. A worker claims a task by atomically moving it from queued
+to running, which takes out a lease on it that the sisyphus running it keeps
+renewing. A task that fails is queued again after a delay that doubles with
+every attempt, up to the number of attempts its lane allows, and a task whose
+lease runs out (because the sisyphus running it died) is treated as a failed
+attempt. poll() must be called periodically to renew leases and to pick up
+tasks that are due to be retried or were left behind by a dead sisyphus.
+
+A request for a task that's identical to one already queued or running (other
+than the id of the document it creates and who asked for it) is attached to
+the existing task instead of being run again. When the task finishes, every
+requester attached to it gets their own copy of the document it created,
+pointing at the same file.
+
+"""
+
+from galah.db.models import SisyphusTask
+from pool import WorkerPool
+from bson import ObjectId
+
+import datetime
+import hashlib
+import logging
+import socket
+import json
+import os
+
+logger = logging.getLogger("galah.sisyphus.taskqueue")
+
+class TaskQueue(WorkerPool):
+    def __init__(self, task_list, lanes, default_lane, nworkers,
+            npriority_workers, result_tasks, lease, retry_delay,
+            max_retry_delay, history_lifetime):
+        """
+        The first five arguments are the same as WorkerPool's, and every lane
+        may also have an "attempts" key giving the most times a task of that
+        kind will be tried. result_tasks maps the names of tasks that create a
+        document to the document's class, such tasks must take the document's
+        id and the requester's email as their first two arguments.
+
+        lease is how long a worker's claim on a task lasts without being
+        renewed by poll(). retry_delay is how long to wait before the first
+        retry (it doubles every time after), up to max_retry_delay. Finished
+        tasks are forgotten after history_lifetime. All of the times are
+        timedeltas.
+
+        """
+
+        WorkerPool.__init__(
+            self, task_list, lanes, default_lane, nworkers, npriority_workers
+        )
+
+        self.result_tasks = result_tasks
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.history_lifetime = history_lifetime
+
+        # Identifies this instance of sisyphus as the owner of the tasks it's
+        # running.
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+
+        # The ids of the tasks in our in-memory queues, so poll() doesn't
+        # queue them up a second time. Guarded by self._condition.
+        self._known = set()
+
+    def add(self, task):
+        """
+        Saves a task, which must have name, args, and kwargs attributes, and
+        queues it, unless an identical task is already queued or running in
+        which case the new one is attached to it. Returns the id of the
+        SisyphusTask that will do the work.
+
+        """
+
+        result_ids, requesters, args = [], [], task.args
+        if task.name in self.result_tasks:
+            result_ids = [ObjectId(task.args[0])]
+            requesters = [task.args[1]]
+            args = task.args[2:]
+
+        dedup_key = hashlib.sha1(
+            json.dumps([task.name, args, task.kwargs], sort_keys = True)
+        ).hexdigest()
+
+        # If the duplicate finishes between finding it and attaching to it the
+        # update won't match anything and a new task is created instead.
+        duplicate = SisyphusTask.objects(
+            dedup_key = dedup_key, status__in = ["queued", "running"]
+        ).only("id").first()
+
+        if duplicate is not None:
+            attached = not result_ids or SisyphusTask.objects(
+                id = duplicate.id, status__in = ["queued", "running"]
+            ).update(
+                push__result_ids = result_ids[0],
+                push__requesters = requesters[0]
+            )
+
+            if attached:
+                logger.info(
+                    "Attached request for task %s to identical task %s.",
+                    task.name, str(duplicate.id)
+                )
+
+                return duplicate.id
+
+        now = datetime.datetime.today()
+
+        document = SisyphusTask(
+            name = task.name,
+            args = task.args,
+            kwargs = task.kwargs,
+            result_ids = result_ids,
+            requesters = requesters,
+            dedup_key = dedup_key,
+            status = "queued",
+            enqueued_at = now,
+            run_after = now
+        )
+        document.save(force_insert = True)
+
+        self._put_new(document)
+
+        return document.id
+
+    def _put_new(self, document):
+        "Queues a document unless it's already queued."
+
+        with self._condition:
+            if document.id in self._known:
+                return
+
+            self._known.add(document.id)
+
+        self.put(document)
+
+    def run(self, task, lane):
+        with self._condition:
+            self._known.discard(task.id)
+
+        if not self._claim(task):
+            logger.info(
+                "Task %s (%s) was already started elsewhere.",
+                str(task.id), task.name
+            )
+
+            return
+
+        try:
+            WorkerPool.run(self, task, lane)
+        except Exception as e:
+            if self._failed(task, lane, str(e)):
+                self._share_result(task)
+
+            raise
+
+        finished = SisyphusTask.objects(
+            id = task.id, status = "running", owner = self.owner
+        ).update(
+            set__status = "done",
+            set__finished_at = datetime.datetime.today(),
+            unset__owner = 1,
+            unset__lease_expires = 1
+        )
+
+        if finished:
+            self._share_result(task)
+
+    def _share_result(self, task):
+        """
+        Gives every requester attached to a finished task a copy of the
+        document it created.
+
+        """
+
+        model = self.result_tasks.get(task.name)
+        if model is None:
+            return
+
+        # Nothing more can be attached now that the task is finished, so this
+        # gets all of them.
+        task.reload()
+
+        original = model.objects(id = task.result_ids[0]).first()
+        if original is None:
+            return
+
+        attached = zip(task.result_ids, task.requesters)[1:]
+        for result_id, requester in attached:
+            copy = model(**dict(
+                (i, getattr(original, i)) for i in original._fields
+                    if i != "id"
+            ))
+            copy.id = result_id
+            copy.requester = requester
+            copy.save()
+
+        if attached:
+            logger.info(
+                "Shared the result of task %s with %d other requests.",
+                str(task.id), len(attached)
+            )
+
+    def _claim(self, task):
+        "Marks a queued task as running. Returns False if it wasn't queued."
+
+        now = datetime.datetime.today()
+
+        claimed = SisyphusTask.objects(id = task.id, status = "queued").update(
+            set__status = "running",
+            set__owner = self.owner,
+            set__started_at = now,
+            set__lease_expires = now + self.lease,
+            inc__attempts = 1
+        )
+
+        if claimed:
+            task.attempts += 1
+
+        return bool(claimed)
+
+    def _failed(self, task, lane, error_string, **query):
+        """
+        Records that an attempt at a running task failed, queueing it to be
+        retried if it has any attempts left. query can add conditions on the
+        update. Returns True if the task has been given up on.
+
+        """
+
+        now = datetime.datetime.today()
+
+        query.setdefault("owner", self.owner)
+        tasks = SisyphusTask.objects(id = task.id, status = "running", **query)
+
+        if task.attempts < lane.get("attempts", 1):
+            delay = min(
+                self.retry_delay * 2 ** (task.attempts - 1),
+                self.max_retry_delay
+            )
+
+            logger.info(
+                "Retrying task %s (%s) in %s, %d attempts so far.",
+                str(task.id), task.name, str(delay), task.attempts
+            )
+
+            tasks.update(
+                set__status = "queued",
+                set__run_after = now + delay,
+                set__error_string = error_string,
+                unset__owner = 1,
+                unset__lease_expires = 1
+            )
+
+            return False
+        else:
+            logger.error(
+                "Giving up on task %s (%s) after %d attempts.",
+                str(task.id), task.name, task.attempts
+            )
+
+            return bool(tasks.update(
+                set__status = "failed",
+                set__finished_at = now,
+                set__error_string = error_string,
+                unset__owner = 1,
+                unset__lease_expires = 1
+            ))
+
+    def poll(self):
+        """
+        Renews the leases on the tasks we're running, takes back tasks whose
+        leases have run out, queues tasks that are due to run, and forgets old
+        finished tasks.
+
+        """
+
+        now = datetime.datetime.today()
+        names = self.task_list.keys()
+
+        SisyphusTask.objects(status = "running", owner = self.owner).update(
+            set__lease_expires = now + self.lease
+        )
+
+        abandoned = SisyphusTask.objects(
+            status = "running", lease_expires__lt = now, name__in = names
+        )
+        for i in abandoned:
+            logger.warning(
+                "Lease on task %s (%s) held by %s ran out.",
+                str(i.id), i.name, i.owner
+            )
+
+            gave_up = self._failed(
+                i, self.lanes[i.name],
+                "The sisyphus running the task stopped responding.",
+                owner = i.owner, lease_expires__lt = now
+            )
+
+            if gave_up:
+                self._share_result(i)
+
+        due = SisyphusTask.objects(
+            status = "queued", run_after__lte = now, name__in = names
+        ).order_by("enqueued_at")
+        for i in due:
+            self._put_new(i)
+
+        SisyphusTask.objects(
+            status__in = ["done", "failed"],
+            finished_at__lt = now - self.history_lifetime
+        ).delete()
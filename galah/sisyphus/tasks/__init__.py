@@ -11,3 +11,14 @@ task_list = {
     "create_gradebook_csv": _create_gradebook_csv,
     "rerun_test_harness": _rerun_test_harness
 }
+
+from galah.db.models import Archive, CSV
+
+# The tasks that create an Archive or CSV document, mapped to the kind of
+# document they create. Their first two arguments are always the id of the
+# document and the email of the user who requested it.
+result_tasks = {
+    "zip_bulk_submissions": Archive,
+    "create_assignment_csv": CSV,
+    "create_gradebook_csv": CSV
+}
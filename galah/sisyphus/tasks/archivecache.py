@@ -0,0 +1,360 @@
+"""
+Keeps the bulk submission archive of every assignment around after it's been
+made, so the next request for it only has to add whatever was submitted since.
+
+Each cached archive is a zip file along with an index mapping the ids of the
+submissions in it to the directories they're stored under. When an archive is
+requested again, any new submissions are appended to the cached zip file
+(which only means rewriting its central directory) rather than building the
+whole thing again. It is only rebuilt if submissions have disappeared since it
+was made.
+
+Every request gets its own hard link to the cached archive, so the cached file
+can be replaced or evicted without disturbing anybody downloading it. A cached
+archive is only added to in place if nothing else links to it, otherwise the
+additions are made to a copy. The least recently used archives are evicted
+when the cache grows past its budget, skipping any a task is working on.
+
+Several tasks, in several processes, may be using the cache at once, so files
+a task was in the middle of writing when it died are only removed once they're
+old enough that nobody could still be writing them.
+
+"""
+
+import os
+import os.path
+import json
+import shutil
+import fcntl
+import errno
+import hashlib
+import tempfile
+import datetime
+import logging
+import time
+
+from galah.base.zipstream import ZipWriter
+
+logger = logging.getLogger("galah.sisyphus.archivecache")
+
+def submission_name(submission):
+    """
+    Returns the name of the directory a submission goes in: its user's email
+    and the date it was submitted.
+
+    """
+
+    # Paths on the filesystem are byte strings, so the name must be too.
+    return os.path.join(
+        submission.user.encode("utf-8"),
+        submission.timestamp.strftime("%Y-%m-%d-%H-%M-%S")
+    )
+
+class ArchiveCache:
+    def __init__(self, directory, budget, zip_processes = 1,
+            stale_age = datetime.timedelta(hours = 1)):
+        """
+        directory is where the cached archives will be stored, it will be
+        created if it does not exist. budget is the maximum number of bytes
+        the archives may use in total, if None archives will never be
+        evicted. zip_processes is given to ZipWriter. Partially written files
+        that haven't been touched for stale_age are thrown away.
+
+        """
+
+        self.directory = directory
+        self.budget = budget
+        self.zip_processes = zip_processes
+        self.stale_age = stale_age
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _paths(self, assignment, email):
+        "Returns the paths of the zip file, index, and lock for an archive."
+
+        key = "%s-%s" % (
+            str(assignment),
+            hashlib.sha1(email.encode("utf-8")).hexdigest()[:16]
+                if email else "all"
+        )
+        base = os.path.join(self.directory, key)
+
+        return base + ".zip", base + ".json", base + ".lock"
+
+    def get(self, assignment, email, submissions, destination):
+        """
+        Makes sure the cached archive of the given assignment's submissions
+        (only those by email if it's not empty) holds exactly submissions, and
+        links it to destination.
+
+        """
+
+        zip_path, index_path, lock_path = self._paths(assignment, email)
+
+        # Only one task at a time may touch a particular archive.
+        with self._lock(lock_path):
+            index = self._load_index(zip_path, index_path)
+
+            current = set(str(i.id) for i in submissions)
+            if index is not None and not set(index) <= current:
+                logger.info(
+                    "Submissions have been removed from %s, rebuilding it.",
+                    zip_path
+                )
+
+                index = None
+
+            new = [
+                i for i in submissions
+                    if index is None or str(i.id) not in index
+            ]
+
+            if new:
+                self._add(zip_path, index_path, index, new)
+            else:
+                # Mark the archive as recently used so it is evicted last.
+                os.utime(zip_path, None)
+
+            self._link(zip_path, destination)
+
+        self._evict(keep = zip_path)
+        self._remove_stale()
+
+    def _lock(self, lock_path, blocking = True):
+        """
+        Opens and locks the given lock file and returns it. If blocking is
+        False and somebody else holds the lock, None is returned instead.
+
+        """
+
+        while True:
+            lock = open(lock_path, "a")
+
+            try:
+                fcntl.flock(
+                    lock, fcntl.LOCK_EX if blocking else
+                        fcntl.LOCK_EX | fcntl.LOCK_NB
+                )
+            except IOError as e:
+                lock.close()
+
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+
+                return None
+
+            # The lock file is removed when its archive is evicted, so make
+            # sure the one we locked is still the one everyone else will open.
+            try:
+                if os.fstat(lock.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    return lock
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    lock.close()
+                    raise
+
+            lock.close()
+
+    def _load_index(self, zip_path, index_path):
+        """
+        Returns the index of an archive, or None if there isn't a usable one.
+        An index records the size of the archive it was written for so an
+        index that doesn't match its archive can be detected.
+
+        """
+
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+
+            if index["size"] != os.path.getsize(zip_path):
+                return None
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        return index["submissions"]
+
+    def _add(self, zip_path, index_path, index, submissions):
+        """
+        Adds submissions to the archive, or builds it from scratch if index is
+        None, and writes out its new index.
+
+        """
+
+        if index is None:
+            index = {}
+            mode = "w"
+        else:
+            mode = "a"
+
+        # Add to the archive in place if nobody else is using it, otherwise
+        # make a copy and replace it when we're done.
+        in_place = mode == "a" and os.stat(zip_path).st_nlink == 1
+
+        if in_place:
+            target = zip_path
+        else:
+            fd, target = tempfile.mkstemp(
+                suffix = ".partial", dir = self.directory
+            )
+            os.close(fd)
+
+            if mode == "a":
+                shutil.copyfile(zip_path, target)
+
+        logger.info(
+            "%s %d submissions %s %s.",
+            "Adding" if mode == "a" else "Archiving", len(submissions),
+            "to" if mode == "a" else "into", zip_path
+        )
+
+        try:
+            # The names read back from an index are unicode.
+            used_names = set(
+                i.encode("utf-8") if isinstance(i, unicode) else i
+                    for i in index.values()
+            )
+            with ZipWriter(target, mode,
+                    processes = self.zip_processes) as archive:
+                for i in submissions:
+                    name = submission_name(i)
+
+                    # In the highly unlikely event that two of the same
+                    # user's submissions have the same exact time stamp,
+                    # we'll need to add a marker to the end of the timestamp.
+                    marker = 0
+                    while (name + ("-%d" % marker if marker > 0 else "")) in \
+                            used_names:
+                        marker += 1
+
+                    if marker > 0:
+                        name += "-%d" % marker
+
+                    used_names.add(name)
+                    index[str(i.id)] = name
+
+                    # Detect if the submission's files are still on the
+                    # filesystem
+                    original_path = i.getFilePath()
+                    if os.path.isdir(original_path):
+                        archive.add_directory(original_path, name)
+                    else:
+                        # Create an empty file marking the fact that a
+                        # submission existed but is no longer available.
+                        archive.add_string("", name)
+
+            if not in_place:
+                os.rename(target, zip_path)
+        except:
+            # Whatever we were writing to is no good now. If it was the
+            # cached archive itself, throwing away its index makes sure it's
+            # rebuilt next time.
+            if in_place:
+                self._remove(index_path)
+            else:
+                os.remove(target)
+
+            raise
+
+        fd, index_target = tempfile.mkstemp(
+            suffix = ".partial", dir = self.directory
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {"size": os.path.getsize(zip_path), "submissions": index}, f
+            )
+
+        os.rename(index_target, index_path)
+
+    def _link(self, zip_path, destination):
+        # An earlier attempt at the same request may have left a link behind.
+        self._remove(destination)
+
+        try:
+            os.link(zip_path, destination)
+        except OSError as e:
+            # Hard links can't cross filesystems, fall back to copying.
+            if e.errno not in (errno.EXDEV, errno.EPERM):
+                raise
+
+            shutil.copyfile(zip_path, destination)
+
+    def _evict(self, keep):
+        "Deletes the least recently used archives until we are within budget."
+
+        if self.budget is None:
+            return
+
+        archives = []
+        total = 0
+        for i in os.listdir(self.directory):
+            if not i.endswith(".zip"):
+                continue
+
+            path = os.path.join(self.directory, i)
+
+            # Another task may have evicted it since we listed the directory.
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            total += stat.st_size
+            if path != keep:
+                archives.append((stat.st_mtime, stat.st_size, path))
+
+        archives.sort()
+        while total > self.budget and archives:
+            _, size, path = archives.pop(0)
+            base = path[:-len(".zip")]
+
+            # Leave archives somebody is working on alone, they'll be
+            # considered again the next time around.
+            lock = self._lock(base + ".lock", blocking = False)
+            if lock is None:
+                continue
+
+            with lock:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        logger.warning(
+                            "Could not evict %s: %s.", path, str(e)
+                        )
+                        continue
+
+                self._remove(base + ".json")
+
+                # Removed while we still hold it, anybody waiting on it will
+                # notice and open a new one.
+                self._remove(base + ".lock")
+
+            total -= size
+
+    def _remove_stale(self):
+        "Throws away partially written files nobody is writing anymore."
+
+        cutoff = time.time() - self.stale_age.total_seconds()
+
+        for i in os.listdir(self.directory):
+            if not i.endswith(".partial"):
+                continue
+
+            path = os.path.join(self.directory, i)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+            except OSError:
+                continue
+
+            logger.info("Removing stale partial file %s.", path)
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
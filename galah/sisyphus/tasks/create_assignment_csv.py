@@ -1,11 +1,7 @@
-import shutil
-import subprocess
-import os
-import datetime
-import os.path
 from bson import ObjectId
 
-from galah.db.models import Submission, CSV, TestResult, User, Assignment
+from galah.db.models import Submission, User, Assignment
+from csvexport import write_csv, with_scores
 
 # Set up configuration and logging
 from galah.base.config import load_config
@@ -14,83 +10,41 @@ config = load_config("sisyphus")
 import logging
 logger = logging.getLogger("galah.sisyphus.create_assignment_csv")
 
-def _create_assignment_csv(csv_id, requester, assignment):
-    csv_id = ObjectId(csv_id)
-
-    csv_file = temp_directory = ""
-
-    # Find any expired archives and remove them
-    deleted_files = []
-    for i in CSV.objects(expires__lt = datetime.datetime.today()):
-        deleted_files.append(i.file_location)
+def assignment_rows(assignment):
+    """
+    Yields a row for the most recent submission of every student in the
+    assignment's class, with the student's email, the submission's score, and
+    when it was submitted.
 
-        if i.file_location:
-            try:
-                os.remove(i.file_location)
-            except OSError as e:
-                logger.warning(
-                    "Could not remove expired csv file at %s: %s.",
-                    i.file_location, str(e)
-                )
+    """
 
-        i.delete()
+    assn = Assignment.objects.get(id = ObjectId(assignment))
 
-    if deleted_files:
-        logger.info("Deleted csv files %s.", str(deleted_files))
-
-    # This is the CSV object that will be added to the database
-    new_csv = CSV(
-        id = csv_id,
-        requester = requester
-    )
-
-    temp_directory = csv_file = None
-    try:
-        assn = Assignment.objects.get(id = ObjectId(assignment))
-
-        # Grab all student users for this class.
-        users = list(
-            User.objects(
-                account_type = "student",
-                classes = assn.for_class
-            )
+    # Grab all student users for this class. Users are keyed on their email.
+    users = [
+        i["_id"] for i in User._get_collection().find(
+            {"account_type": "student", "classes": assn.for_class},
+            {"_id": True}
         )
+    ]
 
-        # Form the query
-        query = {
-            "assignment": ObjectId(assignment),
+    # Grab the most recent submissions from each user. The cursor fetches
+    # them a batch at a time as the rows are written.
+    submissions = Submission._get_collection().find(
+        {
+            "assignment": assn.id,
             "most_recent": True,
-            "user__in": [i.id for i in users]
-        }
-
-        # Grab the most recent submissions from each user.
-        submissions = list(Submission.objects(**query))
-
-        # Create the actual csv file.
-        csv_file = open(os.path.join(config["CSV_DIRECTORY"], str(csv_id)), "w")
-
-        for i in submissions:
-            score = "None"
-            if i.test_results:
-                test_result = TestResult.objects.get(id = i.test_results)
-                score = str(test_result.score)
-
-            print >> csv_file, "%s,%s,%s" % \
-                (i.user, score, i.timestamp.strftime("%Y-%m-%d-%H-%M-%S"))
-
-        csv_file.close()
-
-        new_csv.file_location = os.path.join(config["CSV_DIRECTORY"], str(csv_id))
-
-        new_csv.expires = \
-            datetime.datetime.today() + config["TEACHER_CSV_LIFETIME"]
-
-        new_csv.save(force_insert = True)
-    except Exception as e:
-        new_csv.file_location = None
-        os.remove(os.path.join(config["CSV_DIRECTORY"], str(csv_id)))
+            "user": {"$in": users}
+        },
+        {"_id": False, "user": True, "timestamp": True, "test_results": True}
+    )
 
-        new_csv.error_string = str(e)
-        new_csv.save(force_insert = True)
+    for i, score in with_scores(submissions):
+        yield [
+            i["user"],
+            str(score),
+            i["timestamp"].strftime("%Y-%m-%d-%H-%M-%S")
+        ]
 
-        raise
+def _create_assignment_csv(csv_id, requester, assignment):
+    write_csv(csv_id, requester, assignment_rows(assignment))
@@ -1,16 +1,7 @@
-import shutil
-import subprocess
-import os
-import datetime
-import os.path
 from bson import ObjectId
 
-from galah.db.models import Assignment, Class, CSV, Submission, TestResult, User
-
-try:
-    from collections import OrderedDict
-except ImportError:
-    from ordereddict import OrderedDict
+from galah.db.models import Assignment, Class, Submission, User
+from csvexport import write_csv, with_scores
 
 # Set up configuration and logging
 from galah.base.config import load_config
@@ -19,97 +10,63 @@ config = load_config("sisyphus")
 import logging
 logger = logging.getLogger("galah.sisyphus.create_gradebook_csv")
 
-def _create_gradebook_csv(csv_id, requester, class_id, fill=0):
-    csv_id = ObjectId(csv_id)
-
-    csv_file = temp_directory = ""
-
-    # Find any expired archives and remove them
-    deleted_files = []
-    for i in CSV.objects(expires__lt = datetime.datetime.today()):
-        deleted_files.append(i.file_location)
-
-        if i.file_location:
-            try:
-                os.remove(i.file_location)
-            except OSError as e:
-                logger.warning(
-                    "Could not remove expired csv file at %s: %s.",
-                    i.file_location, str(e)
-                )
-
-        i.delete()
-
-    if deleted_files:
-        logger.info("Deleted csv files %s.", str(deleted_files))
+def get_scores(assignment_ids, users):
+    """
+    Returns a dictionary mapping (user, assignment id) tuples to the score of
+    that user's most recent submission for that assignment. Pairs with no
+    score are left out.
+
+    This is done with one query for all of the submissions and one per batch
+    of their test results rather than a query per user and per submission,
+    only fetching the fields needed.
+
+    """
+
+    submissions = Submission._get_collection().find(
+        {
+            "assignment": {"$in": assignment_ids},
+            "most_recent": True,
+            "user": {"$in": users}
+        },
+        {"_id": False, "user": True, "assignment": True, "test_results": True}
+    )
 
-    # This is the CSV object that will be added to the database
-    new_csv = CSV(
-        id = csv_id,
-        requester = requester
+    return dict(
+        ((i["user"], i["assignment"]), score)
+            for i, score in with_scores(submissions) if score is not None
     )
 
-    temp_directory = csv_file = None
-    try:
-        # Create the actual csv file.
-        csv_file = open(os.path.join(config["CSV_DIRECTORY"], str(csv_id)), "w")
+def gradebook_rows(class_id, fill):
+    "Yields the rows of the gradebook for a class."
 
-        the_class = Class.objects.get(id = ObjectId(class_id))
+    the_class = Class.objects.get(id = ObjectId(class_id))
 
-        # Grab all assignments in this class
-        assns = list(
-            Assignment.objects(for_class = the_class.id)
-        )
+    # Grab all assignments in this class
+    assns = list(
+        Assignment.objects(for_class = the_class.id)
+    )
 
-        print >> csv_file, "%s,%s" % \
-            ("Username", ",".join('"{0}"'.format(i.name) for i in assns))
+    yield ["Username"] + [i.name for i in assns]
 
-        # Grab all student users for this class.
-        users = list(
-            User.objects(
-                account_type = "student",
-                classes = the_class.id
-            )
+    # Grab all student users for this class. Users are keyed on their email.
+    users = [
+        i["_id"] for i in User._get_collection().find(
+            {"account_type": "student", "classes": the_class.id},
+            {"_id": True}
         )
+    ]
 
-        assn_ids = [i.id for i in assns]
-        for user in users:
-            # Query for user's most recent submissions in the known assignments
-            query = {
-                "assignment__in": assn_ids,
-                "most_recent": True,
-                "user": user.id
-            }
-
-            submissions = list(Submission.objects(**query))
-
-            # Initialize each assignment score to empty at first.
-            assn_to_score = OrderedDict((i, str(fill)) for i in assn_ids)
-
-            # Go through submissions, associating scores with assignment
-            for sub in submissions:
-                if sub.test_results:
-                    test_result = TestResult.objects.get(id = sub.test_results)
-                    if test_result.score is not None:
-                        assn_to_score[sub.assignment] = str(test_result.score)
-
-            # Write gradebook results to csv file.
-            print >> csv_file, "%s,%s" % \
-                (user.email, ",".join(assn_to_score.values()))
+    assn_ids = [i.id for i in assns]
+    scores = get_scores(assn_ids, users)
 
-        csv_file.close()
+    for user in users:
+        # Every assignment the user has no score for gets the fill value.
+        row = [user]
+        for assn_id in assn_ids:
+            score = scores.get((user, assn_id))
+            row.append(str(fill) if score is None else str(score))
 
-        new_csv.file_location = os.path.join(config["CSV_DIRECTORY"], str(csv_id))
+        yield row
 
-        new_csv.expires = \
-            datetime.datetime.today() + config["TEACHER_CSV_LIFETIME"]
-
-        new_csv.save(force_insert = True)
-    except Exception as e:
-        new_csv.file_location = None
-        os.remove(os.path.join(config["CSV_DIRECTORY"], str(csv_id)))
-
-        new_csv.error_string = str(e)
-        new_csv.save(force_insert = True)
-
-        raise
+def _create_gradebook_csv(csv_id, requester, class_id, fill=0):
+    write_csv(csv_id, requester, gradebook_rows(class_id, fill))
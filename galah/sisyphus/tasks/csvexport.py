@@ -0,0 +1,107 @@
+"""
+Helpers shared by the tasks that produce CSV reports.
+
+write_csv() takes care of the CSV document and its file, writing rows to the
+file as they're produced so a report never has to be held in memory all at
+once. with_scores() joins submissions to their scores a batch at a time.
+
+"""
+
+import os
+import csv
+import datetime
+import os.path
+from bson import ObjectId
+
+from galah.db.models import CSV, TestResult
+
+# Set up configuration and logging
+from galah.base.config import load_config
+config = load_config("sisyphus")
+
+import logging
+logger = logging.getLogger("galah.sisyphus.csvexport")
+
+def _encode(row):
+    return [i.encode("utf-8") if isinstance(i, unicode) else i for i in row]
+
+def write_csv(csv_id, requester, rows):
+    """
+    Writes rows, an iterable of sequences, to the file for the CSV document
+    with the given id and saves the document. If anything goes wrong
+    (including while producing the rows) the file is removed, the document is
+    saved with an error string instead, and the exception is reraised.
+
+    """
+
+    csv_id = ObjectId(csv_id)
+    csv_path = os.path.join(config["CSV_DIRECTORY"], str(csv_id))
+
+    # This is the CSV object that will be added to the database
+    new_csv = CSV(
+        id = csv_id,
+        requester = requester
+    )
+
+    try:
+        with open(csv_path, "w") as csv_file:
+            writer = csv.writer(csv_file, lineterminator = "\n")
+            writer.writerows(_encode(i) for i in rows)
+
+        new_csv.file_location = csv_path
+
+        new_csv.expires = \
+            datetime.datetime.today() + config["TEACHER_CSV_LIFETIME"]
+
+        # This replaces the document saved by an earlier attempt that failed,
+        # if there was one.
+        new_csv.save()
+    except Exception as e:
+        new_csv.file_location = None
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
+
+        new_csv.error_string = str(e)
+        new_csv.save()
+
+        raise
+
+def with_scores(submissions, batch_size = 1000):
+    """
+    Takes an iterable of submissions as dictionaries straight from pymongo
+    (they need only have the test_results field) and yields (submission,
+    score) tuples in the same order. score is None if the submission has no
+    test result or its test result has no score.
+
+    The test results are fetched with one query per batch_size submissions,
+    fetching only their scores.
+
+    """
+
+    collection = TestResult._get_collection()
+
+    batch = []
+    for i in submissions:
+        batch.append(i)
+
+        if len(batch) >= batch_size:
+            for j in _score_batch(collection, batch):
+                yield j
+
+            batch = []
+
+    for j in _score_batch(collection, batch):
+        yield j
+
+def _score_batch(collection, batch):
+    ids = [i["test_results"] for i in batch if i.get("test_results")]
+
+    scores = {}
+    if ids:
+        scores = dict(
+            (i["_id"], i.get("score")) for i in
+                collection.find({"_id": {"$in": ids}}, {"score": True})
+        )
+
+    for i in batch:
+        yield i, scores.get(i.get("test_results"))
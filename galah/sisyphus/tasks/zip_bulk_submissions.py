@@ -1,12 +1,9 @@
-import shutil
-import subprocess
-import tempfile
 import os
 import datetime
 from bson import ObjectId
 
 from galah.db.models import Archive, Assignment, Submission, User
-from galah.base.filemagic import zipdir
+from archivecache import ArchiveCache
 
 # Set up configuration and logging
 from galah.base.config import load_config
@@ -15,29 +12,15 @@ config = load_config("sisyphus")
 import logging
 logger = logging.getLogger("galah.sisyphus.tar_bulk_submissions")
 
+archive_cache = ArchiveCache(
+    config["ARCHIVE_CACHE_DIRECTORY"], config["ARCHIVE_CACHE_BUDGET"],
+    config["ZIP_PROCESSES"]
+)
+
 def _zip_bulk_submissions(archive_id, requester, assignment, email = ""):
     archive_id = ObjectId(archive_id)
 
-    archive_file = temp_directory = ""
-
-    # Find any expired archives and remove them
-    deleted_files = []
-    for i in Archive.objects(expires__lt = datetime.datetime.today()):
-        deleted_files.append(i.file_location)
-
-        if i.file_location:
-            try:
-                os.remove(i.file_location)
-            except OSError as e:
-                logger.warning(
-                    "Could not remove expired archive at %s: %s.",
-                    i.file_location, str(e)
-                )
-
-        i.delete()
-
-    if deleted_files:
-        logger.info("Deleted archives %s.", str(deleted_files))
+    archive_file = ""
 
     # This is the archive object we will eventually add to the database
     new_archive = Archive(
@@ -46,7 +29,7 @@ def _zip_bulk_submissions(archive_id, requester, assignment, email = ""):
         archive_type = "assignment_package"
     )
 
-    temp_directory = archive_file = None
+    archive_file = None
     try:
         # Form the query
         query = {"assignment": ObjectId(assignment)}
@@ -66,86 +49,45 @@ def _zip_bulk_submissions(archive_id, requester, assignment, email = ""):
             )
             query["user__in"] = [i.id for i in students]
 
-        # Grab all the submissions
-        submissions = list(Submission.objects(**query))
+        # Grab all the submissions, grouped by user as in the archive.
+        submissions = list(
+            Submission.objects(**query).order_by("user")
+                .only("id", "assignment", "user", "timestamp")
+        )
 
         if not submissions:
             logger.info("No submissions found matching query.")
             return
 
-        # Organize all the submissions by user name, as this will closely
-        # match the structure of the archive we will build.
-        submission_map = {}
-        for i in submissions:
-            if i.user in submission_map:
-                submission_map[i.user].append(i)
-            else:
-                submission_map[i.user] = [i]
-
-        # Create a temporary directory we will create our archive in.
-        temp_directory = tempfile.mkdtemp()
-
-        # Create our directory tree. Instead of making new folders for each
-        # submission and copying the user's files over however, we will
-        # create symlinks to save space and time.
-        for user, user_submissions in submission_map.items():
-            # Create a directory for the user
-            os.makedirs(os.path.join(temp_directory, user))
-
-            # Create symlinks for all his submissions. Each symlink is
-            # named after the submission date.
-            for i in user_submissions:
-                time_stamp = i.timestamp.strftime("%Y-%m-%d-%H-%M-%S")
-                symlink_path = \
-                    os.path.join(temp_directory, user, time_stamp)
-
-                # In the highly unlikely event that two of the same user's
-                # submissions have the same exact time stamp, we'll need to
-                # add a marker to the end of the timestamp.
-                marker = 0
-                while os.path.exists(symlink_path +
-                        ("-%d" % marker if marker > 0 else "")):
-                    marker += 1
-
-                if marker > 0:
-                    symlink_path += "-%d" % marker
-
-                original_path = i.getFilePath()
-
-                # Detect if the submission's files are still on the filesystem
-                if os.path.isdir(original_path):
-                    # Create a symlink pointing to the actual submission
-                    # directory with the name we gnerated
-                    os.symlink(original_path, symlink_path)
-                else:
-                    # Create an empty text file marking the fact that a
-                    # submissions existed but is no longer available.
-                    open(symlink_path, "w").close()
-
-        # Create the actual archive file.
-        # TODO: Create it in galah's /var/ directory
-        file_descriptor, archive_file = tempfile.mkstemp(suffix = ".zip")
-        os.close(file_descriptor)
-
-        # Run zip and do the actual archiving. Will block until it's finished.
-        zipdir(temp_directory, archive_file)
+        # Every request gets its own link to the cached archive, named after
+        # the Archive document so it can't clash with any other.
+        if not os.path.isdir(config["ARCHIVE_DIRECTORY"]):
+            os.makedirs(config["ARCHIVE_DIRECTORY"])
+
+        archive_file = \
+            os.path.join(config["ARCHIVE_DIRECTORY"], str(archive_id) + ".zip")
+
+        # Bring the cached archive up to date, only adding the submissions
+        # that have been made since it was last requested.
+        archive_cache.get(
+            ObjectId(assignment), email or "", submissions, archive_file
+        )
 
         new_archive.file_location = archive_file
 
         new_archive.expires = \
             datetime.datetime.today() + config["TEACHER_ARCHIVE_LIFETIME"]
 
-        new_archive.save(force_insert = True)
+        # This replaces the document saved by an earlier attempt that failed,
+        # if there was one.
+        new_archive.save()
     except Exception as e:
-        # If we created a temporary archive file we need to delete it.
+        # If we created an archive file we need to delete it.
         new_archive.file_location = None
-        if archive_file:
+        if archive_file and os.path.exists(archive_file):
             os.remove(archive_file)
 
         new_archive.error_string = str(e)
-        new_archive.save(force_insert = True)
+        new_archive.save()
 
         raise
-    finally:
-        if temp_directory:
-            shutil.rmtree(temp_directory)
@@ -49,3 +49,39 @@ class GalahWebAdapter(logging.LoggerAdapter):
         )
 
         return (prefix + msg, kwargs)
+
+from flask import Response
+from galah.sisyphus.api import get_task_status
+def task_progress_response(result_id, description):
+    """
+    Returns a response telling the user how the sisyphus task creating the
+    document with the given id is going, or None if the task isn't queued or
+    running. description is what's being created, ex: "archive".
+
+    """
+
+    status = get_task_status(result_id)
+    if status is None or status["status"] not in ("queued", "running"):
+        return None
+
+    if status["status"] == "running":
+        message = "Your %s is being created." % description
+    elif status["attempts"]:
+        message = (
+            "Your %s could not be created on the first try and will be tried "
+            "again shortly." % description
+        )
+    else:
+        message = "Your %s is waiting to be created behind %d other tasks." % \
+            (description, status["tasks_ahead"])
+
+    return Response(
+        response = message,
+        status = 202,
+        headers = {
+            "X-CallSuccess": "True",
+            "X-TaskStatus": status["status"],
+            "Retry-After": "5"
+        },
+        mimetype = "text/plain"
+    )
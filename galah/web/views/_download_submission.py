@@ -1,15 +1,15 @@
 from galah.web import app
 from galah.web.auth import account_type_required
 from galah.db.models import Assignment, Submission, Archive
-from galah.base.filemagic import zipdir
+from galah.base.zipstream import ZipWriter
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 from flask import send_file, abort
 from flask.ext.login import current_user
 from galah.web.util import GalahWebAdapter
 import os.path
+import os
 import subprocess
-import tempfile
 import datetime
 import logging
 import sys
@@ -44,26 +44,8 @@ def download_submission(assignment_id, submission_id):
 
         abort(404)
 
-    # Find any expired archives and remove them
-    deleted_files = []
-    for i in Archive.objects(expires__lt = datetime.datetime.today()).limit(5):
-        if i.file_location:
-            deleted_files.append(i.file_location)
-
-            try:
-                os.remove(i.file_location)
-            except OSError as e:
-                logger.warning(
-                    "Could not remove expired archive at %s: %s.",
-                    i.file_location, str(e)
-                )
-
-        i.delete()
-
-    if deleted_files:
-        logger.info("Deleted archives %s.", str(deleted_files))
-
     new_archive = Archive(
+        id = ObjectId(),
         requester = current_user.id,
         archive_type = "single_submission"
     )
@@ -73,16 +55,18 @@ def download_submission(assignment_id, submission_id):
 
     archive_file_name = ""
     try:
-        # Create the actual archive file.
-        # TODO: Create it in galah's /var/ directory
-        archive_fd, archive_file_name = tempfile.mkstemp(suffix = ".zip")
+        # Create the actual archive file, named after its document so that
+        # sisyphus's janitor can delete it once it expires.
+        if not os.path.isdir(app.config["ARCHIVE_DIRECTORY"]):
+            os.makedirs(app.config["ARCHIVE_DIRECTORY"])
 
-        # Close the file because we won't actually do any writing to it,
-        # rather tar will.
-        os.close(archive_fd)
+        archive_file_name = os.path.join(
+            app.config["ARCHIVE_DIRECTORY"], str(new_archive.id) + ".zip"
+        )
 
-        # Run zip and do the actual archiving. Will block until it's finished.
-        zipdir(submission.getFilePath(), archive_file_name)
+        # Write the submission's files into the archive.
+        with ZipWriter(archive_file_name) as archive:
+            archive.add_directory(submission.getFilePath(), "")
 
         new_archive.file_location = archive_file_name
 
@@ -92,9 +76,9 @@ def download_submission(assignment_id, submission_id):
     except Exception as e:
         logger.exception("An error occured while creating an archive.")
 
-        # If we created a temporary archive file we need to delete it.
+        # If we created an archive file we need to delete it.
         new_archive.file_location = None
-        if archive_file_name:
+        if archive_file_name and os.path.exists(archive_file_name):
             os.remove(archive_file_name)
 
         new_archive.error_string = str(e)
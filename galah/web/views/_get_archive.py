@@ -6,7 +6,7 @@ from flask import (
 )
 from galah.db.models import Archive
 from bson.objectid import ObjectId, InvalidId
-from galah.web.util import GalahWebAdapter
+from galah.web.util import GalahWebAdapter, task_progress_response
 import logging
 
 logger = GalahWebAdapter(logging.getLogger("galah.web.views.get_archive"))
@@ -26,6 +26,16 @@ def get_archive(archive_id):
     except Archive.DoesNotExist:
         pass
 
+    # If the archive hasn't been created yet, or is going to be created again
+    # after a failed attempt, tell the user how it's going.
+    if archive is None or archive.error_string:
+        if not current_user.is_authenticated():
+            return current_app.login_manager.unauthorized()
+
+        progress = task_progress_response(archive_id, "archive")
+        if progress is not None:
+            return progress
+
     # If we can't find the archive return a 404 error.
     if archive is None:
         logger.info("Could not find archive with given ID.")
@@ -6,7 +6,7 @@ from flask import (
 )
 from galah.db.models import CSV
 from bson.objectid import ObjectId, InvalidId
-from galah.web.util import GalahWebAdapter
+from galah.web.util import GalahWebAdapter, task_progress_response
 import logging
 
 logger = GalahWebAdapter(logging.getLogger("galah.web.views.get_csv"))
@@ -26,6 +26,16 @@ def get_csv(csv_id):
     except CSV.DoesNotExist:
         pass
 
+    # If the CSV file hasn't been created yet, or is going to be created again
+    # after a failed attempt, tell the user how it's going.
+    if csv is None or csv.error_string:
+        if not current_user.is_authenticated():
+            return current_app.login_manager.unauthorized()
+
+        progress = task_progress_response(csv_id, "CSV file")
+        if progress is not None:
+            return progress
+
     # If we can't find the CSV file return a 404 error.
     if csv is None:
         logger.info("Could not find CSV file with given ID.")
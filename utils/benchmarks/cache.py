@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Copyright 2012-2013 John Sullivan
+# Copyright 2012-2013 Other contributors as noted in the CONTRIBUTORS file
+#
+# This file is part of Galah.
+#
+# Galah is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Galah is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Galah.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares the cost of calling a function decorated with galah.base.cache.cached
+against caching its results in a plain dictionary (which is all the old
+memoize decorator did, without any locking or bookkeeping).
+
+"""
+
+import os
+import sys
+import functools
+from timeit import default_timer as timer
+from optparse import OptionParser
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__
+    ))))
+)
+from galah.base.cache import cached
+
+def dict_memoize(func):
+    "The simplest possible cache, for comparison."
+
+    cache = {}
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        try:
+            return cache[args]
+        except KeyError:
+            value = cache[args] = func(*args)
+            return value
+
+    return wrapper
+
+def target(a, b):
+    return a + b
+
+def time_calls(function, keys, repeat):
+    "Returns the best time per call out of repeat passes over keys."
+
+    best = None
+    for i in xrange(repeat):
+        start = timer()
+        for a, b in keys:
+            function(a, b)
+        elapsed = (timer() - start) / len(keys)
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--keys", type = "int", default = 1000,
+                      help = "Number of distinct arguments to call with.")
+    parser.add_option("--calls", type = "int", default = 100000,
+                      help = "Number of calls per pass.")
+    parser.add_option("--repeat", type = "int", default = 5,
+                      help = "Number of passes, the best is reported.")
+    options, args = parser.parse_args()
+
+    keys = [(i % options.keys, 1) for i in xrange(options.calls)]
+
+    candidates = [
+        ("uncached", target),
+        ("plain dict", dict_memoize(target)),
+        ("cached()", cached()(target)),
+        ("cached(max_size)", cached(max_size = options.keys)(target)),
+        ("cached(ttl)", cached(ttl = 3600)(target)),
+        ("cached(tags)",
+            cached(tags = lambda a, b: [a % 10])(target)),
+        ("cached(max_size), all misses",
+            cached(max_size = options.keys / 2)(target))
+    ]
+
+    # Fill the caches so only the last candidate misses.
+    for name, function in candidates:
+        for a, b in keys[:options.keys]:
+            function(a, b)
+
+    baseline = None
+    for name, function in candidates:
+        elapsed = time_calls(function, keys, options.repeat)
+        if name == "plain dict":
+            baseline = elapsed
+
+        print "%-32s %8.3fus per call%s" % (
+            name, elapsed * 1e6,
+            "" if baseline is None or name == "plain dict" else
+                "  (%+.3fus vs plain dict)" % ((elapsed - baseline) * 1e6)
+        )
+
+if __name__ == "__main__":
+    main()
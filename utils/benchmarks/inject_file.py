@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Copyright 2012-2013 John Sullivan
+# Copyright 2012-2013 Other contributors as noted in the CONTRIBUTORS file
+#
+# This file is part of Galah.
+#
+# Galah is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Galah is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Galah.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares the streaming and copying injection paths of pyvz.inject_file on
+trees of many small files. OpenVZ is not needed, a temporary directory stands
+in for the containers' private areas. Must be run as root so files can be
+chowned.
+
+"""
+
+import os
+import os.path
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+def make_tree(path, nfiles, files_per_directory = 100):
+    "Creates nfiles small files under path, similar to a node_modules upload."
+
+    for i in xrange(nfiles):
+        directory = os.path.join(path, "module-%d" % (i / files_per_directory))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(os.path.join(directory, "file-%d.js" % i), "w") as f:
+            f.write("module.exports = %d;\n" % i)
+
+def time_injection(pyvz, source, container_root, stream, repeat):
+    "Returns the best time out of repeat injections of source."
+
+    best = None
+    for i in range(repeat):
+        target = os.path.join(container_root, "1", "tmp", "testables")
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.makedirs(target)
+
+        start = time.time()
+        pyvz.inject_file(1, source, "/tmp/testables/", stream = stream)
+        elapsed = time.time() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--sizes", default = "10,1000,50000",
+                      help = "Comma separated list of tree sizes to test.")
+    parser.add_option("--repeat", type = "int", default = 3,
+                      help = "Number of runs per size, the best is reported.")
+    options, args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print >> sys.stderr, "This benchmark must be run as root."
+        sys.exit(1)
+
+    import galah.sheep.virtualsuites.vz.pyvz as pyvz
+
+    work_directory = tempfile.mkdtemp()
+    try:
+        container_root = os.path.join(work_directory, "private")
+        pyvz.find_container_directory = lambda: container_root
+
+        print "%10s %12s %12s %8s" % ("files", "copy (s)", "stream (s)", "speedup")
+        for size in [int(i) for i in options.sizes.split(",")]:
+            source = os.path.join(work_directory, "tree-%d" % size)
+            make_tree(source, size)
+
+            copy_time = time_injection(
+                pyvz, source, container_root, False, options.repeat
+            )
+            stream_time = time_injection(
+                pyvz, source, container_root, True, options.repeat
+            )
+
+            print "%10d %12.4f %12.4f %7.2fx" % \
+                (size, copy_time, stream_time, copy_time / stream_time)
+    finally:
+        shutil.rmtree(work_directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+
+# Copyright 2012-2013 John Sullivan
+# Copyright 2012-2013 Other contributors as noted in the CONTRIBUTORS file
+#
+# This file is part of Galah.
+#
+# Galah is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Galah is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Galah.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks the whole testing pipeline on one machine. A private shepherd,
+sisyphus, and a number of sheep using the dummy virtual suite are started up
+with their own sockets and a throwaway database, submissions are injected
+(either directly or through the web application's upload view), and the time
+until each one has a test result is measured.
+
+The report is printed as JSON and can be compared against an earlier report to
+catch regressions. MongoDB must be listening on its default port, or the path
+to mongod given with --mongod so a private one can be started there.
+
+"""
+
+import os
+import os.path
+import sys
+import time
+import json
+import shutil
+import socket
+import tempfile
+import datetime
+import subprocess
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__
+    ))))
+)
+from utils.load_test import (GALAH_ROOT, DUMMY_TIMINGS, parse_settings,
+                             create_objects, start_sheep, stop_processes,
+                             fire_requests, wait_for_results, summarize,
+                             percentile)
+
+# The metrics compared against a baseline, and whether bigger is better.
+COMPARED_METRICS = [
+    (("throughput", ), True),
+    (("latency", "p50"), False),
+    (("latency", "p95"), False),
+    (("latency", "p99"), False),
+    (("cpu", "shepherd"), False)
+]
+
+def make_config(directory, database, overrides):
+    "Returns a configuration that keeps every component inside directory."
+
+    config = dict(DUMMY_TIMINGS)
+    config.update({
+        "global/MONGODB": database,
+        "global/SUBMISSION_DIRECTORY": os.path.join(directory, "submissions"),
+        "global/HARNESS_DIRECTORY": os.path.join(directory, "harnesses"),
+        "global/CSV_DIRECTORY": os.path.join(directory, "csv"),
+        "global/ARCHIVE_DIRECTORY": os.path.join(directory, "archives"),
+        "sisyphus/ARCHIVE_CACHE_DIRECTORY":
+            os.path.join(directory, "archive-cache"),
+        "global/SISYPHUS_ADDRESS":
+            "ipc://" + os.path.join(directory, "sisyphus.sock"),
+        "shepherd/SHEEP_SOCKET":
+            "ipc://" + os.path.join(directory, "shepherd-sheep.sock"),
+        "shepherd/PUBLIC_SOCKET":
+            "ipc://" + os.path.join(directory, "shepherd-public.sock"),
+        "shepherd/BLOB_DIRECTORY": os.path.join(directory, "shepherd-blobs")
+    })
+    config.update(overrides)
+
+    return config
+
+def write_config(path, config):
+    with open(path, "w") as f:
+        f.write("import datetime\nconfig = %r\n" % config)
+
+def start_component(directory, name, config_path):
+    """
+    Starts galah/<name>/<name>.py from its own directory, as it expects, and
+    returns the Popen object.
+
+    """
+
+    env = dict(os.environ)
+    env["GALAH_CONFIG_PATH"] = config_path
+    env["PYTHONPATH"] = GALAH_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+
+    log = open(os.path.join(directory, "%s.log" % name), "w")
+
+    return subprocess.Popen(
+        [sys.executable, os.path.join(GALAH_ROOT, "galah", name, name + ".py")],
+        cwd = os.path.join(GALAH_ROOT, "galah", name),
+        env = env, stdout = log, stderr = subprocess.STDOUT
+    )
+
+def start_mongod(path, directory, port = 27017, timeout = 30):
+    """
+    Starts a private mongod storing its data in directory and waits for it to
+    accept connections. Returns the Popen object.
+
+    """
+
+    data_directory = os.path.join(directory, "mongodb")
+    os.makedirs(data_directory)
+
+    log = open(os.path.join(directory, "mongod.log"), "w")
+    mongod = subprocess.Popen(
+        [path, "--dbpath", data_directory, "--bind_ip", "127.0.0.1",
+         "--port", str(port), "--nojournal"],
+        stdout = log, stderr = subprocess.STDOUT
+    )
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if mongod.poll() is not None:
+            raise RuntimeError(
+                "mongod exited with status %d, see %s." %
+                    (mongod.returncode, log.name)
+            )
+
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return mongod
+        except socket.error:
+            time.sleep(0.1)
+
+    mongod.kill()
+    raise RuntimeError("mongod did not start within %d seconds." % timeout)
+
+def cpu_seconds(pid):
+    """
+    Returns the user and system CPU time the process has used so far, or None
+    if it cannot be read (ie: not on Linux).
+
+    """
+
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            # The process name may contain spaces, so skip past it.
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (IOError, IndexError):
+        return None
+
+    return (int(fields[11]) + int(fields[12])) / \
+        float(os.sysconf("SC_CLK_TCK"))
+
+def cpu_usage(processes):
+    "Returns the total CPU time used by all the processes so far."
+
+    usage = [cpu_seconds(i.pid) for i in processes]
+
+    return None if None in usage else sum(usage)
+
+def opcounters():
+    "Returns the server-wide MongoDB operation counters."
+
+    from mongoengine.connection import get_connection
+
+    return dict(get_connection().admin.command("serverStatus")["opcounters"])
+
+def inject_through_web(assignment, user, count):
+    """
+    Uploads count submissions for the user through the web application's
+    upload view. Returns a dictionary mapping submission ids to when their
+    upload finished, and a list of how long each upload took.
+
+    """
+
+    from StringIO import StringIO
+    from galah.web import app
+    from galah.db.models import Submission
+
+    app.config["CSRF_ENABLED"] = False
+    app.config["WTF_CSRF_ENABLED"] = False
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user.email
+        session["_fresh"] = True
+
+    url = "/assignments/%s/upload" % assignment.id
+    finished = []
+    durations = []
+    for i in xrange(count):
+        start_time = time.time()
+        response = client.post(url, data = {
+            "archive-0": (StringIO("int main() { return %d; }\n" % i),
+                          "main.cpp")
+        })
+        finished.append(time.time())
+        durations.append(finished[-1] - start_time)
+
+        if response.status_code != 302:
+            raise RuntimeError(
+                "Upload failed with status %d." % response.status_code
+            )
+
+    # The uploads were made one after another, so the submissions are in the
+    # same order as the uploads.
+    submissions = Submission.objects(
+        assignment = assignment.id, user = user.email
+    ).order_by("timestamp").only("id")
+
+    return dict(zip([i.id for i in submissions], finished)), durations
+
+def run(options, overrides):
+    directory = tempfile.mkdtemp(prefix = "galah-benchmark-")
+    database = "galah_benchmark_%d" % os.getpid()
+
+    config = make_config(directory, database, overrides)
+    config_path = os.path.join(directory, "galah.config")
+    write_config(config_path, config)
+
+    # Everything Galah in this process needs to see the same configuration as
+    # the components, so this must happen before anything loads it.
+    os.environ["GALAH_CONFIG_PATH"] = config_path
+
+    mongod = None
+    components = {}
+    sheep = []
+    try:
+        if options.mongod:
+            mongod = start_mongod(options.mongod, directory)
+
+        import mongoengine
+        mongoengine.connect(database)
+
+        user, harness, assignment, submissions = create_objects(
+            0 if options.inject == "web" else options.submissions
+        )
+
+        for i in ("shepherd", "sisyphus"):
+            components[i] = start_component(directory, i, config_path)
+
+        for i in xrange(options.sheep):
+            sheep.append(start_sheep(
+                directory, i, config, {}, options.consumers
+            ))
+
+        # Give everything a chance to connect and the sheep a chance to bleet.
+        time.sleep(options.warmup)
+
+        dead = [i for i in components.values() + sheep if i.poll() is not None]
+        if dead:
+            raise RuntimeError(
+                "%d components died on startup, see the logs in %s." %
+                    (len(dead), directory)
+            )
+
+        cpu_before = dict(
+            (k, cpu_usage([v])) for k, v in components.items()
+        )
+        cpu_before["sheep"] = cpu_usage(sheep)
+        ops_before = opcounters()
+
+        uploads = None
+        if options.inject == "web":
+            sent_at, uploads = \
+                inject_through_web(assignment, user, options.submissions)
+        else:
+            sent_at = fire_requests(
+                submissions, options.rate, config["shepherd/PUBLIC_SOCKET"]
+            )
+
+        finished_at = wait_for_results(
+            sent_at, options.timeout, options.poll_interval
+        )
+
+        cpu_after = dict(
+            (k, cpu_usage([v])) for k, v in components.items()
+        )
+        cpu_after["sheep"] = cpu_usage(sheep)
+        ops_after = opcounters()
+
+        report = summarize(sent_at, finished_at, sent_at.keys())
+        report["cpu"] = dict(
+            (k, None if cpu_before[k] is None or cpu_after[k] is None else
+                cpu_after[k] - cpu_before[k])
+            for k in cpu_before
+        )
+
+        # Note that these include the queries made to notice results.
+        report["mongodb_ops"] = dict(
+            (k, ops_after[k] - ops_before.get(k, 0)) for k in ops_after
+        )
+
+        if uploads:
+            uploads.sort()
+            report["upload"] = {
+                "mean": sum(uploads) / len(uploads),
+                "p50": percentile(uploads, 0.5),
+                "p95": percentile(uploads, 0.95),
+                "max": uploads[-1]
+            }
+
+        return report
+    finally:
+        stop_processes(sheep + components.values())
+
+        if not options.keep:
+            try:
+                from mongoengine.connection import get_connection
+                get_connection().drop_database(database)
+            except Exception as e:
+                print >> sys.stderr, "Could not drop %s: %s" % (database, e)
+
+        if mongod is not None:
+            stop_processes([mongod], 30)
+
+        if options.keep:
+            print >> sys.stderr, "Logs and data kept in %s." % directory
+        else:
+            shutil.rmtree(directory, ignore_errors = True)
+
+def get_metric(report, path):
+    for i in path:
+        if not isinstance(report, dict) or report.get(i) is None:
+            return None
+
+        report = report[i]
+
+    return report
+
+def compare(report, baseline, tolerance):
+    """
+    Returns a list of descriptions of the metrics in report that are more than
+    tolerance (a fraction) worse than in baseline.
+
+    """
+
+    regressions = []
+    for path, bigger_is_better in COMPARED_METRICS:
+        new, old = get_metric(report, path), get_metric(baseline, path)
+        if new is None or not old:
+            continue
+
+        change = (new - old) / float(old)
+        if (-change if bigger_is_better else change) > tolerance:
+            regressions.append(
+                "%s went from %.4g to %.4g (%+.1f%%)" %
+                    (".".join(path), old, new, change * 100)
+            )
+
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd = GALAH_ROOT,
+            stderr = open(os.devnull, "w")
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_arguments(args = sys.argv[1:]):
+    from optparse import OptionParser, make_option
+
+    option_list = [
+        make_option(
+            "--sheep", "-s", type = "int", default = 4,
+            help = "The number of sheep to start. Defaults to %default."
+        ),
+        make_option(
+            "--consumers", "-c", type = "int", default = 1,
+            help = "The number of consumers each sheep runs. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--submissions", "-n", type = "int", default = 200,
+            help = "The number of submissions to inject. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--inject", choices = ["direct", "web"], default = "direct",
+            help = "Whether to create submissions in the database and send "
+                   "test requests straight to the shepherd (direct), or to "
+                   "upload them through the web application (web). Defaults "
+                   "to %default."
+        ),
+        make_option(
+            "--rate", "-r", type = "float", default = 0,
+            help = "The number of test requests to send per second when "
+                   "injecting directly, 0 sends them all at once. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--set", metavar = "KEY=VALUE", action = "append", default = [],
+            help = "Overrides a configuration value for every component, "
+                   "VALUE is a Python expression. May be given multiple times."
+        ),
+        make_option(
+            "--mongod", metavar = "PATH",
+            help = "Start a private mongod from PATH rather than using the "
+                   "one already running."
+        ),
+        make_option(
+            "--warmup", type = "float", default = 5,
+            help = "The number of seconds to give the components to start up. "
+                   "Defaults to %default."
+        ),
+        make_option(
+            "--timeout", type = "float", default = 600,
+            help = "The number of seconds to wait for results. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--poll-interval", type = "float", default = 0.05,
+            help = "How often to check for results, in seconds. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--output", "-o", metavar = "FILE",
+            help = "Write the report to FILE rather than standard output."
+        ),
+        make_option(
+            "--compare", metavar = "FILE",
+            help = "Compare the results against the report in FILE and exit "
+                   "with an error if any got worse by more than the "
+                   "tolerance."
+        ),
+        make_option(
+            "--tolerance", type = "float", default = 0.1,
+            help = "How much worse, as a fraction, a result may be than in "
+                   "the compared report. Defaults to %default."
+        ),
+        make_option(
+            "--keep", action = "store_true", default = False,
+            help = "Keep the logs, configuration, and database."
+        )
+    ]
+
+    parser = OptionParser(
+        usage = "Usage: %prog [OPTIONS]",
+        description = "Benchmarks the testing pipeline end to end.",
+        option_list = option_list
+    )
+
+    options, pos_args = parser.parse_args(args)
+
+    if pos_args:
+        parser.error("No positional arguments are accepted.")
+
+    try:
+        overrides = parse_settings(options.set)
+    except ValueError as e:
+        parser.error(str(e))
+
+    return (options, overrides)
+
+def main():
+    options, overrides = parse_arguments()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+    report = {
+        "benchmark": "pipeline",
+        "revision": git_revision(),
+        "started_at": datetime.datetime.utcnow().isoformat(),
+        "parameters": {
+            "sheep": options.sheep,
+            "consumers": options.consumers,
+            "submissions": options.submissions,
+            "inject": options.inject,
+            "rate": options.rate,
+            "settings": dict((k, repr(v)) for k, v in overrides.items())
+        }
+    }
+    report.update(run(options, overrides))
+
+    output = json.dumps(report, indent = 4, sort_keys = True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print output
+
+    status = 0 if report["timed_out"] == 0 else 1
+
+    if baseline is not None:
+        regressions = compare(report, baseline, options.tolerance)
+        for i in regressions:
+            print >> sys.stderr, "Regression: " + i
+
+        if regressions:
+            status = 1
+
+    return status
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+# Copyright 2012-2013 John Sullivan
+# Copyright 2012-2013 Other contributors as noted in the CONTRIBUTORS file
+#
+# This file is part of Galah.
+#
+# Galah is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Galah is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Galah.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks sisyphus's report tasks against a synthetic class in a throwaway
+database. The class has the given number of students and assignments, and
+every student has a few submissions (only the most recent of which counts)
+for most assignments. The gradebook covers the whole class and the assignment
+report covers the first assignment, so it has about as many rows as there are
+students.
+
+Each report is generated a number of times and the best time is reported,
+along with how many queries MongoDB served while generating it, which is what
+made the old reports slow. With --naive the reports are also generated the
+way they used to be, one query per student and per submission, for
+comparison. MongoDB must be listening on its default port.
+
+"""
+
+import os
+import os.path
+import sys
+import time
+import random
+import shutil
+import tempfile
+import datetime
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__
+    ))))
+)
+from utils.benchmarks.pipeline import make_config, write_config, opcounters
+
+def create_class(students, assignments, coverage, history, seed):
+    """
+    Creates a class with students and assignments. Each student has a
+    submission for an assignment with probability coverage, and each
+    submission has history older submissions before it. Returns the class.
+
+    The documents are inserted in bulk directly so that setting up a large
+    class doesn't take longer than the benchmark.
+
+    """
+
+    from galah.db.models import (Class, Assignment, User, Submission,
+                                 TestResult)
+    from bson.objectid import ObjectId
+
+    rng = random.Random(seed)
+
+    the_class = Class(name = "Benchmark Class")
+    the_class.save()
+
+    assignment_ids = []
+    for i in xrange(assignments):
+        assignment = Assignment(
+            name = "Assignment %d" % i,
+            due = datetime.datetime.now(),
+            for_class = the_class.id
+        )
+        assignment.save()
+
+        assignment_ids.append(assignment.id)
+
+    emails = ["student%d@example.com" % i for i in xrange(students)]
+    User._get_collection().insert([
+        {"_id": i, "account_type": "student", "classes": [the_class.id]}
+            for i in emails
+    ])
+
+    now = datetime.datetime.now()
+    for email in emails:
+        submissions = []
+        test_results = []
+        for assignment_id in assignment_ids:
+            if rng.random() >= coverage:
+                continue
+
+            for i in xrange(history + 1):
+                test_result = {
+                    "_id": ObjectId(),
+                    "score": float(rng.randint(0, 10)),
+                    "max_score": 10.0
+                }
+                test_results.append(test_result)
+
+                submissions.append({
+                    "assignment": assignment_id,
+                    "user": email,
+                    "timestamp": now - datetime.timedelta(hours = i),
+                    "most_recent": i == 0,
+                    "test_results": test_result["_id"]
+                })
+
+        if test_results:
+            TestResult._get_collection().insert(test_results)
+            Submission._get_collection().insert(submissions)
+
+    return the_class
+
+def naive_gradebook(csv_path, class_id, fill = 0):
+    "Generates a gradebook the way create_gradebook_csv used to."
+
+    from galah.db.models import (Assignment, Submission, TestResult, User)
+
+    csv_file = open(csv_path, "w")
+
+    assns = list(Assignment.objects(for_class = class_id))
+
+    print >> csv_file, "%s,%s" % \
+        ("Username", ",".join('"{0}"'.format(i.name) for i in assns))
+
+    users = list(User.objects(account_type = "student", classes = class_id))
+
+    assn_ids = [i.id for i in assns]
+    for user in users:
+        submissions = list(Submission.objects(
+            assignment__in = assn_ids, most_recent = True, user = user.id
+        ))
+
+        assn_to_score = dict((i, str(fill)) for i in assn_ids)
+        for sub in submissions:
+            if sub.test_results:
+                test_result = TestResult.objects.get(id = sub.test_results)
+                if test_result.score is not None:
+                    assn_to_score[sub.assignment] = str(test_result.score)
+
+        print >> csv_file, "%s,%s" % \
+            (user.email, ",".join(assn_to_score[i] for i in assn_ids))
+
+    csv_file.close()
+
+def naive_assignment_csv(csv_path, assignment_id):
+    "Generates an assignment's CSV file the way create_assignment_csv used to."
+
+    from galah.db.models import (Assignment, Submission, TestResult, User)
+
+    assn = Assignment.objects.get(id = assignment_id)
+
+    users = list(
+        User.objects(account_type = "student", classes = assn.for_class)
+    )
+
+    submissions = list(Submission.objects(
+        assignment = assignment_id, most_recent = True,
+        user__in = [i.id for i in users]
+    ))
+
+    csv_file = open(csv_path, "w")
+
+    for i in submissions:
+        score = "None"
+        if i.test_results:
+            test_result = TestResult.objects.get(id = i.test_results)
+            score = str(test_result.score)
+
+        print >> csv_file, "%s,%s,%s" % \
+            (i.user, score, i.timestamp.strftime("%Y-%m-%d-%H-%M-%S"))
+
+    csv_file.close()
+
+def measure(function, repeat):
+    """
+    Calls function repeat times. Returns the best time in seconds and the
+    number of queries (including fetches of further batches) MongoDB served
+    during the last call.
+
+    """
+
+    best = None
+    for i in xrange(repeat):
+        ops_before = opcounters()
+        start_time = time.time()
+        function()
+        elapsed = time.time() - start_time
+        ops_after = opcounters()
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    queries = sum(
+        ops_after[k] - ops_before.get(k, 0) for k in ("query", "getmore")
+    )
+
+    return best, queries
+
+def run(options):
+    directory = tempfile.mkdtemp(prefix = "galah-benchmark-")
+    database = "galah_benchmark_%d" % os.getpid()
+
+    config = make_config(directory, database, {})
+    os.makedirs(config["global/CSV_DIRECTORY"])
+    config_path = os.path.join(directory, "galah.config")
+    write_config(config_path, config)
+
+    # The tasks load their configuration when they're imported.
+    os.environ["GALAH_CONFIG_PATH"] = config_path
+
+    import mongoengine
+    mongoengine.connect(database)
+
+    from bson.objectid import ObjectId
+    from galah.db.models import Assignment
+    from galah.sisyphus.tasks.create_gradebook_csv import \
+        _create_gradebook_csv
+    from galah.sisyphus.tasks.create_assignment_csv import \
+        _create_assignment_csv
+
+    try:
+        start_time = time.time()
+        the_class = create_class(
+            options.students, options.assignments, options.coverage,
+            options.history, options.seed
+        )
+        print "Created the class in %.1f seconds." % (time.time() - start_time)
+
+        assignment = Assignment.objects(for_class = the_class.id).first()
+
+        cases = [
+            ("gradebook", lambda: _create_gradebook_csv(
+                str(ObjectId()), "teacher@example.com", str(the_class.id)
+            )),
+            ("assignment", lambda: _create_assignment_csv(
+                str(ObjectId()), "teacher@example.com", str(assignment.id)
+            ))
+        ]
+
+        if options.naive:
+            cases += [
+                ("gradebook (naive)", lambda: naive_gradebook(
+                    os.path.join(directory, "naive.csv"), the_class.id
+                )),
+                ("assignment (naive)", lambda: naive_assignment_csv(
+                    os.path.join(directory, "naive.csv"), assignment.id
+                ))
+            ]
+
+        for name, function in cases:
+            elapsed, queries = measure(function, options.repeat)
+
+            print "%-24s %8.3f seconds %8d queries" % (name, elapsed, queries)
+    finally:
+        from mongoengine.connection import get_connection
+        get_connection().drop_database(database)
+
+        shutil.rmtree(directory, ignore_errors = True)
+
+def parse_arguments(args = sys.argv[1:]):
+    from optparse import OptionParser, make_option
+
+    option_list = [
+        make_option(
+            "--students", type = "int", default = 1000,
+            help = "The number of students in the class. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--assignments", type = "int", default = 12,
+            help = "The number of assignments in the class. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--coverage", type = "float", default = 0.9,
+            help = "The chance that a student has submitted to an "
+                   "assignment. Defaults to %default."
+        ),
+        make_option(
+            "--history", type = "int", default = 2,
+            help = "The number of older submissions each student has for "
+                   "each assignment they submitted to. Defaults to %default."
+        ),
+        make_option(
+            "--repeat", type = "int", default = 3,
+            help = "The number of times to generate each report, the best "
+                   "time is reported. Defaults to %default."
+        ),
+        make_option(
+            "--seed", type = "int", default = 0,
+            help = "The random seed used to create the class. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--naive", action = "store_true", default = False,
+            help = "Also generate the reports the old way for comparison."
+        )
+    ]
+
+    parser = OptionParser(
+        usage = "Usage: %prog [OPTIONS]",
+        description = "Benchmarks sisyphus's report tasks.",
+        option_list = option_list
+    )
+
+    options, pos_args = parser.parse_args(args)
+
+    if pos_args:
+        parser.error("No positional arguments are accepted.")
+
+    return options
+
+def main():
+    options = parse_arguments()
+
+    run(options)
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+
+# Copyright 2012-2013 John Sullivan
+# Copyright 2012-2013 Other contributors as noted in the CONTRIBUTORS file
+#
+# This file is part of Galah.
+#
+# Galah is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Galah is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Galah.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Microbenchmarks for the shepherd's scheduling data structures: PriorityDict,
+FlockManager, FlockManager.check_environments, and the JSON serialization of
+flock messages. Neither MongoDB nor any running components are needed.
+
+Every benchmark reports the best time per operation out of several runs. Save
+a run with --save and check later runs against it with --compare, baselines
+are only meaningful on the machine they were recorded on.
+
+"""
+
+import os
+import sys
+import json
+import random
+import datetime
+import platform
+import subprocess
+from timeit import default_timer as timer
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__
+    ))))
+)
+from galah.base.prioritydict import PriorityDict
+from galah.base.flockmail import FlockMessage, InternalTestRequest
+from galah.base.zmqhelpers import jsonify, dejsonify
+from galah.base.utility import monotonic
+from galah.shepherd.flockmanager import FlockManager
+
+QUEUE_SIZES = [10, 1000, 10000, 100000]
+FLOCK_SIZES = [10, 100, 1000]
+
+# What sheep and the requests they can service look like.
+SHEEP_ENVIRONMENT = {
+    "os": "centos-6", "arch": "x86_64", "compiler": "g++", "python": "2.7",
+    "java": "1.7", "memory": "512M"
+}
+MATCHING_ENVIRONMENT = {"os": "centos-6", "compiler": "g++"}
+MISMATCHED_ENVIRONMENT = {"os": "centos-6", "compiler": "clang"}
+
+# How many operations each benchmark times at most per run.
+MAX_OPS = 1000
+
+def measure(setup, repeat):
+    """
+    Calls setup() to get the number of operations to perform and a function
+    that performs them, then times that function. Returns the best time per
+    operation out of repeat runs.
+
+    """
+
+    best = None
+    for i in xrange(repeat):
+        ops, function = setup()
+
+        start = timer()
+        function()
+        elapsed = (timer() - start) / ops
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def make_priority_dict(size, rng):
+    return PriorityDict((i, rng.random()) for i in xrange(size))
+
+def prioritydict_benchmarks(size, rng):
+    def set_new():
+        queue = make_priority_dict(size, rng)
+        priorities = [rng.random() for i in xrange(MAX_OPS)]
+
+        def run():
+            for n, i in enumerate(priorities):
+                queue[size + n] = i
+
+        return MAX_OPS, run
+
+    def update_priority():
+        queue = make_priority_dict(size, rng)
+        updates = [(rng.randrange(size), rng.random()) for i in xrange(MAX_OPS)]
+
+        def run():
+            for k, v in updates:
+                queue[k] = v
+
+        return MAX_OPS, run
+
+    def touch():
+        # Move random items to the back of the queue, like sheep bleeting.
+        queue = make_priority_dict(size, rng)
+        keys = [rng.randrange(size) for i in xrange(MAX_OPS)]
+
+        def run():
+            for n, i in enumerate(keys):
+                queue[i] = 1 + n
+
+        return MAX_OPS, run
+
+    def pop_smallest():
+        # Update every priority first, like a queue that's been in use for a
+        # while.
+        queue = make_priority_dict(size, rng)
+        for i in xrange(size):
+            queue[i] = rng.random()
+
+        ops = min(size, MAX_OPS)
+
+        def run():
+            for i in xrange(ops):
+                queue.pop_smallest()
+
+        return ops, run
+
+    def delete_then_smallest():
+        queue = make_priority_dict(size, rng)
+        keys = rng.sample(xrange(size), min(size - 1, MAX_OPS))
+
+        def run():
+            for i in keys:
+                del queue[i]
+                queue.smallest()
+
+        return len(keys), run
+
+    return [
+        ("prioritydict.set_new", set_new),
+        ("prioritydict.update_priority", update_priority),
+        ("prioritydict.touch", touch),
+        ("prioritydict.pop_smallest", pop_smallest),
+        ("prioritydict.delete_then_smallest", delete_then_smallest)
+    ]
+
+def make_request(n, environment):
+    return InternalTestRequest(n, 30, environment, n % 10)
+
+def make_flock(requests, sheep, sheep_busy = False):
+    """
+    Returns a FlockManager with the given number of sheep and queued requests.
+    None of the queued requests can be serviced by any of the sheep.
+
+    """
+
+    manager = FlockManager(lambda *args: True, datetime.timedelta(seconds = 30),
+                           datetime.timedelta(minutes = 5))
+
+    for i in xrange(sheep):
+        manager.manage_sheep("sheep-%d" % i, SHEEP_ENVIRONMENT)
+
+    if sheep_busy:
+        for i in xrange(sheep):
+            request = make_request(-i - 1, MATCHING_ENVIRONMENT)
+            manager.received_request(request)
+
+    # Queueing requests through received_request would check every request
+    # against every sheep, so build the queue directly.
+    now = monotonic()
+    for i in xrange(requests):
+        manager._request_queue[make_request(i, MISMATCHED_ENVIRONMENT)] = now
+
+    return manager
+
+def flock_benchmarks(requests, sheep):
+    def received_request_unmatched():
+        manager = make_flock(requests, sheep)
+        new_requests = [
+            make_request(requests + i, MISMATCHED_ENVIRONMENT)
+                for i in xrange(MAX_OPS)
+        ]
+
+        def run():
+            for i in new_requests:
+                manager.received_request(i)
+
+        return MAX_OPS, run
+
+    def received_request_matched():
+        manager = make_flock(requests, sheep)
+        ops = min(sheep, MAX_OPS)
+        new_requests = [
+            make_request(requests + i, MATCHING_ENVIRONMENT)
+                for i in xrange(ops)
+        ]
+
+        def run():
+            for i in new_requests:
+                manager.received_request(i)
+
+        return ops, run
+
+    def sheep_bleeted_idle():
+        manager = make_flock(requests, sheep)
+        identities = ["sheep-%d" % (i % sheep) for i in xrange(MAX_OPS)]
+
+        def run():
+            for i in identities:
+                manager.sheep_bleeted(i)
+
+        return MAX_OPS, run
+
+    def sheep_bleeted_available():
+        # Each sheep that finishes looks through every queued request.
+        manager = make_flock(requests, sheep, sheep_busy = True)
+        ops = min(sheep, max(1, MAX_OPS * 100 / max(requests, 1)))
+        identities = ["sheep-%d" % i for i in xrange(ops)]
+
+        def run():
+            for i in identities:
+                manager.sheep_finished(i)
+                manager.sheep_bleeted(i)
+
+        return ops, run
+
+    def cleanup_nothing_expired():
+        manager = make_flock(requests, sheep)
+
+        def run():
+            for i in xrange(MAX_OPS):
+                manager.cleanup()
+
+        return MAX_OPS, run
+
+    def cleanup_all_lost():
+        manager = make_flock(requests, sheep)
+        manager.bleet_timeout = datetime.timedelta(seconds = -1)
+
+        def run():
+            manager.cleanup()
+
+        return sheep, run
+
+    return [
+        ("flock.received_request.unmatched", received_request_unmatched),
+        ("flock.received_request.matched", received_request_matched),
+        ("flock.sheep_bleeted.idle", sheep_bleeted_idle),
+        ("flock.sheep_bleeted.available", sheep_bleeted_available),
+        ("flock.cleanup.nothing_expired", cleanup_nothing_expired),
+        ("flock.cleanup.all_lost", cleanup_all_lost)
+    ]
+
+def check_environments_benchmarks():
+    def check(environment):
+        def setup():
+            def run():
+                for i in xrange(MAX_OPS):
+                    FlockManager.check_environments(
+                        environment, SHEEP_ENVIRONMENT
+                    )
+
+            return MAX_OPS, run
+
+        return setup
+
+    return [
+        ("check_environments.match", check(MATCHING_ENVIRONMENT)),
+        ("check_environments.mismatch", check(MISMATCHED_ENVIRONMENT)),
+        ("check_environments.empty", check({}))
+    ]
+
+def make_request_message():
+    "Returns a request message like the shepherd sends to sheep."
+
+    return FlockMessage("request", {
+        "assignment": {
+            "name": "Lab 7: Linked Lists",
+            "due": "2013-04-12T23:59:59",
+            "due_cutoff": "2013-04-14T23:59:59",
+            "hide_until": "51266b8a7d2e7a1e3c000001",
+            "test_harness": "51266c0a7d2e7a1e3c000007"
+        },
+        "submission": {
+            "id": "5167a3e07d2e7a3f2a00012c",
+            "assignment": "51266b8a7d2e7a1e3c000003",
+            "user": "student42@example.edu",
+            "timestamp": "2013-04-12T21:13:04.522000",
+            "most_recent": True,
+            "test_type": "public",
+            "test_results": "None",
+            "test_request_timestamp": "2013-04-12T21:13:04.530000"
+        },
+        "test_harness": {
+            "config": {
+                "galah/timeout": 30,
+                "galah/environment": MATCHING_ENVIRONMENT,
+                "files": ["main.cpp", "list.cpp", "list.hpp"],
+                "points": [2, 3, 3, 2]
+            },
+            "harness_path": "/var/local/galah/web/harness/51266c0a7d2e7a1e3c000007",
+            "id": "51266c0a7d2e7a1e3c000007"
+        },
+        "dispatch_id": "5167a3e07d2e7a3f2a00012d",
+        "hint": {"test_harness": "51266c0a7d2e7a1e3c000007"}
+    }).to_dict()
+
+def make_result_message(ntests = 20):
+    "Returns a result message like sheep send to the shepherd."
+
+    return FlockMessage("result", {
+        "id": "5167a3e07d2e7a3f2a00012c",
+        "dispatch_id": "5167a3e07d2e7a3f2a00012d",
+        "score": 31.5,
+        "max_score": 40,
+        "tests": [
+            {
+                "name": "Test case %d" % i,
+                "score": i % 3,
+                "max_score": 2,
+                "message": "Expected output did not match on line %d:\n"
+                           "expected: 1 -> 2 -> 3\n     got: 1 -> 3" % i,
+                "parts": [["Compiles", 1, 1], ["Runs", i % 2, 1]]
+            } for i in xrange(ntests)
+        ],
+        "timings": {
+            "prepare": 0.012, "wait": 0.0, "fetch": 0.0, "inject": 0.18,
+            "connect": 0.41, "run": 2.3, "teardown": 0.2
+        },
+        "sheep": "sheep-host-3"
+    }).to_dict()
+
+def serialization_benchmarks():
+    def serialize(message):
+        def setup():
+            def run():
+                for i in xrange(MAX_OPS):
+                    jsonify(message)
+
+            return MAX_OPS, run
+
+        return setup
+
+    def deserialize(message):
+        raw = jsonify(message)
+
+        def setup():
+            def run():
+                for i in xrange(MAX_OPS):
+                    dejsonify(raw)
+
+            return MAX_OPS, run
+
+        return setup
+
+    request, result = make_request_message(), make_result_message()
+
+    return [
+        ("jsonify.request", serialize(request)),
+        ("jsonify.result", serialize(result)),
+        ("dejsonify.request", deserialize(request)),
+        ("dejsonify.result", deserialize(result))
+    ]
+
+def all_benchmarks(queue_sizes, flock_sizes, rng):
+    "Returns a list of (name, setup) pairs."
+
+    benchmarks = []
+
+    for size in queue_sizes:
+        benchmarks += [
+            ("%s[size=%d]" % (name, size), setup)
+                for name, setup in prioritydict_benchmarks(size, rng)
+        ]
+
+    for requests in queue_sizes:
+        for sheep in flock_sizes:
+            benchmarks += [
+                ("%s[requests=%d,sheep=%d]" % (name, requests, sheep), setup)
+                    for name, setup in flock_benchmarks(requests, sheep)
+            ]
+
+    benchmarks += check_environments_benchmarks()
+    benchmarks += serialization_benchmarks()
+
+    return benchmarks
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of descriptions of the benchmarks in results that are more
+    than tolerance (a fraction) slower than in baseline.
+
+    """
+
+    regressions = []
+    for name in sorted(results):
+        new, old = results[name], baseline.get(name)
+        if not old:
+            continue
+
+        change = (new - old) / old
+        if change > tolerance:
+            regressions.append(
+                "%s went from %.3gus to %.3gus (%+.1f%%)" %
+                    (name, old * 1e6, new * 1e6, change * 100)
+            )
+
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            stderr = open(os.devnull, "w")
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_sizes(option, opt_str, value, parser):
+    try:
+        setattr(parser.values, option.dest,
+                [int(i) for i in value.split(",")])
+    except ValueError:
+        parser.error("%s expects a comma separated list of numbers." % opt_str)
+
+def parse_arguments(args = sys.argv[1:]):
+    from optparse import OptionParser, make_option
+
+    option_list = [
+        make_option(
+            "--queue-sizes", type = "string", default = QUEUE_SIZES,
+            action = "callback", callback = parse_sizes,
+            help = "Comma separated list of numbers of queued items to test "
+                   "with. Defaults to %s." % ",".join(map(str, QUEUE_SIZES))
+        ),
+        make_option(
+            "--flock-sizes", type = "string", default = FLOCK_SIZES,
+            action = "callback", callback = parse_sizes,
+            help = "Comma separated list of numbers of sheep to test with. "
+                   "Defaults to %s." % ",".join(map(str, FLOCK_SIZES))
+        ),
+        make_option(
+            "--filter", "-k", metavar = "TEXT",
+            help = "Only run benchmarks whose names contain TEXT."
+        ),
+        make_option(
+            "--repeat", type = "int", default = 5,
+            help = "The number of runs per benchmark, the best is reported. "
+                   "Defaults to %default."
+        ),
+        make_option(
+            "--seed", type = "int", default = 0,
+            help = "Seed for the random priorities. Defaults to %default."
+        ),
+        make_option(
+            "--save", metavar = "FILE",
+            help = "Save the results as JSON to FILE."
+        ),
+        make_option(
+            "--compare", metavar = "FILE",
+            help = "Compare the results against those saved in FILE and exit "
+                   "with an error if any got slower by more than the "
+                   "tolerance."
+        ),
+        make_option(
+            "--tolerance", type = "float", default = 0.25,
+            help = "How much slower, as a fraction, a benchmark may be than in "
+                   "the compared results. Defaults to %default."
+        ),
+        make_option(
+            "--json", action = "store_true", default = False,
+            help = "Print the results as JSON."
+        )
+    ]
+
+    parser = OptionParser(
+        usage = "Usage: %prog [OPTIONS]",
+        description = "Benchmarks the shepherd's scheduling data structures.",
+        option_list = option_list
+    )
+
+    options, pos_args = parser.parse_args(args)
+
+    if pos_args:
+        parser.error("No positional arguments are accepted.")
+
+    return (options, pos_args)
+
+def main():
+    options, args = parse_arguments()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)["results"]
+
+    benchmarks = all_benchmarks(
+        options.queue_sizes, options.flock_sizes, random.Random(options.seed)
+    )
+
+    results = {}
+    for name, setup in benchmarks:
+        if options.filter and options.filter not in name:
+            continue
+
+        results[name] = measure(setup, options.repeat)
+
+        if not options.json:
+            print "%-62s %12.3fus" % (name, results[name] * 1e6)
+            sys.stdout.flush()
+
+    report = {
+        "benchmark": "scheduling",
+        "revision": git_revision(),
+        "started_at": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "repeat": options.repeat,
+        "results": results
+    }
+
+    if options.json:
+        print json.dumps(report, indent = 4, sort_keys = True)
+
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump(report, f, indent = 4, sort_keys = True)
+            f.write("\n")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, options.tolerance)
+        for i in regressions:
+            print >> sys.stderr, "Regression: " + i
+
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+# Copyright 2012-2013 John Sullivan
+# Copyright 2012-2013 Other contributors as noted in the CONTRIBUTORS file
+#
+# This file is part of Galah.
+#
+# Galah is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Galah is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Galah.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A stand-in for OpenVZ's vzctl and vzlist commands so pyvz and the vz virtual
+suite can be exercised on machines without OpenVZ.
+
+The script behaves like vzlist if it is invoked through a file named vzlist
+(ex: a symlink) and like vzctl otherwise. Containers are plain directories and
+their state is kept in a JSON file, all under the directory named by the
+FAKE_VZ_ROOT environment variable (/tmp/fake_vz by default). The first time
+the script runs it also writes a vz.conf file there pointing at the
+containers' private areas, so after running `vzlist` once a configuration like
+the following is enough to point a sheep at the fake.
+
+    "sheep/vz/VZCTL_PATH": "/path/to/fake_vz/vzctl",
+    "sheep/vz/VZLIST_PATH": "/path/to/fake_vz/vzlist",
+    "sheep/vz/VZ_CONFIG_PATH": "/tmp/fake_vz/vz.conf",
+
+Setting FAKE_VZ_LOCKED to a number makes that many of the following vzctl
+invocations fail as if the container was locked (exit code 9), which is useful
+for exercising pyvz's retry logic.
+
+"""
+
+import os
+import os.path
+import sys
+import json
+import fcntl
+import shutil
+import fnmatch
+import subprocess
+
+ROOT = os.environ.get("FAKE_VZ_ROOT", "/tmp/fake_vz")
+PRIVATE = os.path.join(ROOT, "private")
+
+# Exit codes used by the real vzctl
+EXIT_LOCKED = 9
+EXIT_NOT_EXIST = 44
+
+def load_state():
+    """
+    Returns the file object the state is stored in (which must be passed to
+    save_state) and the state itself. The file is locked until it is saved.
+
+    """
+
+    if not os.path.isdir(PRIVATE):
+        os.makedirs(PRIVATE)
+
+    conf_path = os.path.join(ROOT, "vz.conf")
+    if not os.path.isfile(conf_path):
+        with open(conf_path, "w") as f:
+            f.write("VE_PRIVATE=%s/$VEID\n" % PRIVATE)
+
+    state_file = open(os.path.join(ROOT, "state.json"), "a+")
+    fcntl.flock(state_file, fcntl.LOCK_EX)
+
+    state_file.seek(0)
+    raw = state_file.read()
+    state = json.loads(raw) if raw else {"containers": {}, "locked": 0}
+
+    if "FAKE_VZ_LOCKED" in os.environ and "locked_from_env" not in state:
+        state["locked"] = int(os.environ["FAKE_VZ_LOCKED"])
+        state["locked_from_env"] = True
+
+    return state_file, state
+
+def save_state(state_file, state):
+    state_file.seek(0)
+    state_file.truncate()
+    state_file.write(json.dumps(state))
+    state_file.close()
+
+def get_option(args, name, default = None):
+    if name in args:
+        return args[args.index(name) + 1]
+
+    return default
+
+def vzctl(args):
+    state_file, state = load_state()
+    containers = state["containers"]
+
+    try:
+        if state["locked"] > 0:
+            state["locked"] -= 1
+            return EXIT_LOCKED
+
+        command, ctid = args[0], args[1]
+
+        if command == "create":
+            if ctid in containers:
+                return 1
+
+            containers[ctid] = {
+                "description": get_option(args, "--description", ""),
+                "ip": get_option(args, "--ipadd", ""),
+                "ostemplate": get_option(args, "--ostemplate", ""),
+                "status": "stopped"
+            }
+            os.makedirs(os.path.join(PRIVATE, ctid))
+
+            return 0
+
+        if ctid not in containers:
+            return EXIT_NOT_EXIST
+
+        if command == "start":
+            containers[ctid]["status"] = "running"
+        elif command == "stop":
+            containers[ctid]["status"] = "stopped"
+        elif command == "destroy":
+            del containers[ctid]
+            shutil.rmtree(os.path.join(PRIVATE, ctid), ignore_errors = True)
+        elif command == "set":
+            if "--description" in args:
+                containers[ctid]["description"] = \
+                    get_option(args, "--description")
+        elif command in ("exec", "runscript"):
+            # Release the state lock, the command may take a while.
+            save_state(state_file, state)
+            state_file = None
+
+            script = None if command == "exec" else args[2]
+            return subprocess.call(
+                ["sh"] + ([script] if script else ["-s"]),
+                cwd = os.path.join(PRIVATE, ctid)
+            )
+        else:
+            sys.stderr.write("fake vzctl: unknown command %s\n" % command)
+            return 1
+
+        return 0
+    finally:
+        if state_file is not None:
+            save_state(state_file, state)
+
+def vzlist(args):
+    state_file, state = load_state()
+    save_state(state_file, state)
+    containers = state["containers"]
+
+    fields = get_option(args, "-Ho") or get_option(args, "-aHo") or "ctid"
+    fields = fields.split(",")
+    pattern = get_option(args, "-d")
+
+    ctids = [i for i in args if i.isdigit()]
+    if ctids:
+        if any(i not in containers for i in ctids):
+            return 1
+    else:
+        ctids = sorted(containers.keys(), key = int)
+
+    for ctid in ctids:
+        info = dict(containers[ctid], ctid = ctid)
+
+        if pattern is not None and \
+                not fnmatch.fnmatchcase(info["description"], pattern):
+            continue
+
+        sys.stdout.write(
+            " ".join(str(info.get(i, "")) or "-" for i in fields) + "\n"
+        )
+
+    return 0
+
+def main():
+    if os.path.basename(sys.argv[0]).startswith("vzlist"):
+        sys.exit(vzlist(sys.argv[1:]))
+    else:
+        sys.exit(vzctl(sys.argv[1:]))
+
+if __name__ == "__main__":
+    main()
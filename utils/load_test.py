@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+
+# Copyright 2012-2013 John Sullivan
+# Copyright 2012-2013 Other contributors as noted in the CONTRIBUTORS file
+#
+# This file is part of Galah.
+#
+# Galah is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Galah is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Galah.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the throughput and latency of the shepherd by starting up a number of
+sheep using the dummy virtual suite and firing test requests at the shepherd's
+public socket.
+
+The shepherd must already be running. A throwaway user, assignment, test
+harness, and submissions are created in the database for the test requests to
+refer to and are deleted afterwards (unless --keep is given).
+
+"""
+
+import os
+import os.path
+import sys
+import time
+import json
+import shutil
+import signal
+import tempfile
+import datetime
+import subprocess
+
+GALAH_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The dummy suite's defaults are far too slow for a load test.
+DUMMY_TIMINGS = {
+    "sheep/dummy/PRODUCE_TIME": ("fixed", 0.01),
+    "sheep/dummy/PREPARE_TIME": ("fixed", 0),
+    "sheep/dummy/TEST_TIME": ("fixed", 0.1)
+}
+
+def percentile(values, fraction):
+    "Returns the given percentile of a sorted list of values."
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def load_user_config():
+    "Returns the configuration dictionary from the user's configuration file."
+
+    path = os.environ.get("GALAH_CONFIG_PATH", "/etc/galah/galah.config")
+    if not os.path.isfile(path):
+        return {}
+
+    import imp
+    return dict(imp.load_source("load_test_user_config", path).config)
+
+def create_objects(count):
+    "Creates everything the shepherd needs to accept count test requests."
+
+    from galah.db.models import (User, Assignment, TestHarness, Submission)
+    from bson.objectid import ObjectId
+
+    tag = str(ObjectId())
+
+    user = User(email = "load-test-%s@example.com" % tag,
+                account_type = "student")
+    user.save()
+
+    harness = TestHarness(config = {}, harness_path = "/dev/null")
+    harness.save()
+
+    assignment = Assignment(
+        name = "Load Test %s" % tag,
+        due = datetime.datetime.now() + datetime.timedelta(days = 1),
+        for_class = ObjectId(),
+        test_harness = harness.id
+    )
+    assignment.save()
+
+    submissions = []
+    for i in xrange(count):
+        submission = Submission(
+            assignment = assignment.id,
+            user = user.email,
+            timestamp = datetime.datetime.now(),
+            test_type = "public"
+        )
+        submission.save()
+
+        submissions.append(submission.id)
+
+    return user, harness, assignment, submissions
+
+def delete_objects(user, harness, assignment, submissions):
+    from galah.db.models import Submission, TestResult
+
+    results = [
+        i.test_results for i in
+            Submission.objects(id__in = submissions).only("test_results")
+        if i.test_results
+    ]
+    TestResult.objects(id__in = results).delete()
+    Submission.objects(id__in = submissions).delete()
+
+    assignment.delete()
+    harness.delete()
+    user.delete()
+
+def start_sheep(directory, index, user_config, overrides, consumers):
+    """
+    Starts a sheep process with its own configuration file (so that sheep
+    don't share outboxes). Returns the Popen object.
+
+    """
+
+    sheep_config = dict(user_config)
+    sheep_config.update({
+        "sheep/VIRTUAL_SUITE": "dummy",
+        "sheep/NCONSUMERS": consumers,
+        "sheep/OUTBOX_DIRECTORY": os.path.join(directory, "outbox-%d" % index),
+        "sheep/BLOB_DIRECTORY": os.path.join(directory, "blobs-%d" % index)
+    })
+    sheep_config.update(overrides)
+
+    config_path = os.path.join(directory, "sheep-%d.config" % index)
+    with open(config_path, "w") as f:
+        f.write("import datetime\nconfig = %r\n" % sheep_config)
+
+    env = dict(os.environ)
+    env["GALAH_CONFIG_PATH"] = config_path
+    env["PYTHONPATH"] = GALAH_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+
+    log = open(os.path.join(directory, "sheep-%d.log" % index), "w")
+
+    return subprocess.Popen(
+        [sys.executable, os.path.join(GALAH_ROOT, "galah", "sheep", "sheep.py")],
+        cwd = os.path.join(GALAH_ROOT, "galah", "sheep"),
+        env = env, stdout = log, stderr = subprocess.STDOUT
+    )
+
+def stop_processes(processes, timeout = 10):
+    for i in processes:
+        if i.poll() is None:
+            i.send_signal(signal.SIGINT)
+
+    deadline = time.time() + timeout
+    for i in processes:
+        while i.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+
+        if i.poll() is None:
+            i.kill()
+            i.wait()
+
+def fire_requests(submissions, rate, public_socket):
+    """
+    Sends a test request for every submission to the shepherd, at most rate
+    requests per second (or all at once if rate is 0). Returns a dictionary
+    mapping submission ids to when their request was sent.
+
+    """
+
+    import zmq
+    from galah.base.flockmail import TestRequest
+
+    context = zmq.Context()
+    shepherd = context.socket(zmq.DEALER)
+    shepherd.linger = -1
+    shepherd.connect(public_socket)
+
+    sent_at = {}
+    start_time = time.time()
+    for n, i in enumerate(submissions):
+        if rate:
+            delay = start_time + n / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        shepherd.send_json(TestRequest(i).to_dict())
+        sent_at[i] = time.time()
+
+    shepherd.close()
+    context.term()
+
+    return sent_at
+
+def wait_for_results(sent_at, timeout, poll_interval = 0.05):
+    """
+    Waits for every submission to get a test result. Returns a dictionary
+    mapping submission ids to when their result was noticed.
+
+    """
+
+    from galah.db.models import Submission
+
+    finished_at = {}
+    pending = set(sent_at)
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        done = Submission.objects(
+            id__in = list(pending), test_results__ne = None
+        ).only("id")
+
+        now = time.time()
+        for i in done:
+            finished_at[i.id] = now
+            pending.discard(i.id)
+
+        time.sleep(poll_interval)
+
+    return finished_at
+
+def summarize(sent_at, finished_at, submissions):
+    from galah.db.models import Submission, TestResult
+
+    latencies = sorted(finished_at[i] - sent_at[i] for i in finished_at)
+
+    results = [
+        i.test_results for i in
+            Submission.objects(id__in = submissions).only("test_results")
+        if i.test_results
+    ]
+    failed = TestResult.objects(id__in = results, failed = True).count()
+
+    report = {
+        "requests": len(sent_at),
+        "completed": len(finished_at),
+        "failed": failed,
+        "timed_out": len(sent_at) - len(finished_at)
+    }
+
+    if latencies:
+        elapsed = max(finished_at.values()) - min(sent_at.values())
+        report.update({
+            "elapsed": elapsed,
+            "throughput": len(finished_at) / elapsed if elapsed else None,
+            "latency": {
+                "mean": sum(latencies) / len(latencies),
+                "p50": percentile(latencies, 0.5),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1]
+            }
+        })
+
+    return report
+
+def run(options, overrides):
+    user_config = load_user_config()
+
+    from galah.base.config import load_config
+    config = load_config("shepherd")
+
+    import mongoengine
+    mongoengine.connect(config["MONGODB"])
+
+    print >> sys.stderr, "Creating %d submissions..." % options.requests
+    user, harness, assignment, submissions = create_objects(options.requests)
+
+    directory = tempfile.mkdtemp(prefix = "galah-load-test-")
+    sheep = []
+    try:
+        print >> sys.stderr, "Starting %d sheep..." % options.sheep
+        for i in xrange(options.sheep):
+            sheep.append(start_sheep(
+                directory, i, user_config, overrides, options.consumers
+            ))
+
+        # Give the sheep a chance to connect and bleet.
+        time.sleep(options.warmup)
+
+        dead = [i for i in sheep if i.poll() is not None]
+        if dead:
+            raise RuntimeError(
+                "%d sheep died on startup, see the logs in %s." %
+                    (len(dead), directory)
+            )
+
+        print >> sys.stderr, "Firing %d requests..." % options.requests
+        sent_at = fire_requests(
+            submissions, options.rate, config["PUBLIC_SOCKET"]
+        )
+        finished_at = wait_for_results(sent_at, options.timeout)
+
+        return summarize(sent_at, finished_at, submissions)
+    finally:
+        stop_processes(sheep)
+
+        if options.keep:
+            print >> sys.stderr, "Sheep logs kept in %s." % directory
+        else:
+            shutil.rmtree(directory, ignore_errors = True)
+            delete_objects(user, harness, assignment, submissions)
+
+def parse_settings(settings):
+    """
+    Turns a list of KEY=VALUE strings, where each VALUE is a Python expression,
+    into a dictionary of configuration values. Raises ValueError if any are
+    malformed.
+
+    """
+
+    result = {}
+    for i in settings:
+        if "=" not in i:
+            raise ValueError("Expected KEY=VALUE, got %s." % i)
+
+        key, value = i.split("=", 1)
+        try:
+            result[key] = eval(value, {"datetime": datetime})
+        except Exception as e:
+            raise ValueError(
+                "Could not evaluate value for %s: %s" % (key, e)
+            )
+
+    return result
+
+def parse_arguments(args = sys.argv[1:]):
+    from optparse import OptionParser, make_option
+
+    option_list = [
+        make_option(
+            "--sheep", "-s", type = "int", default = 4,
+            help = "The number of sheep processes to start. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--consumers", "-c", type = "int", default = 1,
+            help = "The number of consumers each sheep runs. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--requests", "-n", type = "int", default = 100,
+            help = "The number of test requests to send. Defaults to %default."
+        ),
+        make_option(
+            "--rate", "-r", type = "float", default = 0,
+            help = "The number of requests to send per second, 0 sends them "
+                   "all at once. Defaults to %default."
+        ),
+        make_option(
+            "--set", metavar = "KEY=VALUE", action = "append", default = [],
+            help = "Overrides a configuration value for the sheep, VALUE is a "
+                   "Python expression. May be given multiple times. For "
+                   "example: --set \"sheep/dummy/TEST_TIME=('exponential', "
+                   "0.5)\""
+        ),
+        make_option(
+            "--warmup", type = "float", default = 5,
+            help = "The number of seconds to give the sheep to start up. "
+                   "Defaults to %default."
+        ),
+        make_option(
+            "--timeout", type = "float", default = 600,
+            help = "The number of seconds to wait for results. Defaults to "
+                   "%default."
+        ),
+        make_option(
+            "--keep", action = "store_true", default = False,
+            help = "Keep the created database objects and the sheep's logs."
+        ),
+        make_option(
+            "--json", action = "store_true", default = False,
+            help = "Print the report as JSON."
+        )
+    ]
+
+    parser = OptionParser(
+        usage = "Usage: %prog [OPTIONS]",
+        description = "Load tests a running shepherd with dummy sheep.",
+        option_list = option_list
+    )
+
+    options, pos_args = parser.parse_args(args)
+
+    if pos_args:
+        parser.error("No positional arguments are accepted.")
+
+    overrides = dict(DUMMY_TIMINGS)
+    try:
+        overrides.update(parse_settings(options.set))
+    except ValueError as e:
+        parser.error(str(e))
+
+    return (options, overrides)
+
+def main():
+    options, overrides = parse_arguments()
+
+    report = run(options, overrides)
+
+    if options.json:
+        print json.dumps(report, indent = 4, sort_keys = True)
+    else:
+        print "Requests:   %d sent, %d completed, %d failed, %d timed out" % (
+            report["requests"], report["completed"], report["failed"],
+            report["timed_out"]
+        )
+
+        if "latency" in report:
+            print "Elapsed:    %.2fs" % report["elapsed"]
+            print "Throughput: %.2f requests/s" % (report["throughput"] or 0)
+            print "Latency:    " + ", ".join(
+                "%s %.3fs" % (k, report["latency"][k])
+                    for k in ("mean", "p50", "p95", "p99", "max")
+            )
+
+    return 0 if report["timed_out"] == 0 else 1
+
+if __name__ == "__main__":
+    exit(main())
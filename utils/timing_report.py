@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+# Copyright 2012-2013 John Sullivan
+# Copyright 2012-2013 Other contributors as noted in the CONTRIBUTORS file
+#
+# This file is part of Galah.
+#
+# Galah is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Galah is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Galah.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Summarizes where the time goes when testing submissions, per assignment or per
+sheep, using the timings stored along with every test result.
+
+"""
+
+import datetime
+
+# The phases in the order they happen. Any other phases found are listed after
+# these.
+PHASES = [
+    "queue_wait", "prepare", "wait", "fetch", "inject", "connect", "run",
+    "teardown", "service"
+]
+
+def percentile(values, fraction):
+    "Returns the given percentile of a sorted list of values."
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize(values):
+    values = sorted(values)
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "total": sum(values)
+    }
+
+def gather(since, group_by, assignment = None, galah_server = "galah"):
+    """
+    Returns a dictionary mapping group names to dictionaries mapping phase
+    names to summaries of how long that phase took.
+
+    """
+
+    import mongoengine
+    mongoengine.connect(galah_server)
+
+    from galah.db.models import TestResult, Submission, Assignment
+    from bson.objectid import ObjectId
+
+    results = TestResult.objects(
+        timings__received_at__gte = since
+    ).only("id", "timings", "sheep")
+    results = dict((i.id, i) for i in results)
+
+    # Test results don't know what assignment they're for, so look that up
+    # through the submissions that point at them.
+    submissions = Submission.objects(
+        test_results__in = results.keys()
+    ).only("assignment", "test_results")
+    if assignment:
+        submissions = submissions.filter(assignment = ObjectId(assignment))
+
+    assignment_ids = set()
+    pairs = []
+    for i in submissions:
+        assignment_ids.add(i.assignment)
+        pairs.append((i.assignment, results[i.test_results]))
+
+    names = dict(
+        (i.id, "%s (%s)" % (i.name, i.id)) for i in
+            Assignment.objects(id__in = list(assignment_ids)).only("name")
+    )
+
+    groups = {}
+    for assignment_id, result in pairs:
+        if group_by == "sheep":
+            group = result.sheep or "unknown"
+        else:
+            group = names.get(assignment_id, str(assignment_id))
+
+        phases = groups.setdefault(group, {})
+        for phase, value in result.timings.items():
+            if isinstance(value, (int, long, float)):
+                phases.setdefault(phase, []).append(float(value))
+
+    return dict(
+        (group, dict((k, summarize(v)) for k, v in phases.items()))
+            for group, phases in groups.items()
+    )
+
+def print_report(report):
+    for group in sorted(report):
+        phases = report[group]
+        ordered = [i for i in PHASES if i in phases] + \
+            sorted(i for i in phases if i not in PHASES)
+
+        print group
+        print "    %-26s %7s %9s %9s %9s %11s" % (
+            "phase", "count", "mean", "p50", "p95", "total"
+        )
+        for phase in ordered:
+            summary = phases[phase]
+            print "    %-26s %7d %9.3f %9.3f %9.3f %11.1f" % (
+                phase, summary["count"], summary["mean"], summary["p50"],
+                summary["p95"], summary["total"]
+            )
+        print
+
+import sys
+def parse_arguments(args = sys.argv[1:]):
+    from optparse import OptionParser, make_option
+
+    option_list = [
+        make_option(
+            "--by", choices = ["assignment", "sheep"], default = "assignment",
+            help = "Whether to group the results by assignment or by sheep. "
+                   "Defaults to %default."
+        ),
+        make_option(
+            "--hours", type = "float", default = 24,
+            help = "Only include results received in the last HOURS hours. "
+                   "Defaults to %default."
+        ),
+        make_option(
+            "--assignment", metavar = "ID",
+            help = "Only include results for the given assignment."
+        ),
+        make_option(
+            "--json", action = "store_true", default = False,
+            help = "Print the report as JSON."
+        )
+    ]
+
+    parser = OptionParser(
+        usage = "Usage: %prog [OPTIONS]",
+        description = "Summarizes how long each phase of testing submissions "
+                      "took, in seconds.",
+        option_list = option_list
+    )
+
+    options, pos_args = parser.parse_args(args)
+
+    if pos_args:
+        parser.error("No positional arguments are accepted.")
+
+    return (options, pos_args)
+
+def main():
+    options, args = parse_arguments()
+
+    report = gather(
+        datetime.datetime.now() - datetime.timedelta(hours = options.hours),
+        options.by, options.assignment
+    )
+
+    if options.json:
+        import json
+        print json.dumps(report, indent = 4, sort_keys = True)
+    elif not report:
+        print >> sys.stderr, "No timed test results found."
+    else:
+        print_report(report)
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())